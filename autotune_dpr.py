@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import argparse
+from typing import Dict, List
+
+import _jsonnet
+import torch
+
+from lib import read_json, write_json, load_cwd_dotenv
+from dpr_lib import get_device_signature, get_autotune_file_path
+from index_dpr import load_retriever
+
+
+def get_peak_memory_fraction() -> float:
+    if torch.cuda.is_available():
+        return max(
+            torch.cuda.max_memory_allocated(index) / torch.cuda.get_device_properties(index).total_memory
+            for index in range(torch.cuda.device_count())
+        )
+    # peak resident memory of the process, it only increases, which is fine as the budgets only increase.
+    with open("/proc/self/status") as file:
+        peak_rss_kb = next(int(line.split()[1]) for line in file if line.startswith("VmHWM:"))
+    total_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return peak_rss_kb * 1024 / total_memory
+
+
+def make_probe_dicts(encoder_name: str, num_items: int, max_seq_len: int) -> List[Dict]:
+    # Worst case: every input is truncated to max_seq_len, so the budget is safe for any data.
+    long_text = " ".join(["retrieval"] * max_seq_len)
+    if encoder_name == "query":
+        return [{"query": long_text} for _ in range(num_items)]
+    return [
+        {"passages": [{"title": "", "text": long_text, "label": "positive", "external_id": str(index)}]}
+        for index in range(num_items)
+    ]
+
+
+def measure(retriever, encoder_name: str, max_batch_tokens: int, max_seq_len: int, num_repeats: int) -> Dict:
+    retriever.max_batch_tokens = max_batch_tokens
+    num_items = 2 * max(max_batch_tokens // max_seq_len, 1) # two full batches.
+    dicts = make_probe_dicts(encoder_name, num_items, max_seq_len)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        for index in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(index)
+    retriever._get_predictions(dicts) # warmup
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        retriever._get_predictions(dicts)
+    seconds = time.perf_counter() - start_time
+    return {
+        "max_batch_tokens": max_batch_tokens,
+        "tokens_per_second": round(num_items * max_seq_len * num_repeats / seconds, 1),
+        "peak_memory_fraction": round(get_peak_memory_fraction(), 4),
+    }
+
+
+def autotune(
+    retriever,
+    encoder_name: str,
+    max_seq_len: int,
+    max_memory_fraction: float,
+    max_batch_tokens_limit: int,
+    min_improvement: float,
+    tolerance: float,
+    num_repeats: int,
+) -> Dict:
+    # Doubles the budget (from a single item) until it runs out of memory, crosses the memory limit
+    # or the throughput stops improving. Then picks the smallest budget within tolerance of the best.
+    results = []
+    max_batch_tokens = max_seq_len
+    num_non_improvements = 0
+    while max_batch_tokens <= max_batch_tokens_limit:
+        try:
+            result = measure(retriever, encoder_name, max_batch_tokens, max_seq_len, num_repeats)
+        except RuntimeError as exception:
+            if "out of memory" not in str(exception).lower():
+                raise
+            print(f"{encoder_name}: max_batch_tokens={max_batch_tokens} ran out of memory.")
+            torch.cuda.empty_cache()
+            break
+        print(
+            f"{encoder_name}: max_batch_tokens={max_batch_tokens} tokens/sec={result['tokens_per_second']} "
+            f"peak memory={result['peak_memory_fraction']:.1%}"
+        )
+        if result["peak_memory_fraction"] > max_memory_fraction:
+            print(f"It's above the memory limit of {max_memory_fraction:.1%}.")
+            break
+        best_tokens_per_second = max([result_["tokens_per_second"] for result_ in results], default=0)
+        results.append(result)
+        if result["tokens_per_second"] < best_tokens_per_second * (1 + min_improvement):
+            num_non_improvements += 1
+            if num_non_improvements >= 2:
+                break
+        else:
+            num_non_improvements = 0
+        max_batch_tokens *= 2
+
+    if not results:
+        exit(f"Even a batch of a single {encoder_name} doesn't fit in the memory limit.")
+    best_tokens_per_second = max(result["tokens_per_second"] for result in results)
+    chosen_result = min(
+        [result for result in results if result["tokens_per_second"] >= best_tokens_per_second * (1 - tolerance)],
+        key=lambda result: result["max_batch_tokens"],
+    )
+    print(f"{encoder_name}: chose max_batch_tokens={chosen_result['max_batch_tokens']}")
+    return {"chosen": chosen_result, "probes": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the throughput-optimal encoding batch token budget for this machine."
+    )
+    parser.add_argument(
+        "experiment_name", type=str, help="experiment_name (from config file in experiment_config/)."
+    )
+    parser.add_argument(
+        "--encoders", type=str, nargs="+", choices=("passage", "query"), default=["passage", "query"],
+        help="encoders to autotune.",
+    )
+    parser.add_argument(
+        "--max_memory_fraction", type=float, default=0.85,
+        help="max fraction of the gpu (or cpu) memory that the encoding can use.",
+    )
+    parser.add_argument(
+        "--max_batch_tokens_limit", type=int, default=2**22, help="max batch token budget to try."
+    )
+    parser.add_argument(
+        "--min_improvement", type=float, default=0.05,
+        help="stop after two budget doublings that improve the throughput by less than this.",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.03,
+        help="choose the smallest budget with throughput within this of the best one.",
+    )
+    parser.add_argument("--num_repeats", type=int, default=2, help="number of timed runs per budget.")
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+
+    retriever, _ = load_retriever(args.experiment_name, experiment_config)
+    retriever.progress_bar = False
+    encoder_name_to_max_seq_len = {
+        "passage": retriever.processor.max_seq_len_passage,
+        "query": retriever.processor.max_seq_len_query,
+    }
+
+    device_signature = get_device_signature()
+    print(f"Autotuning for {device_signature}.")
+    autotune_result = {
+        "max_memory_fraction": args.max_memory_fraction,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    for encoder_name in args.encoders:
+        encoder_result = autotune(
+            retriever,
+            encoder_name,
+            encoder_name_to_max_seq_len[encoder_name],
+            max_memory_fraction=args.max_memory_fraction,
+            max_batch_tokens_limit=args.max_batch_tokens_limit,
+            min_improvement=args.min_improvement,
+            tolerance=args.tolerance,
+            num_repeats=args.num_repeats,
+        )
+        autotune_result[f"{encoder_name}_max_batch_tokens"] = encoder_result["chosen"]["max_batch_tokens"]
+        autotune_result[f"{encoder_name}_tokens_per_second"] = encoder_result["chosen"]["tokens_per_second"]
+        autotune_result[f"{encoder_name}_probes"] = encoder_result["probes"]
+
+    autotune_file_path = get_autotune_file_path(args.experiment_name)
+    autotune_results = read_json(autotune_file_path) if os.path.exists(autotune_file_path) else {}
+    autotune_results[device_signature] = {**autotune_results.get(device_signature, {}), **autotune_result}
+    write_json(autotune_results, autotune_file_path)
+
+
+if __name__ == "__main__":
+    main()
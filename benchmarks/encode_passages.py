@@ -0,0 +1,104 @@
+# Compares passage (and query) encoding throughput with and without length bucketing on CPU.
+# Run from the root directory: PYTHONPATH=. python benchmarks/encode_passages.py
+import time
+import random
+import argparse
+
+import numpy as np
+from haystack.schema import Document
+from haystack.nodes import DensePassageRetriever
+
+from haystack_monkeypatch import monkeypatch_retriever
+
+
+def make_documents(num_documents: int):
+    random.seed(13)
+    words = ["retrieval", "passage", "dense", "wikipedia", "question", "answer", "index", "milvus"]
+    # Mostly short passages with a long tail, like the paragraphs of the index data.
+    return [
+        Document(
+            content=" ".join(random.choice(words) for _ in range(min(int(random.expovariate(1 / 80)) + 5, 400))),
+            meta={"name": f"Title {index}"},
+        )
+        for index in range(num_documents)
+    ]
+
+
+def make_queries(num_queries: int):
+    random.seed(13)
+    words = ["who", "wrote", "the", "dense", "passage", "retrieval", "paper", "when"]
+    return [" ".join(random.choice(words) for _ in range(random.randint(3, 30))) for _ in range(num_queries)]
+
+
+def count_tokens(retriever: DensePassageRetriever, texts, max_length: int) -> int:
+    return sum(
+        len(input_ids) for input_ids in
+        retriever.passage_tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark length-bucketed encoding on CPU.")
+    parser.add_argument("--num_documents", type=int, help="number of passages to encode.", default=512)
+    parser.add_argument("--num_queries", type=int, help="number of queries to encode.", default=1024)
+    parser.add_argument("--batch_size", type=int, help="encoding batch size.", default=32)
+    parser.add_argument(
+        "--query_model", type=str, help="query encoder.", default="facebook/dpr-question_encoder-single-nq-base"
+    )
+    parser.add_argument(
+        "--passage_model", type=str, help="passage encoder.", default="facebook/dpr-ctx_encoder-single-nq-base"
+    )
+    args = parser.parse_args()
+
+    retriever = DensePassageRetriever(
+        document_store=None,
+        query_embedding_model=args.query_model,
+        passage_embedding_model=args.passage_model,
+        max_seq_len_query=60,
+        max_seq_len_passage=440,
+        batch_size=args.batch_size,
+        use_gpu=False,
+        progress_bar=False,
+    )
+    monkeypatch_retriever(retriever)
+
+    documents = make_documents(args.num_documents)
+    queries = make_queries(args.num_queries)
+    num_passage_tokens = count_tokens(
+        retriever, [[document.meta["name"], document.content] for document in documents], 440
+    )
+    num_query_tokens = count_tokens(retriever, queries, 60)
+
+    results = []
+    outputs = {}
+    for length_bucketed_encoding in (False, True):
+        retriever.length_bucketed_encoding = length_bucketed_encoding
+
+        start_time = time.perf_counter()
+        passage_embeddings = retriever.embed_documents(documents)
+        seconds = time.perf_counter() - start_time
+        results.append(("passages", length_bucketed_encoding, len(documents), num_passage_tokens, seconds))
+
+        start_time = time.perf_counter()
+        query_embeddings = np.stack(retriever.embed_queries(queries))
+        seconds = time.perf_counter() - start_time
+        results.append(("queries", length_bucketed_encoding, len(queries), num_query_tokens, seconds))
+
+        outputs[length_bucketed_encoding] = (passage_embeddings, query_embeddings)
+
+    print(
+        f"\n{'inputs':>9} {'bucketed':>9} {'count':>7} {'tokens':>9} {'seconds':>8} "
+        f"{'items/sec':>10} {'tokens/sec':>11}"
+    )
+    for inputs, length_bucketed_encoding, count, num_tokens, seconds in results:
+        print(
+            f"{inputs:>9} {str(length_bucketed_encoding):>9} {count:>7} {num_tokens:>9} {seconds:>8.2f} "
+            f"{count/seconds:>10.1f} {num_tokens/seconds:>11.1f}"
+        )
+    for name, index in (("passage", 0), ("query", 1)):
+        max_difference = np.abs(outputs[False][index] - outputs[True][index]).max()
+        print(f"Max absolute difference of {name} embeddings (bucketed vs not): {max_difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Compares the single-process read_jsonl path against the parallel one (with both json backends).
+# Run from the root directory: PYTHONPATH=. python benchmarks/read_jsonl.py [--file_path ...]
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+from lib import read_jsonl, load_jsonl_index
+
+
+def make_synthetic_jsonl(file_path: str, num_instances: int):
+    print(f"Writing {num_instances} synthetic passages in {file_path}")
+    random.seed(13)
+    words = ["retrieval", "passage", "dense", "wikipedia", "question", "answer", "index", "milvus"]
+    with open(file_path, "w") as file:
+        for index in range(num_instances):
+            instance = {
+                "content": " ".join(random.choice(words) for _ in range(random.randint(20, 200))),
+                "meta": {"id": str(index), "name": f"Title {index}", "section_index": 0},
+            }
+            file.write(json.dumps(instance) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark jsonl reading.")
+    parser.add_argument("--file_path", type=str, help="jsonl file to read. Synthetic if not passed.", default=None)
+    parser.add_argument("--num_instances", type=int, help="size of the synthetic file.", default=1_000_000)
+    parser.add_argument(
+        "--num_workers", type=int, nargs="+", help="parallel worker counts to try.", default=[4, 8, 16]
+    )
+    args = parser.parse_args()
+
+    temp_directory = None
+    file_path = args.file_path
+    if file_path is None:
+        temp_directory = tempfile.TemporaryDirectory()
+        file_path = os.path.join(temp_directory.name, "synthetic.jsonl")
+        make_synthetic_jsonl(file_path, args.num_instances)
+    load_jsonl_index(file_path) # so that the one-time index building isn't part of the timing.
+
+    settings = [(1, "json")] + [
+        (num_workers, json_backend) for num_workers in args.num_workers for json_backend in ("json", "orjson")
+    ]
+    results = []
+    for num_workers, json_backend in settings:
+        try:
+            start_time = time.perf_counter()
+            instances = read_jsonl(file_path, num_workers=num_workers, json_backend=json_backend)
+            seconds = time.perf_counter() - start_time
+        except ImportError:
+            print(f"Skipping json_backend={json_backend} as it's not installed.")
+            continue
+        results.append((num_workers, json_backend, len(instances), seconds))
+        del instances
+
+    baseline_seconds = results[0][3]
+    print(f"\n{'num_workers':>12} {'backend':>8} {'instances':>10} {'seconds':>8} {'speedup':>8}")
+    for num_workers, json_backend, num_instances, seconds in results:
+        print(
+            f"{num_workers:>12} {json_backend:>8} {num_instances:>10} "
+            f"{seconds:>8.2f} {baseline_seconds/seconds:>7.2f}x"
+        )
+
+    if temp_directory is not None:
+        temp_directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
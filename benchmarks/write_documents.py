@@ -0,0 +1,82 @@
+# Compares the old 10-documents-per-call write_documents loop against bulk_write_documents on the
+# sql part of the document store (which is what MilvusDocumentStore uses for documents and metadata).
+# Start the local postgresql first (python postgresql_runner.py start), then from the root directory:
+# PYTHONPATH=. python benchmarks/write_documents.py
+import time
+import random
+import argparse
+
+from haystack.document_stores import SQLDocumentStore
+
+from lib import get_postgresql_address, load_cwd_dotenv
+from dpr_lib import bulk_write_documents
+
+
+def make_documents(num_documents: int):
+    random.seed(13)
+    words = ["retrieval", "passage", "dense", "wikipedia", "question", "answer", "index", "milvus"]
+    return [
+        {
+            "id": f"benchmark_document_{index}",
+            "content": " ".join(random.choice(words) for _ in range(100)),
+            "meta": {
+                "id_prefix": "",
+                "name": f"Title {index}",
+                "section_index": 0,
+                "document_type": "paragraph",
+                "document_index": index,
+                "document_sub_index": 0,
+            },
+        }
+        for index in range(num_documents)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark document writing in postgresql.")
+    parser.add_argument("--num_documents", type=int, help="number of documents to write.", default=200_000)
+    parser.add_argument(
+        "--num_loop_documents", type=int, help="number of documents for the (slow) old loop.", default=20_000
+    )
+    parser.add_argument("--batch_size", type=int, help="bulk write batch size.", default=10_000)
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    postgresql_host, postgresql_port = get_postgresql_address()
+    index = "write_documents_benchmark"
+    document_store = SQLDocumentStore(
+        url=f"postgresql://postgres:postgres@{postgresql_host}:{postgresql_port}/postgres", index=index
+    )
+    document_store.delete_index(index)
+
+    results = []
+
+    documents = make_documents(args.num_loop_documents)
+    start_time = time.perf_counter()
+    for i in range(0, len(documents), 10):
+        document_store.write_documents(documents[i:i + 10], duplicate_documents="skip")
+    results.append(("loop of 10 (old)", len(documents), time.perf_counter() - start_time))
+    document_store.delete_index(index)
+
+    documents = make_documents(args.num_documents)
+    start_time = time.perf_counter()
+    written_documents = bulk_write_documents(document_store, documents, batch_size=args.batch_size)
+    results.append(("bulk (new)", len(documents), time.perf_counter() - start_time))
+    assert len(written_documents) == len(documents)
+    assert document_store.get_document_count() == len(documents)
+
+    documents = make_documents(args.num_documents)
+    start_time = time.perf_counter()
+    written_documents = bulk_write_documents(document_store, documents, batch_size=args.batch_size)
+    results.append(("bulk (all duplicates)", len(documents), time.perf_counter() - start_time))
+    assert not written_documents
+
+    document_store.delete_index(index)
+
+    print(f"\n{'mode':>22} {'documents':>10} {'seconds':>8} {'documents/sec':>14}")
+    for mode, num_documents, seconds in results:
+        print(f"{mode:>22} {num_documents:>10} {seconds:>8.2f} {num_documents/seconds:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
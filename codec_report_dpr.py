@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import argparse
+from typing import Dict, List
+
+import _jsonnet
+import numpy as np
+
+from lib import read_jsonl, load_cwd_dotenv
+from dpr_lib import get_index_name
+from index_dpr import load_retriever
+from local_document_store import LOCAL_INDEX_TYPES, LocalDocumentStore, get_local_index_directory
+from vector_codecs import CODEC_NAMES
+
+
+def get_recalls(rows: np.ndarray, exact_rows: np.ndarray, ks: List[int]) -> Dict[str, float]:
+    # The fraction of the exact top-k that's in the top-k, averaged over the queries.
+    recalls = {}
+    for k in ks:
+        query_recalls = []
+        for query_rows, query_exact_rows in zip(rows, exact_rows):
+            exact = set(query_exact_rows[:k]) - {-1}
+            query_recalls.append(len(exact & set(query_rows[:k])) / max(len(exact), 1))
+        recalls[f"recall@{k}"] = float(np.mean(query_recalls))
+    return recalls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report the recall (vs float32) and the memory of the local index codecs on the dev queries."
+    )
+    parser.add_argument(
+        "experiment_name", type=str, help="experiment_name (from config file in experiment_config/)."
+    )
+    parser.add_argument("prediction_file_path", nargs="?", help="queries file path (default: dev).", default=None)
+    parser.add_argument("--query_field", type=str, help="query_field", default="question_text")
+    parser.add_argument("--num_queries", type=int, help="number of queries to search.", default=1000)
+    parser.add_argument("--top_k", type=int, help="number of documents retrieved per query.", default=100)
+    parser.add_argument(
+        "--codecs", type=str, nargs="+", choices=CODEC_NAMES[1:], default=list(CODEC_NAMES[1:]),
+        help="codecs to report (their codes are built if they aren't).",
+    )
+    parser.add_argument(
+        "--rerank_top_ns", type=int, nargs="+", default=[0, 200, 1000],
+        help="numbers of candidates rescored with the float32 embeddings (0 is no re-ranking).",
+    )
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+
+    if not args.prediction_file_path:
+        args.prediction_file_path = os.path.join(experiment_config["data_dir"], experiment_config["dev_filename"])
+    index_data_path = experiment_config.pop("index_data_path")
+    index_name = get_index_name(args.experiment_name, index_data_path)
+    index_type = experiment_config.pop("index_type")
+    if index_type not in LOCAL_INDEX_TYPES:
+        exit(f"The codecs are for the local index types {LOCAL_INDEX_TYPES}, not {index_type}.")
+    # The exhaustive search of the same embeddings for every codec, so the recall is the codec's alone.
+    directory = get_local_index_directory(index_name, index_type)
+    document_store = LocalDocumentStore(directory, index=index_name)
+    num_embeddings = document_store.get_embedding_count()
+    assert num_embeddings, f"The local index {directory} is empty."
+
+    queries = [
+        instance[args.query_field] for instance in read_jsonl(args.prediction_file_path)[:args.num_queries]
+    ]
+    print(f"Embedding {len(queries)} queries from {args.prediction_file_path}.")
+    retriever, _ = load_retriever(args.experiment_name, experiment_config)
+    query_embs = retriever.embed_queries(queries)
+
+    ks = sorted({k for k in (1, 10, args.top_k) if k <= args.top_k})
+    start_time = time.perf_counter()
+    _, exact_rows = document_store.search_top_k(query_embs, args.top_k)
+    results = [{
+        "codec": "float32",
+        "rerank_top_n": 0,
+        "bytes_per_embedding": document_store._row_num_bytes,
+        "index_gb": num_embeddings * document_store._row_num_bytes / 1024**3,
+        "seconds_per_query": (time.perf_counter() - start_time) / len(queries),
+        **get_recalls(exact_rows, exact_rows, ks),
+    }]
+    for codec_name in args.codecs:
+        codec_document_store = LocalDocumentStore(directory, index=index_name, codec=codec_name)
+        codes_config = codec_document_store.config.get("codes", {}).get(codec_name)
+        if not codec_document_store.is_built_for_embeddings(codes_config):
+            codec_document_store.build_codes()
+        codec = codec_document_store._get_codes()["codec"]
+        index_num_bytes = num_embeddings * codec.num_bytes_per_vector + codec.num_state_bytes
+        for rerank_top_n in args.rerank_top_ns:
+            codec_document_store.rerank_top_n = rerank_top_n
+            start_time = time.perf_counter()
+            _, rows = codec_document_store.search_top_k(query_embs, args.top_k)
+            results.append({
+                "codec": codec_name,
+                "rerank_top_n": rerank_top_n,
+                "bytes_per_embedding": codec.num_bytes_per_vector,
+                "index_gb": index_num_bytes / 1024**3,
+                "seconds_per_query": (time.perf_counter() - start_time) / len(queries),
+                **get_recalls(rows, exact_rows, ks),
+            })
+
+    print(f"Recall against the float32 top-{args.top_k} of {len(queries)} queries over {num_embeddings} embeddings:")
+    columns = ["codec", "rerank_top_n", "bytes_per_embedding", "index_gb", "seconds_per_query"]
+    columns += [f"recall@{k}" for k in ks]
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(
+            f"{result[column]:.4f}" if isinstance(result[column], float) else str(result[column])
+            for column in columns
+        ))
+    report_file_path = os.path.join(directory, "codec_report.json")
+    with open(report_file_path, "w") as file:
+        json.dump(
+            {"prediction_file_path": args.prediction_file_path, "top_k": args.top_k, "results": results},
+            file, indent=4,
+        )
+    print(f"Saved the report in {report_file_path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import argparse
+
+from lib import open_maybe_compressed, write_lines, get_file_compression, load_jsonl_index
+
+
+def main():
+    # Converts a jsonl file (plain or compressed) to a block-compressed one, which
+    # the lib readers can slice without decompressing the file from the start.
+    parser = argparse.ArgumentParser(description="Block-compress jsonl files (gzip, bz2 or xz).")
+    parser.add_argument("input_file_path", type=str, help="input jsonl file path (can be compressed).")
+    parser.add_argument("output_file_path", type=str, help="output file path ending in .gz, .bz2 or .xz")
+    parser.add_argument(
+        "--block_num_lines", type=int, help="number of lines per compressed block.", default=10_000
+    )
+    args = parser.parse_args()
+
+    if get_file_compression(args.output_file_path) is None:
+        exit(f"The output file path {args.output_file_path} must end in .gz, .bz2 or .xz")
+
+    print(f"Compressing {args.input_file_path} into {args.output_file_path}")
+    with open_maybe_compressed(args.input_file_path) as file:
+        write_lines(file, args.output_file_path, block_num_lines=args.block_num_lines)
+
+    # Build the index right away, so that the first reader doesn't have to.
+    jsonl_index = load_jsonl_index(args.output_file_path)
+    print(
+        f"Wrote {jsonl_index['num_records']} records in "
+        f"{len(jsonl_index['point_offsets'])} blocks in {args.output_file_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
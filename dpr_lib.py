@@ -1,12 +1,20 @@
+import io
 import os
-from typing import Dict
-from lib import string_to_hash
+import json
+import uuid
+import platform
+from typing import Dict, List, Optional, Union
+from lib import (
+    string_to_hash, strip_compression_extension, read_json, get_postgresql_address, get_milvus_address,
+)
 
 
 def get_index_name(experiment_name: str, index_data_path: str) -> str:
     # NOTE: Don't change this unless absolutely necessary,
     # as milvus doesn't allow renaming collections.
 
+    # compressed and uncompressed versions of the data should map to the same index.
+    index_data_path = strip_compression_extension(index_data_path)
     index_data_path = index_data_path.replace( # TODO: Temporary hack to get natcq a good name. Fix later.
         "combined_cleaned_wikipedia_for_dpr", "processed_datasets/natcq/"
     ).replace(
@@ -96,3 +104,221 @@ def build_document_store(
         similarity="dot_product",
     )
     return document_store
+
+
+def build_milvus_document_store(index_name: str, index_type: str, delete_if_exists: bool = False):
+    # Connects to the milvus and postgresql servers (checking that the milvus one is for this index) and
+    # builds the MilvusDocumentStore of the index.
+    print("Connecting to Milvus.")
+    milvus_host, milvus_port = get_milvus_address()
+    milvus_connect(milvus_host, milvus_port)
+
+    print("Milvus collections stats.")
+    collection_name_to_sizes = get_collection_name_to_sizes()
+    print(json.dumps(collection_name_to_sizes, indent=4))
+
+    non_empty_collection_names = [
+        collection_name for collection_name, size in collection_name_to_sizes.items()
+        if size > 0
+    ]
+    if non_empty_collection_names:
+        assert non_empty_collection_names == [index_name], \
+            "Looks like your running on an incorrect milvus server. " \
+            "The index name on the server doesn't match the client."
+
+    print("Initializing MilvusDocumentStore.")
+    postgresql_host, postgresql_port = get_postgresql_address()
+    document_store = build_document_store(
+        postgresql_host, postgresql_port,
+        milvus_host, milvus_port,
+        index_name, index_type
+    )
+
+    if delete_if_exists:
+        print(f"Deleting index {index_name} if it exists.")
+        document_store.delete_index(index_name)
+
+        # it needs to be reinstantiated after deleting the index.
+        document_store = build_document_store(
+            postgresql_host, postgresql_port,
+            milvus_host, milvus_port,
+            index_name, index_type
+        )
+    return document_store
+
+
+def get_device_signature() -> str:
+    # The autotuned batch token budgets are only valid for the same kind (and number) of devices.
+    import torch
+    if torch.cuda.is_available():
+        device_names = [torch.cuda.get_device_name(index) for index in range(torch.cuda.device_count())]
+        return f"cuda:{device_names[0]}x{len(device_names)}"
+    return f"cpu:{platform.machine()}x{os.cpu_count()}"
+
+
+def get_autotune_file_path(experiment_name: str) -> str:
+    return os.path.join("experiment_configs", experiment_name + ".autotune.json")
+
+
+def get_autotuned_max_batch_tokens(experiment_name: str, encoder_name: str) -> Optional[int]:
+    assert encoder_name in ("passage", "query")
+    autotune_file_path = get_autotune_file_path(experiment_name)
+    if not os.path.exists(autotune_file_path):
+        return None
+    device_signature = get_device_signature()
+    autotune_results = read_json(autotune_file_path)
+    if device_signature not in autotune_results:
+        print(f"No autotuned batch token budget for {device_signature} in {autotune_file_path}.")
+        return None
+    max_batch_tokens = autotune_results[device_signature].get(f"{encoder_name}_max_batch_tokens", None)
+    if max_batch_tokens is None:
+        return None
+    print(f"Using the autotuned {encoder_name} batch token budget for {device_signature}: {max_batch_tokens}")
+    return max_batch_tokens
+
+
+def bulk_write_documents(
+    document_store,
+    documents: List[Union[Dict, "Document"]],
+    index: str = None,
+    batch_size: int = 10_000,
+) -> List["Document"]:
+    """
+    Writes documents in the sql database of the document store, skipping the ones already there,
+    and returns the ones that were actually written. The duplicate check is set-based per batch.
+    For postgresql, each batch is one COPY into a temp table, one INSERT ... ON CONFLICT DO NOTHING
+    and one COPY for the metadata, instead of a round trip (and duplicate check) per document.
+    """
+    from haystack.schema import Document
+    index = index or document_store.index
+    documents = [Document.from_dict(document) if isinstance(document, dict) else document for document in documents]
+    engine = document_store.session.get_bind()
+    written_documents = []
+    for i in range(0, len(documents), batch_size):
+        batch_documents = documents[i:i + batch_size]
+        if engine.dialect.name == "postgresql":
+            written_documents.extend(_copy_documents_postgresql(engine, batch_documents, index))
+        else:
+            batch_documents = document_store._handle_duplicate_documents(
+                batch_documents, index=index, duplicate_documents="skip"
+            )
+            document_store.write_documents(
+                batch_documents, index=index, batch_size=batch_size, duplicate_documents="skip"
+            )
+            written_documents.extend(batch_documents)
+    return written_documents
+
+
+def bulk_read_records(
+    document_store,
+    vector_ids: List[str],
+    index: str = None,
+    batch_size: int = 10_000,
+    session=None,
+) -> Dict[str, Dict]:
+    """
+    Reads the documents of the vector ids from the sql database of the document store straight into
+    prediction records (id with its prefix, content, score placeholder and the metadata, with name as
+    title), keyed by vector id. Per batch, it's one query for the documents and one for their metadata,
+    instead of the ORM objects (and Document objects) per document. Pass a session to read from
+    other threads, as the session of the document store can only be used by one at a time.
+    """
+    from sqlalchemy import select
+    from haystack.document_stores.sql import DocumentORM, MetaDocumentORM
+    index = index or document_store.index
+    session = session or document_store.session
+    vector_id_to_record = {}
+    for i in range(0, len(vector_ids), batch_size):
+        document_rows = session.execute(
+            select(DocumentORM.id, DocumentORM.content, DocumentORM.vector_id).where(
+                DocumentORM.index == index, DocumentORM.vector_id.in_(vector_ids[i:i + batch_size])
+            )
+        ).all()
+        if not document_rows:
+            continue
+        document_id_to_meta = {document_row.id: {} for document_row in document_rows}
+        meta_rows = session.execute(
+            select(MetaDocumentORM.document_id, MetaDocumentORM.name, MetaDocumentORM.value).where(
+                MetaDocumentORM.document_index == index,
+                MetaDocumentORM.document_id.in_(list(document_id_to_meta)),
+            )
+        ).all()
+        for meta_row in meta_rows:
+            document_id_to_meta[meta_row.document_id][meta_row.name] = meta_row.value
+        for document_row in document_rows:
+            meta = document_id_to_meta[document_row.id]
+            record = {
+                "id": meta.pop("id_prefix") + document_row.id,
+                "content": document_row.content,
+                "score": None,
+            }
+            record.update(meta)
+            if "name" in record:
+                record["title"] = record.pop("name")
+            vector_id_to_record[document_row.vector_id] = record
+    return vector_id_to_record
+
+
+def _copy_escape(value) -> str:
+    # For postgresql COPY text format.
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_rows(cursor, table_and_columns: str, rows: List[List]):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_escape(value) for value in row) + "\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table_and_columns} FROM STDIN", buffer)
+
+
+def _copy_documents_postgresql(engine, documents: List["Document"], index: str) -> List["Document"]:
+    # The tables are the ones of haystack's SQLDocumentStore (DocumentORM and MetaDocumentORM).
+    # The document content is a JSON column, and the meta value is JSON-encoded (ArrayType) by haystack.
+    # The ordinal keeps the first of the repeated ids of the batch (as duplicate_documents="skip" does), which
+    # is also the one whose meta is written below.
+    document_rows = []
+    for ordinal, document in enumerate(documents):
+        vector_id = (document.meta or {}).get("vector_id", None)
+        document_rows.append([
+            ordinal, document.id, json.dumps(document.to_dict()["content"]), document.content_type, vector_id
+        ])
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS bulk_document "
+            "(ordinal INT, id VARCHAR(100), content JSON, content_type TEXT, vector_id VARCHAR(100)) "
+            "ON COMMIT DELETE ROWS"
+        )
+        _copy_rows(cursor, "bulk_document (ordinal, id, content, content_type, vector_id)", document_rows)
+        cursor.execute(
+            'INSERT INTO document (id, content, content_type, vector_id, "index") '
+            'SELECT DISTINCT ON (id) id, content, content_type, vector_id, %s FROM bulk_document '
+            'ORDER BY id, ordinal '
+            'ON CONFLICT (id, "index") DO NOTHING RETURNING id',
+            (index,)
+        )
+        written_ids = {row[0] for row in cursor.fetchall()}
+
+        written_documents = []
+        meta_rows = []
+        for document in documents:
+            if document.id not in written_ids:
+                continue
+            written_ids.remove(document.id) # in case the same id occurs again in this batch.
+            written_documents.append(document)
+            for name, value in (document.meta or {}).items():
+                if name == "vector_id":
+                    continue
+                meta_rows.append([str(uuid.uuid4()), name, json.dumps(value), document.id, index])
+        _copy_rows(cursor, "meta_document (id, name, value, document_id, document_index)", meta_rows)
+        raw_connection.commit()
+    except Exception:
+        raw_connection.rollback()
+        raise
+    finally:
+        raw_connection.close()
+    return written_documents
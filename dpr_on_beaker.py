@@ -93,6 +93,12 @@ def main():
     allennlp_index_subparser.add_argument(
         "--delete_if_exists", action="store_true", help="delete index if it exists."
     )
+    allennlp_index_subparser.add_argument(
+        "--slice_index", type=int, help="only index this slice (run a job per slice to parallelize).", default=None
+    )
+    allennlp_index_subparser.add_argument(
+        "--consolidate", action="store_true", help="consolidate the index after all the slices are indexed."
+    )
     allennlp_predict_subparser = allennlp_subparsers.add_parser(
         "predict", description="Predict", help="Predict", parents=[allennlp_base_parser]
     )
@@ -102,6 +108,10 @@ def main():
     allennlp_predict_subparser.add_argument(
         "--batch_size", type=int, help="batch_size", default=256 # no point increasing it, knn is bs=1
     )
+    allennlp_predict_subparser.add_argument(
+        "--compress_output", type=str, choices=("gz", "bz2", "xz"), default=None,
+        help="write the predictions compressed."
+    )
     args = allennlp_root_parser.parse_args()
 
     if not args.command:
@@ -118,6 +128,9 @@ def main():
     data_paths = args.data_mounts
 
     data_paths.append(experiment_config_file_path)
+    autotune_file_path = os.path.join("experiment_configs", f"{args.experiment_name}.autotune.json")
+    if os.path.exists(autotune_file_path): # autotuned batch token budgets (see autotune_dpr.py).
+        data_paths.append(autotune_file_path)
 
     data_dir = experiment_config.get("data_dir", "")
     train_filename = experiment_config.get("train_filename", "")
@@ -172,6 +185,15 @@ def main():
         run_command = f"python {haystack_wrapper_root}/index_dpr.py {args.experiment_name}"
         if args.delete_if_exists:
             run_command += f" --delete_if_exists"
+        if args.slice_index is not None:
+            run_command += f" --slice_index {args.slice_index}"
+            if "INDEX_MANIFEST_DIRECTORY" not in os.environ:
+                print(
+                    "WARNING: INDEX_MANIFEST_DIRECTORY isn't set, so the slice jobs won't share the "
+                    "index manifest and can't be consolidated. Set it to a shared writable directory."
+                )
+        if args.consolidate:
+            run_command += f" --consolidate"
     elif args.command == "predict":
         run_command = (
             f"python {haystack_wrapper_root}/predict_dpr.py "
@@ -180,6 +202,8 @@ def main():
         )
         if args.batch_size:
             run_command += f" --batch_size {args.batch_size}"
+        if args.compress_output:
+            run_command += f" --compress_output {args.compress_output}"
     else:
         raise Exception(f"Unknown command {args.command}")
 
@@ -197,6 +221,16 @@ def main():
         envs["POSTGRESQL_SERVER_ADDRESS"] = os.environ["POSTGRESQL_SERVER_ADDRESS"]
     if "MILVUS_SERVER_ADDRESS" in os.environ:
         envs["MILVUS_SERVER_ADDRESS"] = os.environ["MILVUS_SERVER_ADDRESS"]
+    if "INDEX_MANIFEST_DIRECTORY" in os.environ:
+        envs["INDEX_MANIFEST_DIRECTORY"] = os.environ["INDEX_MANIFEST_DIRECTORY"]
+    if "EMBEDDING_CACHE_DIRECTORY" in os.environ:
+        envs["EMBEDDING_CACHE_DIRECTORY"] = os.environ["EMBEDDING_CACHE_DIRECTORY"]
+    if "TOKEN_CACHE_DIRECTORY" in os.environ:
+        envs["TOKEN_CACHE_DIRECTORY"] = os.environ["TOKEN_CACHE_DIRECTORY"]
+    if "RESULT_CACHE_DIRECTORY" in os.environ:
+        envs["RESULT_CACHE_DIRECTORY"] = os.environ["RESULT_CACHE_DIRECTORY"]
+    if "LOCAL_INDEX_DIRECTORY" in os.environ:
+        envs["LOCAL_INDEX_DIRECTORY"] = os.environ["LOCAL_INDEX_DIRECTORY"]
 
     wandb_configs = get_wandb_configs()
     if wandb_configs is None:
@@ -212,6 +246,8 @@ def main():
             args.command, args.experiment_name, prediction_file_path_
         )
 
+        if getattr(args, "slice_index", None) is not None:
+            run_name += f"__slice_{args.slice_index}"
         envs["WANDB_RUN_NAME"] = run_name
 
     if args.command in ("index", "predict"):
@@ -248,6 +284,11 @@ def main():
         data_path = args.prediction_file_path
 
     beaker_experiment_name = get_run_name(args.command, args.experiment_name, data_path)
+    if getattr(args, "slice_index", None) is not None:
+        # so that the jobs of different slices don't replace each other.
+        beaker_experiment_name += f"__slice_{args.slice_index}"
+    elif getattr(args, "consolidate", False):
+        beaker_experiment_name += "__consolidate"
     beakerizer_config_file_path = os.path.join(
         "beaker_configs", beaker_experiment_name + ".jsonnet"
     )
@@ -0,0 +1,302 @@
+import os
+import glob
+import uuid
+import fcntl
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+KEY_DTYPE = np.dtype("S16")
+
+
+def get_embedding_cache_directory() -> str:
+    return os.environ.get(
+        "EMBEDDING_CACHE_DIRECTORY",
+        os.path.join(os.path.expanduser("~"), ".cache", "haystack_wrapper", "embedding_cache"),
+    )
+
+
+def texts_to_keys(texts: List[str]) -> np.ndarray:
+    return np.array(
+        [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts], dtype=KEY_DTYPE
+    )
+
+
+def get_passage_keys(documents) -> np.ndarray:
+    # Same title and text as DensePassageRetriever.embed_documents uses.
+    return texts_to_keys([
+        (document.meta["name"] if document.meta and "name" in document.meta else "") + "\x00" + document.content
+        for document in documents
+    ])
+
+
+def get_encoder_fingerprint(encoder: torch.nn.Module, tokenizer, **settings) -> str:
+    # Hashes the weights (not the path) so that the same model loaded from different places shares the cache.
+    hasher = hashlib.sha1()
+    for name, tensor in sorted(encoder.state_dict().items()):
+        hasher.update(name.encode("utf-8"))
+        hasher.update(str(tuple(tensor.shape)).encode("utf-8"))
+        hasher.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    hasher.update(str(len(tokenizer)).encode("utf-8"))
+    for key, value in sorted(settings.items()):
+        hasher.update(f"{key}={value}".encode("utf-8"))
+    return hasher.hexdigest()[:20]
+
+
+def _get_encoding_settings(retriever) -> Dict:
+    settings = {}
+    encoder_backend = getattr(retriever, "encoder_backend", "torch") # see onnx_dpr.py
+    if encoder_backend != "torch":
+        settings["encoder_backend"] = encoder_backend
+    embedding_dtype = getattr(retriever, "embedding_dtype", "float32") # see haystack_monkeypatch.py
+    if embedding_dtype != "float32":
+        settings["embedding_dtype"] = embedding_dtype
+    return settings
+
+
+def get_passage_encoder_fingerprint(retriever) -> str:
+    settings = {
+        "max_seq_len_passage": retriever.processor.max_seq_len_passage,
+        "embed_title": retriever.processor.embed_title,
+        **_get_encoding_settings(retriever),
+    }
+    return get_encoder_fingerprint(retriever.passage_encoder, retriever.passage_tokenizer, **settings)
+
+
+def get_query_encoder_fingerprint(retriever) -> str:
+    settings = {
+        "max_seq_len_query": retriever.processor.max_seq_len_query,
+        **_get_encoding_settings(retriever),
+    }
+    return get_encoder_fingerprint(retriever.query_encoder, retriever.query_tokenizer, **settings)
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by the 16-byte digest of the text, in a directory per encoder
+    fingerprint. It's a set of immutable shards, each a sorted keys .npy and an embeddings .npy, both
+    memory-mapped, so a lookup is a binary search per shard and only the hit rows are read from disk.
+    Every put adds a shard (written to a temp file and renamed, so concurrent processes can share the
+    cache), and once there are more than max_num_shards, the smallest ones are merged. With
+    max_num_bytes, the least recently hit (or written) shards are deleted once the cache is larger.
+    """
+
+    def __init__(self, directory: str, max_num_shards: int = 64, max_num_bytes: Optional[int] = None) -> None:
+        self.directory = directory
+        self.max_num_shards = max_num_shards
+        self.max_num_bytes = max_num_bytes
+        self.num_lookups = 0
+        self.num_hits = 0
+        self._shards: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _refresh_shards(self):
+        # Other processes may have added or merged shards. The open memmaps of deleted ones stay valid.
+        shard_names = {
+            os.path.basename(path)[:-len(".keys.npy")]
+            for path in glob.glob(os.path.join(self.directory, "*.keys.npy"))
+        }
+        for shard_name in set(self._shards) - shard_names:
+            del self._shards[shard_name]
+        for shard_name in shard_names - set(self._shards):
+            shard_path = os.path.join(self.directory, shard_name)
+            try:
+                keys = np.load(shard_path + ".keys.npy", mmap_mode="r")
+                embeddings = np.load(shard_path + ".embeddings.npy", mmap_mode="r")
+            except FileNotFoundError: # merged away in the meantime.
+                continue
+            self._shards[shard_name] = (keys, embeddings)
+
+    def _sorted_shards(self) -> List[Tuple[str, np.ndarray, np.ndarray]]:
+        # largest first, as that's where most of the hits are.
+        return sorted(
+            [(shard_name, keys, embeddings) for shard_name, (keys, embeddings) in self._shards.items()],
+            key=lambda shard: -len(shard[1]),
+        )
+
+    def _lookup(self, keys: np.ndarray) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        found = np.zeros(len(keys), dtype=bool)
+        embeddings = None
+        for shard_name, shard_keys, shard_embeddings in self._sorted_shards():
+            remaining = np.flatnonzero(~found)
+            if not len(remaining):
+                break
+            if embeddings is None:
+                embeddings = np.zeros((len(keys), shard_embeddings.shape[1]), dtype=shard_embeddings.dtype)
+            positions = np.minimum(np.searchsorted(shard_keys, keys[remaining]), len(shard_keys) - 1)
+            hits = shard_keys[positions] == keys[remaining]
+            embeddings[remaining[hits]] = shard_embeddings[positions[hits]]
+            found[remaining[hits]] = True
+            if self.max_num_bytes is not None and hits.any():
+                self._touch_shard(shard_name)
+        return embeddings, found
+
+    def lookup(self, keys: np.ndarray) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        Returns (embeddings, found) where embeddings rows are only valid where found is True.
+        embeddings is None if the cache is empty.
+        """
+        with self._lock:
+            self._refresh_shards()
+            embeddings, found = self._lookup(keys)
+            self.num_lookups += len(keys)
+            self.num_hits += int(found.sum())
+        return embeddings, found
+
+    def _write_shard(self, keys: np.ndarray, embeddings: np.ndarray) -> str:
+        shard_name = "shard_" + uuid.uuid4().hex
+        shard_path = os.path.join(self.directory, shard_name)
+        # The keys file is renamed last, so a shard is only visible once it's complete.
+        for suffix, array in ((".embeddings.npy", embeddings), (".keys.npy", keys)):
+            temp_file_path = shard_path + suffix + ".tmp"
+            with open(temp_file_path, "wb") as file:
+                np.save(file, array)
+            os.replace(temp_file_path, shard_path + suffix)
+        return shard_name
+
+    def _touch_shard(self, shard_name: str):
+        # The mtime of the keys file is the last use of the shard, for the eviction.
+        try:
+            os.utime(os.path.join(self.directory, shard_name + ".keys.npy"))
+        except FileNotFoundError: # merged or evicted by another process.
+            pass
+
+    def _delete_shard(self, shard_name: str):
+        shard_path = os.path.join(self.directory, shard_name)
+        for suffix in (".keys.npy", ".embeddings.npy"): # keys first, so that it's not visible anymore.
+            if os.path.exists(shard_path + suffix):
+                os.remove(shard_path + suffix)
+
+    def put(self, keys: np.ndarray, embeddings: np.ndarray):
+        assert len(keys) == len(embeddings)
+        with self._lock:
+            self._refresh_shards()
+            keys, indices = np.unique(keys, return_index=True) # sorted and deduplicated.
+            embeddings = np.ascontiguousarray(embeddings[indices])
+            _, found = self._lookup(keys)
+            if found.all():
+                return
+            shard_name = self._write_shard(keys[~found], embeddings[~found])
+            self._shards[shard_name] = (keys[~found], embeddings[~found])
+            if len(self._shards) > self.max_num_shards:
+                self._merge_smallest_shards()
+            if self.max_num_bytes is not None:
+                self._evict_least_recently_used_shards(keep_shard_name=shard_name)
+
+    def _merge_smallest_shards(self):
+        with open(os.path.join(self.directory, "merge.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError: # another process is merging.
+                return
+            self._refresh_shards()
+            shards = self._sorted_shards()[::-1]
+            # Merging the smallest ones (rather than all) keeps the rewrites to O(log(size)) per embedding.
+            shards = shards[:len(shards) - self.max_num_shards + 1]
+            if len(shards) < 2:
+                return
+            keys = np.concatenate([shard_keys for _, shard_keys, _ in shards])
+            embeddings = np.concatenate([shard_embeddings for _, _, shard_embeddings in shards])
+            keys, indices = np.unique(keys, return_index=True)
+            embeddings = embeddings[indices]
+            merged_shard_name = self._write_shard(keys, embeddings)
+            for shard_name, _, _ in shards:
+                self._delete_shard(shard_name)
+                del self._shards[shard_name]
+            self._shards[merged_shard_name] = (keys, embeddings)
+
+    def _get_shard_num_bytes_and_mtime(self, shard_name: str) -> Tuple[int, float]:
+        shard_path = os.path.join(self.directory, shard_name)
+        try:
+            keys_stat = os.stat(shard_path + ".keys.npy")
+            embeddings_stat = os.stat(shard_path + ".embeddings.npy")
+        except FileNotFoundError:
+            return 0, 0.0
+        return keys_stat.st_size + embeddings_stat.st_size, keys_stat.st_mtime
+
+    def _evict_least_recently_used_shards(self, keep_shard_name: str):
+        shard_name_to_stats = {shard_name: self._get_shard_num_bytes_and_mtime(shard_name) for shard_name in self._shards}
+        num_bytes = sum(shard_num_bytes for shard_num_bytes, _ in shard_name_to_stats.values())
+        for shard_name in sorted(shard_name_to_stats, key=lambda shard_name: shard_name_to_stats[shard_name][1]):
+            if num_bytes <= self.max_num_bytes:
+                break
+            if shard_name == keep_shard_name: # the one just written.
+                continue
+            self._delete_shard(shard_name)
+            del self._shards[shard_name]
+            num_bytes -= shard_name_to_stats[shard_name][0]
+
+    def get_num_embeddings(self) -> int:
+        with self._lock:
+            self._refresh_shards()
+            return sum(len(keys) for keys, _ in self._shards.values())
+
+    def print_stats(self):
+        hit_rate = self.num_hits / self.num_lookups if self.num_lookups else 0.0
+        print(
+            f"Embedding cache ({self.directory}): {self.num_hits}/{self.num_lookups} hits ({hit_rate:.1%}), "
+            f"{self.get_num_embeddings()} embeddings in {len(self._shards)} shards."
+        )
+
+
+def cached_embed_documents(documents, embed_documents: Callable, embedding_cache: EmbeddingCache) -> np.ndarray:
+    keys = get_passage_keys(documents)
+    embeddings, found = embedding_cache.lookup(keys)
+    missing_indices = np.flatnonzero(~found)
+    if len(missing_indices):
+        missing_embeddings = embed_documents([documents[index] for index in missing_indices])
+        embedding_cache.put(keys[missing_indices], missing_embeddings)
+        if embeddings is None:
+            embeddings = np.zeros((len(documents), missing_embeddings.shape[1]), dtype=missing_embeddings.dtype)
+        embeddings[missing_indices] = missing_embeddings
+    return embeddings
+
+
+def cached_embed_queries(queries: List[str], embed_queries: Callable, embedding_cache: EmbeddingCache) -> np.ndarray:
+    keys = texts_to_keys(queries)
+    embeddings, found = embedding_cache.lookup(keys)
+    missing_indices = np.flatnonzero(~found)
+    if len(missing_indices):
+        missing_embeddings = embed_queries([queries[index] for index in missing_indices])
+        embedding_cache.put(keys[missing_indices], missing_embeddings)
+        if embeddings is None:
+            embeddings = np.zeros((len(queries), missing_embeddings.shape[1]), dtype=missing_embeddings.dtype)
+        embeddings[missing_indices] = missing_embeddings
+    return embeddings
+
+
+def attach_passage_embedding_cache(retriever) -> EmbeddingCache:
+    """
+    Makes retriever.embed_documents (which update_embeddings and the ingestion pipeline use) encode
+    only the passages that aren't in the cache for this passage encoder.
+    """
+    print("Computing the passage encoder fingerprint for the embedding cache.")
+    fingerprint = get_passage_encoder_fingerprint(retriever)
+    embedding_cache = EmbeddingCache(os.path.join(get_embedding_cache_directory(), "passages", fingerprint))
+    print(f"Using passage embedding cache: {embedding_cache.directory}")
+    embed_documents = retriever.embed_documents
+    retriever.embed_documents = lambda documents: cached_embed_documents(
+        documents, embed_documents, embedding_cache
+    )
+    return embedding_cache
+
+
+def attach_query_embedding_cache(retriever, max_num_bytes: Optional[int] = None) -> EmbeddingCache:
+    """
+    Makes retriever.embed_queries (which retrieve_batch uses) encode only the queries that aren't in
+    the cache for this query encoder, so repeated predictions on the same queries skip the encoder.
+    """
+    print("Computing the query encoder fingerprint for the embedding cache.")
+    fingerprint = get_query_encoder_fingerprint(retriever)
+    embedding_cache = EmbeddingCache(
+        os.path.join(get_embedding_cache_directory(), "queries", fingerprint), max_num_bytes=max_num_bytes
+    )
+    print(f"Using query embedding cache: {embedding_cache.directory}")
+    embed_queries = retriever.embed_queries
+    retriever.embed_queries = lambda queries: cached_embed_queries(queries, embed_queries, embedding_cache)
+    return embedding_cache
@@ -0,0 +1,117 @@
+import os
+import math
+import atexit
+import multiprocessing
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+
+_worker_retriever = None
+_worker_exception = None
+
+
+def get_worker_core_sets(num_workers: int, num_threads_per_worker: Optional[int] = None) -> List[List[int]]:
+    # Contiguous (so mostly same-socket) slices of the cores this process may run on.
+    cores = sorted(os.sched_getaffinity(0))
+    num_threads_per_worker = num_threads_per_worker or max(len(cores) // num_workers, 1)
+    return [
+        [
+            cores[(worker_index * num_threads_per_worker + offset) % len(cores)]
+            for offset in range(num_threads_per_worker)
+        ]
+        for worker_index in range(num_workers)
+    ]
+
+
+def _init_worker(load_retriever: Callable, core_sets: List[List[int]], num_started_workers) -> None:
+    global _worker_retriever, _worker_exception
+    with num_started_workers.get_lock(): # a counter rather than a pid, as the pool restarts dead workers.
+        core_set = core_sets[num_started_workers.value % len(core_sets)]
+        num_started_workers.value += 1
+    os.sched_setaffinity(0, core_set)
+    torch.set_num_threads(len(core_set))
+    torch.set_num_interop_threads(1)
+    try:
+        _worker_retriever = load_retriever(num_threads=len(core_set))
+    except Exception as exception: # o/w the pool restarts the worker forever, raise it on the first chunk instead.
+        _worker_exception = exception
+        return
+    _worker_retriever.progress_bar = False
+
+
+def _embed_documents(documents) -> np.ndarray:
+    if _worker_exception is not None:
+        raise _worker_exception
+    return _worker_retriever.embed_documents(documents)
+
+
+class EncodingPool:
+    """
+    Encodes passages in worker processes on cpu, each with its own retriever (loaded once) and its
+    intra-op threads pinned to a separate slice of the cores. A single process with all the threads
+    stops scaling after a few cores, while the workers scale with cores as they don't share anything.
+    The documents are sent in chunks and the embeddings come back in the order of the documents.
+    """
+
+    def __init__(
+        self,
+        load_retriever: Callable,
+        num_workers: int,
+        num_threads_per_worker: Optional[int] = None,
+        chunk_size: int = 256,
+    ) -> None:
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        core_sets = get_worker_core_sets(num_workers, num_threads_per_worker)
+        print(f"Starting {num_workers} encoding workers with {len(core_sets[0])} threads each.")
+        # spawn instead of fork: forking a process that has already used torch threads can deadlock.
+        context = multiprocessing.get_context("spawn")
+        num_started_workers = context.Value("i", 0)
+        self._pool = context.Pool(
+            num_workers, initializer=_init_worker, initargs=(load_retriever, core_sets, num_started_workers)
+        )
+
+    def _get_chunk_size(self, num_documents: int) -> int:
+        # At least one chunk per worker, even for small inputs.
+        return max(min(self.chunk_size, math.ceil(num_documents / self.num_workers)), 1)
+
+    def yield_embeddings(self, documents) -> Iterator[np.ndarray]:
+        chunk_size = self._get_chunk_size(len(documents))
+        chunks = [documents[index:index+chunk_size] for index in range(0, len(documents), chunk_size)]
+        yield from self._pool.imap(_embed_documents, chunks)
+
+    def embed_documents(self, documents) -> np.ndarray:
+        embeddings = None
+        start_index = 0
+        for chunk_embeddings in self.yield_embeddings(documents):
+            if embeddings is None:
+                embeddings = np.zeros((len(documents), chunk_embeddings.shape[1]), dtype=chunk_embeddings.dtype)
+            embeddings[start_index:start_index+len(chunk_embeddings)] = chunk_embeddings
+            start_index += len(chunk_embeddings)
+        assert start_index == len(documents)
+        return embeddings
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def attach_encoding_pool(
+    retriever, load_retriever: Callable, num_workers: int, num_threads_per_worker: Optional[int] = None
+) -> Optional[EncodingPool]:
+    """
+    Makes retriever.embed_documents (which update_embeddings and the ingestion pipeline use) encode
+    with an EncodingPool. load_retriever(num_threads=...) must load the same retriever, without a pool.
+    """
+    if torch.cuda.is_available():
+        print("Not using the encoding pool as it's only for cpu and there is a gpu.")
+        return None
+    encoding_pool = EncodingPool(load_retriever, num_workers, num_threads_per_worker)
+    atexit.register(encoding_pool.close)
+    embed_documents = retriever.embed_documents
+    retriever.embed_documents = lambda documents: (
+        encoding_pool.embed_documents(documents) if documents else embed_documents(documents)
+    )
+    return encoding_pool
@@ -0,0 +1,104 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from token_cache import get_dict_passage_keys
+
+
+# Batched (fast) tokenizer versions of what haystack's TextSimilarityProcessor.dataset_from_dicts
+# does per dict, for the passage dicts of embed_documents and the query dicts of embed_queries.
+# The (rust) fast tokenizers encode a batch in parallel and without the GIL, unlike the processor.
+
+PASSAGE_TENSOR_NAMES = ["passage_input_ids", "passage_segment_ids", "passage_attention_mask"]
+QUERY_TENSOR_NAMES = ["query_input_ids", "query_segment_ids", "query_attention_mask"]
+
+
+def is_passage_dicts(dicts: List[Dict]) -> bool:
+    return bool(dicts) and all(list(dict_) == ["passages"] and len(dict_["passages"]) == 1 for dict_ in dicts)
+
+
+def is_query_dicts(dicts: List[Dict]) -> bool:
+    return bool(dicts) and all(list(dict_) == ["query"] for dict_ in dicts)
+
+
+def normalize_question(question: str) -> str:
+    # As TextSimilarityProcessor._normalize_question.
+    if question[-1:] == "?":
+        question = question[:-1]
+    return question
+
+
+def tokenize_passages(
+    tokenizer, titles: List[str], texts: List[str], max_seq_len: int, embed_title: bool
+) -> List[List[int]]:
+    # Without the padding (the processor pads to max_seq_len), and the segment ids are all 0.
+    if embed_title:
+        titles = ["" if title is None else title for title in titles]
+        encoded = tokenizer(titles, texts, add_special_tokens=True, truncation=True, max_length=max_seq_len)
+    else:
+        encoded = tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_seq_len)
+    return encoded["input_ids"]
+
+
+def tokenize_queries(tokenizer, queries: List[str], max_seq_len: int) -> List[List[int]]:
+    queries = [normalize_question(query) for query in queries]
+    return tokenizer(queries, add_special_tokens=True, truncation=True, max_length=max_seq_len)["input_ids"]
+
+
+def _fill_padded(input_ids: np.ndarray, lengths: np.ndarray, indices: np.ndarray, token_ids: List[List[int]]):
+    for index, ids in zip(indices, token_ids):
+        input_ids[index, :len(ids)] = ids
+        lengths[index] = len(ids)
+
+
+def _to_dataset(input_ids: np.ndarray, lengths: np.ndarray, tensor_names: List[str], is_passage: bool):
+    attention_mask = (np.arange(input_ids.shape[1])[None, :] < lengths[:, None]).astype(np.int64)
+    input_ids = torch.from_numpy(input_ids)
+    attention_mask = torch.from_numpy(attention_mask)
+    if is_passage: # passages are (dicts, passages per dict, length).
+        input_ids = input_ids.unsqueeze(1)
+        attention_mask = attention_mask.unsqueeze(1)
+    return TensorDataset(input_ids, torch.zeros_like(input_ids), attention_mask), tensor_names
+
+
+def get_passage_dataset(retriever, dicts: List[Dict], token_cache=None) -> Tuple[TensorDataset, List[str]]:
+    """
+    The passage tensors of processor.dataset_from_dicts for embed_documents dicts. With a token cache
+    (see token_cache.py), the token ids come from it and only the missing passages are tokenized.
+    """
+    max_seq_len = retriever.processor.max_seq_len_passage
+    input_ids = np.full((len(dicts), max_seq_len), retriever.passage_tokenizer.pad_token_id, dtype=np.int64)
+    lengths = np.zeros(len(dicts), dtype=np.int64)
+    missing_indices = np.arange(len(dicts))
+    if token_cache is not None:
+        rows, found = token_cache.lookup(get_dict_passage_keys(dicts))
+        found_indices = np.flatnonzero(found)
+        if len(found_indices):
+            found_input_ids = input_ids[found_indices]
+            lengths[found_indices] = token_cache.fill_input_ids(rows[found_indices], found_input_ids)
+            input_ids[found_indices] = found_input_ids
+        missing_indices = np.flatnonzero(~found)
+    if len(missing_indices):
+        token_ids = tokenize_passages(
+            retriever.passage_tokenizer,
+            [dicts[index]["passages"][0].get("title") for index in missing_indices],
+            [dicts[index]["passages"][0]["text"] for index in missing_indices],
+            max_seq_len,
+            retriever.processor.embed_title,
+        )
+        _fill_padded(input_ids, lengths, missing_indices, token_ids)
+    return _to_dataset(input_ids, lengths, PASSAGE_TENSOR_NAMES, is_passage=True)
+
+
+def get_query_dataset(retriever, dicts: List[Dict]) -> Tuple[TensorDataset, List[str]]:
+    """
+    The query tensors of processor.dataset_from_dicts for embed_queries dicts.
+    """
+    max_seq_len = retriever.processor.max_seq_len_query
+    input_ids = np.full((len(dicts), max_seq_len), retriever.query_tokenizer.pad_token_id, dtype=np.int64)
+    lengths = np.zeros(len(dicts), dtype=np.int64)
+    token_ids = tokenize_queries(retriever.query_tokenizer, [dict_["query"] for dict_ in dicts], max_seq_len)
+    _fill_padded(input_ids, lengths, np.arange(len(dicts)), token_ids)
+    return _to_dataset(input_ids, lengths, QUERY_TENSOR_NAMES, is_passage=False)
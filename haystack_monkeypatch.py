@@ -3,12 +3,18 @@
 from tqdm.auto import tqdm
 import os
 import sys
+import copy
+import math
 import types
 import numbers
 import logging
+import tempfile
+import time
+from collections import deque
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict, List, Union, Any
+from typing import Optional, Dict, Iterator, List, Tuple, Union, Any
 
 import numpy as np
 import torch
@@ -16,7 +22,8 @@ from torch.utils.data.sampler import SequentialSampler
 
 from haystack.schema import Document, FilterType
 from haystack.errors import HaystackError
-from haystack.document_stores import BaseDocumentStore
+from haystack.document_stores import BaseDocumentStore, MilvusDocumentStore
+from haystack.document_stores.sql import DocumentORM
 from haystack.modeling.data_handler.dataloader import NamedDataLoader
 from haystack.nodes import DensePassageRetriever
 from haystack.modeling.visual import BUSH_SEP
@@ -24,7 +31,11 @@ from haystack.modeling.training.base import Trainer
 from haystack.modeling.evaluation.eval import Evaluator
 from haystack.utils.experiment_tracking import Tracker as tracker
 
-from lib import read_json, write_json
+from lib import read_json, write_json, format_latencies
+from dpr_lib import bulk_read_records
+from result_cache import ResultCache, embeddings_to_keys
+from local_document_store import LocalDocumentStore
+from fast_tokenization import is_passage_dicts, is_query_dicts, get_passage_dataset, get_query_dataset
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +50,7 @@ def query_by_embedding_batch(
     return_embedding: Optional[bool] = None,
     headers: Optional[Dict[str, str]] = None,
     scale_score: bool = True,
+    search_batch_size: Optional[int] = None,
 ) -> List[List[Document]]:
     if isinstance(filters, list):
         if len(filters) != len(query_embs):
@@ -48,6 +60,13 @@ def query_by_embedding_batch(
             )
     else:
         filters = [filters] * len(query_embs)
+    # NOTE(Harsh): The batched search is an addition of the monkey patch.
+    if search_batch_size and isinstance(self, MilvusDocumentStore):
+        if any(filters):
+            logger.warning("Query filters are not implemented for the MilvusDocumentStore.")
+        return _milvus_query_by_embedding_batch(
+            self, query_embs, top_k, index, return_embedding, headers, scale_score, search_batch_size
+        )
     results = []
     # NOTE(Harsh): The next 1 line is the reason for monkey patch.
     for query_emb, filter in tqdm(list(zip(query_embs, filters))):
@@ -65,6 +84,132 @@ def query_by_embedding_batch(
     return results
 
 
+def _get_documents_by_vector_ids(
+    self, vector_ids: List[str], index: str, batch_size: int = 10_000
+) -> Dict[str, Document]:
+    # SQLDocumentStore.get_documents_by_vector_ids without its sort, which is quadratic in the number of ids.
+    vector_id_to_document = {}
+    for start in range(0, len(vector_ids), batch_size):
+        query = self.session.query(DocumentORM).filter(
+            DocumentORM.vector_id.in_(vector_ids[start:start+batch_size]), DocumentORM.index == index
+        )
+        for row in query.all():
+            document = self._convert_sql_row_to_document(row)
+            vector_id_to_document[document.meta["vector_id"]] = document
+    return vector_id_to_document
+
+
+def _get_milvus_query_embs(self, query_embs: Union[List[np.ndarray], np.ndarray], index: str) -> np.ndarray:
+    from pymilvus import utility
+    if not utility.has_collection(collection_name=index):
+        raise Exception("No index exists. Use 'update_embeddings()` to create an index.")
+    query_embs = np.stack([np.asarray(query_emb).reshape(-1) for query_emb in query_embs]).astype(np.float32)
+    if self.cosine:
+        query_embs = query_embs / np.linalg.norm(query_embs, axis=1, keepdims=True)
+    return query_embs
+
+
+def _milvus_search(self, query_embs: np.ndarray, top_k: int) -> List[List[Tuple[str, float]]]:
+    # The (vector_id, distance) hits of each query, in one search request.
+    search_result = self.collection.search(
+        data=query_embs.tolist(),
+        anns_field=self.embedding_field,
+        param={"metric_type": self.metric_type, **self.search_param},
+        limit=top_k,
+    )
+    return [
+        [(str(vector_id), distance) for vector_id, distance in zip(hits.ids, hits.distances)]
+        for hits in search_result
+    ]
+
+
+def _get_search_query_embs(
+    document_store, query_embs: Union[List[np.ndarray], np.ndarray], index: str
+) -> np.ndarray:
+    if isinstance(document_store, LocalDocumentStore):
+        return np.stack([np.asarray(query_emb).reshape(-1) for query_emb in query_embs]).astype(np.float32)
+    return _get_milvus_query_embs(document_store, query_embs, index)
+
+
+def _search(document_store, query_embs: np.ndarray, top_k: int) -> List[List[Tuple[str, float]]]:
+    if isinstance(document_store, LocalDocumentStore):
+        return document_store.search(query_embs, top_k)
+    return _milvus_search(document_store, query_embs, top_k)
+
+
+def _milvus_search_batches(
+    self,
+    query_embs: Union[List[np.ndarray], np.ndarray],
+    top_k: int,
+    index: str,
+    search_batch_size: int,
+) -> Iterator[List[List[Tuple[str, float]]]]:
+    # Yields the hits of each query, per search request of search_batch_size queries.
+    query_embs = _get_milvus_query_embs(self, query_embs, index)
+    for start in tqdm(range(0, len(query_embs), search_batch_size)):
+        yield _milvus_search(self, query_embs[start:start+search_batch_size], top_k)
+
+
+def _milvus_query_by_embedding_batch(
+    self,
+    query_embs: Union[List[np.ndarray], np.ndarray],
+    top_k: int,
+    index: Optional[str],
+    return_embedding: Optional[bool],
+    headers: Optional[Dict[str, str]],
+    scale_score: bool,
+    search_batch_size: int,
+) -> List[List[Document]]:
+    # MilvusDocumentStore.query_by_embedding, but with search_batch_size query vectors per milvus search
+    # request, and one sql lookup for all the hits of those queries. Like it, it doesn't apply filters (the
+    # caller warns about them).
+    if headers:
+        raise NotImplementedError("MilvusDocumentStore does not support headers.")
+    index = index or self.index
+    if return_embedding is None:
+        return_embedding = self.return_embedding
+
+    results = []
+    for hits in _milvus_search_batches(self, query_embs, top_k, index, search_batch_size):
+        vector_ids = list({vector_id for query_hits in hits for vector_id, _ in query_hits})
+        vector_id_to_document = _get_documents_by_vector_ids(self, vector_ids, index=index)
+        if return_embedding:
+            self._populate_embeddings_to_docs(index=index, docs=list(vector_id_to_document.values()))
+        for query_hits in hits:
+            documents = []
+            for vector_id, score in query_hits:
+                if vector_id not in vector_id_to_document:
+                    continue
+                # A copy per query, as the same document can be a hit of several queries (with different scores),
+                # with its own meta, as callers pop from it.
+                document = copy.copy(vector_id_to_document[vector_id])
+                document.meta = dict(document.meta)
+                document.score = self.scale_to_unit_interval(score, self.similarity) if scale_score else score
+                documents.append(document)
+            results.append(documents)
+    return results
+
+
+def _embed_queries_in_batches(self, queries: List[str], batch_size: int) -> List[np.ndarray]:
+    query_embs: List[np.ndarray] = []
+    maybe_tqdm = tqdm if self.progress_bar else lambda e: e
+    if (
+        getattr(self, "length_bucketed_encoding", False)
+        or getattr(self, "max_batch_tokens", None)
+        or getattr(self, "tokenization_chunk_size", None)
+    ):
+        # All at once, so that the queries are bucketed by length across the batches (and tokenized ahead).
+        original_batch_size, self.batch_size = self.batch_size, batch_size
+        try:
+            query_embs.extend(self.embed_queries(queries=queries))
+        finally:
+            self.batch_size = original_batch_size
+    else:
+        for batch in maybe_tqdm(self._get_batches(queries=queries, batch_size=batch_size)):
+            query_embs.extend(self.embed_queries(queries=batch))
+    return query_embs
+
+
 def retrieve_batch(
     self,
     queries: List[str],
@@ -75,6 +220,7 @@ def retrieve_batch(
     batch_size: Optional[int] = None,
     scale_score: Optional[bool] = None,
     document_store: Optional[BaseDocumentStore] = None,
+    search_batch_size: Optional[int] = None,
 ) -> List[List[Document]]:
     document_store = document_store or self.document_store
     if document_store is None:
@@ -93,33 +239,316 @@ def retrieve_batch(
     if scale_score is None:
         scale_score = self.scale_score
 
-    query_embs: List[np.ndarray] = []
-
-    # NOTE(Harsh): The next 2 lines and the two prints below is the reason for monkey patch.
-    maybe_tqdm = tqdm if self.progress_bar else lambda e: e
-    document_store.query_by_embedding_batch = types.MethodType(query_by_embedding_batch, document_store)
     print("Building query vectors...")
-    for batch in maybe_tqdm(self._get_batches(queries=queries, batch_size=batch_size)):
-        query_embs.extend(self.embed_queries(queries=batch))
+    query_embs = _embed_queries_in_batches(self, queries, batch_size)
     print("Performing retrieval with query vectors...")
+    if isinstance(document_store, LocalDocumentStore): # searches all the queries at once anyway.
+        return document_store.query_by_embedding_batch(
+            query_embs=query_embs, top_k=top_k, filters=filters, index=index, headers=headers, scale_score=scale_score,
+        )
+    # NOTE(Harsh): The next 1 line and the two prints above is the reason for monkey patch.
+    document_store.query_by_embedding_batch = types.MethodType(query_by_embedding_batch, document_store)
     documents = document_store.query_by_embedding_batch(
-        query_embs=query_embs, top_k=top_k, filters=filters, index=index, headers=headers, scale_score=scale_score
+        query_embs=query_embs, top_k=top_k, filters=filters, index=index, headers=headers, scale_score=scale_score,
+        search_batch_size=search_batch_size,
     )
 
     return documents
 
 
-def _get_predictions(self, dicts: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+def retrieve_batch_records(
+    self,
+    queries: List[str],
+    document_store: Union[MilvusDocumentStore, LocalDocumentStore],
+    top_k: Optional[int] = None,
+    index: Optional[str] = None,
+    batch_size: Optional[int] = None,
+    scale_score: Optional[bool] = None,
+    search_batch_size: int = 256,
+    max_concurrent_searches: int = 1,
+    result_cache: Optional[ResultCache] = None,
+    result_cache_top_k: Optional[int] = None,
+) -> List[List[Dict]]:
+    """
+    retrieve_batch for predictions: the hits of each search request (of search_batch_size queries, to
+    milvus or the LocalDocumentStore) are deduplicated and read from sql together (see
+    dpr_lib.bulk_read_records), straight into output records ({"id", "content", "score", ...metadata})
+    instead of Document objects.
+    With max_concurrent_searches > 1, that many search requests (and their sql reads) are in flight
+    at once, in a thread pool, and the results are still in the order of the queries.
+    With a result_cache (see result_cache.py), only the queries without cached hits (of at least
+    top_k) are searched, for max(top_k, result_cache_top_k) hits that are then cached.
+    """
+    top_k = top_k or self.top_k
+    batch_size = batch_size or self.batch_size
+    index = index or document_store.index
+    scale_score = self.scale_score if scale_score is None else scale_score
+
+    print("Building query vectors...")
+    query_embs = embed_search_queries(self, queries, document_store, index=index, batch_size=batch_size)
+    print("Performing retrieval with query vectors...")
+    search_batch_size = max(search_batch_size, 1)
+    starts = range(0, len(query_embs), search_batch_size)
+    if max_concurrent_searches > 1:
+        from sqlalchemy.orm import sessionmaker
+        make_session = sessionmaker(bind=document_store.session.get_bind())
+    cached_hits = [None] * len(query_embs)
+    search_top_k = top_k
+    if result_cache is not None:
+        result_cache_keys = embeddings_to_keys(query_embs)
+        cached_hits, _ = result_cache.lookup(result_cache_keys, top_k)
+        search_top_k = max(top_k, result_cache_top_k or 0)
+    searched = [] # (query index, hits) of the searched queries, to cache.
+
+    def search_and_read(start: int) -> Tuple[List[List[Tuple[str, float]]], Dict[str, Dict], float]:
+        start_time = time.perf_counter()
+        hits = cached_hits[start:start+search_batch_size]
+        search_indices = [index_ for index_, query_hits in enumerate(hits, start) if query_hits is None]
+        if search_indices:
+            search_hits = _search(document_store, query_embs[search_indices], search_top_k)
+            searched.extend(list(zip(search_indices, search_hits))) # one extend, as it's shared by the threads.
+            for index_, query_hits in zip(search_indices, search_hits):
+                hits[index_ - start] = query_hits[:top_k]
+        vector_ids = list({vector_id for query_hits in hits for vector_id, _ in query_hits})
+        if max_concurrent_searches > 1:
+            # The session of the document store can't be shared by threads. A session per request
+            # gives its connection back to the engine's pool right after.
+            with make_session() as session:
+                vector_id_to_record = bulk_read_records(document_store, vector_ids, index=index, session=session)
+        else:
+            vector_id_to_record = bulk_read_records(document_store, vector_ids, index=index)
+        return hits, vector_id_to_record, time.perf_counter() - start_time
+
+    results = []
+    latencies = []
+    start_time = time.perf_counter()
+    for hits, vector_id_to_record, latency in tqdm(
+        _yield_in_order_concurrently(search_and_read, starts, max_concurrent_searches), total=len(starts)
+    ):
+        results.extend(_hits_to_records(document_store, hits, vector_id_to_record, scale_score))
+        latencies.append(latency)
+    total_time = time.perf_counter() - start_time
+    print(
+        f"Retrieved {len(query_embs)} queries in {len(starts)} search requests of up to {search_batch_size} "
+        f"queries, with up to {max_concurrent_searches} in flight, in {total_time:.1f}s "
+        f"({len(query_embs) / max(total_time, 1e-9):.1f} queries/s). "
+        f"Search request latencies: {format_latencies(latencies)}."
+    )
+    if result_cache is not None:
+        print(f"Searched {len(searched)} queries, the others were in the result cache.")
+        if searched:
+            searched_indices, searched_hits = zip(*searched)
+            result_cache.put(result_cache_keys[list(searched_indices)], list(searched_hits), search_top_k)
+    return results
+
+
+def embed_search_queries(
+    self,
+    queries: List[str],
+    document_store: Union[MilvusDocumentStore, LocalDocumentStore],
+    index: Optional[str] = None,
+    batch_size: Optional[int] = None,
+) -> np.ndarray:
+    """
+    The (num_queries, embedding_dim) query embeddings, as the search of the document store takes them.
+    """
+    query_embs = _embed_queries_in_batches(self, queries, batch_size or self.batch_size)
+    return _get_search_query_embs(document_store, query_embs, index or document_store.index)
+
+
+def search_records(
+    self,
+    query_embs: np.ndarray,
+    document_store: Union[MilvusDocumentStore, LocalDocumentStore],
+    top_k: Optional[int] = None,
+    index: Optional[str] = None,
+    scale_score: Optional[bool] = None,
+    session=None,
+) -> List[List[Dict]]:
+    """
+    One search request of the query embeddings (of embed_search_queries), with the hits read from sql
+    into records as in retrieve_batch_records. Pass a session to call it from other threads.
+    """
+    top_k = top_k or self.top_k
+    index = index or document_store.index
+    scale_score = self.scale_score if scale_score is None else scale_score
+    hits = _search(document_store, query_embs, top_k)
+    vector_ids = list({vector_id for query_hits in hits for vector_id, _ in query_hits})
+    vector_id_to_record = bulk_read_records(document_store, vector_ids, index=index, session=session)
+    return _hits_to_records(document_store, hits, vector_id_to_record, scale_score)
+
+
+def _yield_in_order_concurrently(function, items, max_workers: int) -> Iterator:
+    # function(item) of the items, from a thread pool of max_workers (or in this thread for 1), in
+    # the order of the items. At most 2 items/worker are submitted at any point.
+    if max_workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        try:
+            for item in items:
+                futures.append(executor.submit(function, item))
+                if len(futures) >= 2*max_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _hits_to_records(
+    document_store, hits: List[List[Tuple[str, float]]], vector_id_to_record: Dict[str, Dict], scale_score: bool
+) -> List[List[Dict]]:
+    results = []
+    for query_hits in hits:
+        records = []
+        for vector_id, score in query_hits:
+            if vector_id not in vector_id_to_record:
+                continue
+            record = dict(vector_id_to_record[vector_id])
+            record["score"] = (
+                document_store.scale_to_unit_interval(score, document_store.similarity) if scale_score else score
+            )
+            records.append(record)
+        results.append(records)
+    return results
+
 
+def _get_length_bucketed_batches(
+    dataset, tensor_names: List[str], batch_size: int, max_batch_tokens: Optional[int] = None
+):
+    # Sorts the items by their (passage or query) length, longest first, and trims the padding of
+    # each batch to its longest item. Each batch comes with its item indices, to put the outputs back
+    # in the original order. With max_batch_tokens, the batches are instead filled up to that many
+    # (padded) tokens.
+    tensors = dict(zip(tensor_names, dataset.tensors))
+    prefix_to_lengths = {}
+    for prefix in ("passage", "query"):
+        if f"{prefix}_attention_mask" in tensors:
+            attention_mask = tensors[f"{prefix}_attention_mask"]
+            # passage tensors are (items, passages, length) and query ones are (items, length).
+            attention_mask = attention_mask.reshape(attention_mask.shape[0], -1, attention_mask.shape[-1])
+            prefix_to_lengths[prefix] = attention_mask.sum(dim=-1).max(dim=-1).values
+            num_sequences_per_item = attention_mask.shape[1]
+    lengths = prefix_to_lengths.get("passage", prefix_to_lengths.get("query"))
+    order = torch.sort(lengths, descending=True, stable=True).indices
+
+    batches_indices = []
+    start = 0
+    while start < len(order):
+        if max_batch_tokens is None:
+            size = batch_size
+        else:
+            # The first item is the longest one of the batch, so it decides the padded length.
+            item_num_tokens = max(int(lengths[order[start]]), 1) * num_sequences_per_item
+            size = max(max_batch_tokens // item_num_tokens, 1)
+        batches_indices.append(order[start:start + size])
+        start += size
+
+    def yield_batches():
+        for indices in batches_indices:
+            batch = {name: tensor[indices] for name, tensor in tensors.items()}
+            for prefix, prefix_lengths in prefix_to_lengths.items():
+                max_length = int(prefix_lengths[indices].max())
+                for name in (f"{prefix}_input_ids", f"{prefix}_segment_ids", f"{prefix}_attention_mask"):
+                    if name in batch:
+                        batch[name] = batch[name][..., :max_length]
+            yield indices.numpy(), batch
+
+    return len(batches_indices), yield_batches()
+
+
+def _get_dataset(self, dicts: List[Dict[str, Any]]):
+    # NOTE(Harsh): The token cache and the fast tokenization are additions of the monkey patch.
+    # They're only for the dicts of embed_documents and embed_queries (see fast_tokenization.py).
+    token_cache = getattr(self, "token_cache", None)
+    fast_tokenization = getattr(self, "fast_tokenization", False)
+    if (fast_tokenization or token_cache is not None) and is_passage_dicts(dicts):
+        return get_passage_dataset(self, dicts, token_cache)
+    if fast_tokenization and is_query_dicts(dicts):
+        return get_query_dataset(self, dicts)
     dataset, tensor_names, _, _ = self.processor.dataset_from_dicts(
         dicts, indices=[i for i in range(len(dicts))], return_baskets=True
     )
+    return dataset, tensor_names
+
+
+def _yield_predictions(self, dicts: List[Dict[str, Any]]) -> Iterator[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    # NOTE(Harsh): The chunking is an addition of the monkey patch. The next chunk is tokenized in a
+    # thread while the current one is encoded (the tokenizers and the forward pass release the GIL).
+    tokenization_chunk_size = getattr(self, "tokenization_chunk_size", None)
+    if not tokenization_chunk_size or len(dicts) <= tokenization_chunk_size:
+        yield from _yield_dataset_predictions(self, *_get_dataset(self, dicts))
+        return
+    chunk_starts = list(range(0, len(dicts), tokenization_chunk_size))
+    # The rows of a chunk follow those of the previous chunks' datasets, which can be shorter than the chunks.
+    row_offset = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_dataset = executor.submit(_get_dataset, self, dicts[:tokenization_chunk_size])
+        for chunk_index in range(len(chunk_starts)):
+            dataset, tensor_names = next_dataset.result()
+            if chunk_index + 1 < len(chunk_starts):
+                next_chunk_start = chunk_starts[chunk_index + 1]
+                next_dataset = executor.submit(
+                    _get_dataset, self, dicts[next_chunk_start:next_chunk_start+tokenization_chunk_size]
+                )
+            for indices, batch_embeddings in _yield_dataset_predictions(self, dataset, tensor_names):
+                yield indices + row_offset, batch_embeddings
+            row_offset += len(dataset)
+
+
+def _allocate_embeddings(self, num_rows: int, embedding_dim: int) -> np.ndarray:
+    # NOTE(Harsh): The output buffer is an addition of the monkey patch. Filling it as the batches finish
+    # (instead of concatenating the batch outputs at the end) avoids holding the embeddings twice.
+    dtype = getattr(self, "embedding_dtype", "float32")
+    memmap_directory = getattr(self, "embedding_memmap_directory", None)
+    if memmap_directory is None:
+        return np.empty((num_rows, embedding_dim), dtype=dtype)
+    # The file is deleted right away, the mapping (and so the disk space) lives as long as the array.
+    os.makedirs(memmap_directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=memmap_directory, suffix=".npy") as file:
+        return np.lib.format.open_memmap(file.name, mode="w+", dtype=dtype, shape=(num_rows, embedding_dim))
 
-    data_loader = NamedDataLoader(
-        dataset=dataset, sampler=SequentialSampler(dataset), batch_size=self.batch_size, tensor_names=tensor_names
-    )
-    query_embeddings_batched = []
-    passage_embeddings_batched = []
+
+def _get_predictions(self, dicts: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    all_embeddings: Dict[str, np.ndarray] = {}
+    num_rows = 0
+    for indices, batch_embeddings in _yield_predictions(self, dicts):
+        for key, embeddings in batch_embeddings.items():
+            if key not in all_embeddings:
+                all_embeddings[key] = _allocate_embeddings(self, len(dicts), embeddings.shape[1])
+            all_embeddings[key][indices] = embeddings
+        num_rows += len(indices)
+    # The processor drops the dicts it fails to featurize, and the rows would no longer match the dicts.
+    assert num_rows == len(dicts), f"Only {num_rows} of the {len(dicts)} texts could be featurized."
+    return all_embeddings
+
+
+def _with_sequential_indices(data_loader):
+    start = 0
+    for batch in data_loader:
+        batch_size = len(next(iter(batch.values())))
+        yield np.arange(start, start + batch_size), batch
+        start += batch_size
+
+
+def _yield_dataset_predictions(
+    self, dataset, tensor_names: List[str]
+) -> Iterator[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    # NOTE(Harsh): The length bucketing is an addition of the monkey patch.
+    max_batch_tokens = getattr(self, "max_batch_tokens", None)
+    if getattr(self, "length_bucketed_encoding", False) or max_batch_tokens:
+        num_batches, data_loader = _get_length_bucketed_batches(
+            dataset, tensor_names, self.batch_size, max_batch_tokens
+        )
+    else:
+        data_loader = _with_sequential_indices(NamedDataLoader(
+            dataset=dataset, sampler=SequentialSampler(dataset), batch_size=self.batch_size, tensor_names=tensor_names
+        ))
+        num_batches = math.ceil(len(dataset) / self.batch_size)
     self.model.eval()
 
     # When running evaluations etc., we don't want a progress bar for every single query
@@ -131,14 +560,14 @@ def _get_predictions(self, dicts: List[Dict[str, Any]]) -> Dict[str, np.ndarray]
     # NOTE(Harsh): The next 1 line is the reason for monkey patch.
     disable_tqdm = True
     with tqdm(
-        total=len(data_loader) * self.batch_size,
+        total=num_batches * self.batch_size,
         unit=" Docs",
         desc="Create embeddings",
         position=1,
         leave=False,
         disable=disable_tqdm,
     ) as progress_bar:
-        for raw_batch in data_loader:
+        for indices, raw_batch in data_loader:
             batch = {key: raw_batch[key].to(self.devices[0]) for key in raw_batch}
 
             # get logits
@@ -151,23 +580,79 @@ def _get_predictions(self, dicts: List[Dict[str, Any]]) -> Dict[str, np.ndarray]
                     passage_segment_ids=batch.get("passage_segment_ids", None),
                     passage_attention_mask=batch.get("passage_attention_mask", None),
                 )[0]
+                batch_embeddings: Dict[str, np.ndarray] = {}
                 if query_embeddings is not None:
-                    query_embeddings_batched.append(query_embeddings.cpu().numpy())
+                    batch_embeddings["query"] = query_embeddings.cpu().numpy()
                 if passage_embeddings is not None:
-                    passage_embeddings_batched.append(passage_embeddings.cpu().numpy())
+                    batch_embeddings["passages"] = passage_embeddings.cpu().numpy()
             progress_bar.update(self.batch_size)
-
-    all_embeddings: Dict[str, np.ndarray] = {}
-    if passage_embeddings_batched:
-        all_embeddings["passages"] = np.concatenate(passage_embeddings_batched)
-    if query_embeddings_batched:
-        all_embeddings["query"] = np.concatenate(query_embeddings_batched)
-    return all_embeddings
-
-
-def monkeypatch_retriever(retriever: DensePassageRetriever):
+            # outside of the inference mode, as it'd otherwise leak into the consumer while suspended.
+            yield indices, batch_embeddings
+
+
+def _documents_to_dicts(documents: List[Document]) -> List[Dict[str, Any]]:
+    # As DensePassageRetriever.embed_documents makes them.
+    return [
+        {
+            "passages": [
+                {
+                    "title": d.meta["name"] if d.meta and "name" in d.meta else "",
+                    "text": d.content,
+                    "label": d.meta["label"] if d.meta and "label" in d.meta else "positive",
+                    "external_id": d.id,
+                }
+            ]
+        }
+        for d in documents
+    ]
+
+
+def yield_document_embeddings(self, documents: List[Document]) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Streaming embed_documents: yields (document indices, embeddings) per batch, as soon as it's encoded.
+    The batches are in encoding order, which isn't the document order with length bucketing.
+    """
+    self.processor.num_hard_negatives = 0
+    for indices, batch_embeddings in _yield_predictions(self, _documents_to_dicts(documents)):
+        yield indices, batch_embeddings["passages"]
+
+
+def yield_query_embeddings(self, queries: List[str]) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Streaming embed_queries: yields (query indices, embeddings) per batch, as soon as it's encoded.
+    """
+    for indices, batch_embeddings in _yield_predictions(self, [{"query": query} for query in queries]):
+        yield indices, batch_embeddings["query"]
+
+
+def monkeypatch_retriever(
+    retriever: DensePassageRetriever,
+    length_bucketed_encoding: bool = False,
+    max_batch_tokens: Optional[int] = None,
+    fast_tokenization: bool = False,
+    tokenization_chunk_size: Optional[int] = None,
+    embedding_dtype: str = "float32",
+    embedding_memmap_directory: Optional[str] = None,
+):
+    assert embedding_dtype in ("float32", "float16"), "embedding_dtype must be float32 or float16."
+    # max_batch_tokens (if set) replaces the batch_size of the encoding, and implies length bucketing.
+    retriever.length_bucketed_encoding = length_bucketed_encoding
+    retriever.max_batch_tokens = max_batch_tokens
+    # fast_tokenization makes the tensors with batched tokenizer calls instead of the processor, and
+    # tokenization_chunk_size (if set) overlaps the tokenization of a chunk with the encoding of the previous one.
+    retriever.fast_tokenization = fast_tokenization
+    retriever.tokenization_chunk_size = tokenization_chunk_size
+    # The embeddings are returned in (and converted to) embedding_dtype, in a memory-mapped temporary
+    # file under embedding_memmap_directory if it's set (see _allocate_embeddings).
+    retriever.embedding_dtype = embedding_dtype
+    retriever.embedding_memmap_directory = embedding_memmap_directory
     retriever.retrieve_batch = types.MethodType(retrieve_batch, retriever)
+    retriever.retrieve_batch_records = types.MethodType(retrieve_batch_records, retriever)
+    retriever.embed_search_queries = types.MethodType(embed_search_queries, retriever)
+    retriever.search_records = types.MethodType(search_records, retriever)
     retriever._get_predictions = types.MethodType(_get_predictions, retriever)
+    retriever.yield_document_embeddings = types.MethodType(yield_document_embeddings, retriever)
+    retriever.yield_query_embeddings = types.MethodType(yield_query_embeddings, retriever)
 
 
 def log_results(
@@ -1,83 +1,178 @@
 import os
+import sys
 import json
+import time
 import argparse
+import subprocess
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import _jsonnet
-from progressbar import progressbar
 from haystack.nodes import DensePassageRetriever
+from haystack.document_stores import MilvusDocumentStore
 
 from lib import yield_jsonl_slice, get_postgresql_address, get_milvus_address, load_cwd_dotenv
-from dpr_lib import get_index_name, milvus_connect, get_collection_name_to_sizes, build_document_store
+from dpr_lib import (
+    get_index_name, build_document_store, build_milvus_document_store, bulk_write_documents,
+    get_autotuned_max_batch_tokens,
+)
 from haystack_monkeypatch import monkeypatch_retriever
+from onnx_dpr import use_onnx_encoders
+from embedding_cache import EmbeddingCache, attach_passage_embedding_cache
+from encoding_pool import attach_encoding_pool
+from token_cache import attach_passage_token_cache
+from local_document_store import LOCAL_INDEX_TYPES, LocalDocumentStore, build_local_document_store
+from ingestion_pipeline import IngestionPipeline
+from index_manifest import IndexManifest, get_index_manifest_directory
 
 
-def main():
-    # https://haystack.deepset.ai/tutorials/06_better_retrieval_via_embedding_retrieval
+def normalize_document(document: Dict, embed_title: bool) -> Dict:
+    true_document_id = document["meta"].pop("id")
+    document["id"] = true_document_id[-100:] # o/w raises error. The true ID will be in the metadata.
+    document["meta"]["id_prefix"] = true_document_id.replace(document["id"], "")
+    assert true_document_id == document["meta"]["id_prefix"] + document["id"]
+    metadata = {}
+    field_names = ["id_prefix", "section_index", "document_type", "document_index", "document_sub_index"]
+    for key_name in field_names:
+        if key_name in document["meta"]:
+            metadata[key_name] = document["meta"][key_name]
+    if embed_title:
+        assert "title" in document["meta"] or "name" in document["meta"], \
+            "The title/name must be set in meta if embed_title is True."
+        title = document["meta"].get("title", document["meta"].get("name", None))
+        metadata["name"] = title
+        assert title is not None
+    document["meta"] = metadata
+    return document
 
-    parser = argparse.ArgumentParser(description="Allennlp-style wrapper around Haystack.")
-    parser.add_argument(
-        "experiment_name", type=str,
-        help="experiment_name (from config file in experiment_config/). Use haystack_help to see haystack args help."
-    )
-    parser.add_argument("--delete_if_exists", action="store_true", default=False, help="delete index if it exists.")
-    args = parser.parse_args()
-    load_cwd_dotenv()
 
-    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
-    if not os.path.exists(experiment_config_file_path):
-        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+def yield_document_batches(
+    index_data_path: str,
+    index_manifest: IndexManifest,
+    embed_title: bool,
+    batch_size: int,
+    num_read_workers: int = 1,
+    slice_indices: Optional[List[int]] = None,
+):
+    num_slices = index_manifest.num_slices
+    slice_indices = range(num_slices) if slice_indices is None else slice_indices
+    for slice_index in slice_indices:
+        if index_manifest.is_slice_embedded(slice_index):
+            print(f"\n\nSkipping slice {slice_index+1}/{num_slices} as it's already embedded.")
+            continue
+        # The records whose vectors are already inserted are skipped (the batches go through the pipeline in order).
+        num_records_to_skip = index_manifest.get_slice(slice_index).get("num_embedded_records", 0)
+        print(f"\n\nReading input documents slice {slice_index+1}/{num_slices} (skipping {num_records_to_skip}).")
+        documents = []
+        num_records = 0
+        for document in yield_jsonl_slice(
+            index_data_path, num_slices, slice_index, num_workers=num_read_workers
+        ):
+            num_records += 1
+            if num_records <= num_records_to_skip:
+                continue
+            documents.append(normalize_document(document, embed_title))
+            if len(documents) >= batch_size:
+                yield {"slice_index": slice_index, "documents": documents, "num_records": len(documents), "is_last": False}
+                documents = []
+        # the last one is yielded even if it's empty, so that the slice status is updated.
+        yield {"slice_index": slice_index, "documents": documents, "num_records": len(documents), "is_last": True}
 
-    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
 
-    print("Connecting to Milvus.")
-    milvus_host, milvus_port = get_milvus_address()
-    milvus_connect(milvus_host, milvus_port)
+def run_ingestion_pipeline(
+    document_batches: Iterable[Dict],
+    document_store: MilvusDocumentStore,
+    vector_document_store: MilvusDocumentStore,
+    retriever: DensePassageRetriever,
+    index_manifest: IndexManifest,
+    queue_size: int,
+    write_batch_size: int,
+):
+    # The sql writes and the vector insertions happen in different threads, and sqlalchemy sessions
+    # aren't thread-safe. So the vector insertion stage uses its own document store (and so session).
+    index = document_store.index
 
-    embed_title = experiment_config.pop("embed_title", True)
-    index_num_chunks = experiment_config.pop("index_num_chunks", 1)
-    index_data_path = experiment_config.pop("index_data_path")
-    index_name = get_index_name(args.experiment_name, index_data_path)
-    index_type = experiment_config.pop("index_type")
-    assert index_type in ("FLAT", "IVF_FLAT", "HNSW")
-    print(f"Index name: {index_name}")
-    print(f"Index type: {index_type}")
+    def write_documents(batch: Dict) -> Dict:
+        # Documents that are already in the store are dropped here, so they aren't embedded again.
+        # If they were written by an earlier (interrupted) run, but not embedded, the update_embeddings
+        # call after the pipeline takes care of them.
+        slice_index = batch["slice_index"]
+        documents = bulk_write_documents(document_store, batch["documents"], index=index, batch_size=write_batch_size)
+        if documents:
+            slice_ = index_manifest.get_slice(slice_index)
+            index_manifest.update_slice(
+                slice_index,
+                first_document_id=slice_.get("first_document_id", documents[0].id),
+                last_document_id=documents[-1].id,
+                num_written_documents=slice_.get("num_written_documents", 0) + len(documents),
+            )
+        if batch["is_last"]:
+            index_manifest.update_slice(slice_index, status="written")
+        batch["documents"] = documents
+        return batch
 
-    print("Milvus collections stats.")
-    collection_name_to_sizes = get_collection_name_to_sizes()
-    print(json.dumps(collection_name_to_sizes, indent=4))
+    def encode_documents(batch: Dict) -> Dict:
+        if batch["documents"]:
+            batch["embeddings"] = retriever.embed_documents(batch["documents"])
+        return batch
 
-    non_empty_collection_names = [
-        collection_name for collection_name, size in collection_name_to_sizes.items()
-        if size > 0
-    ]
-    if non_empty_collection_names:
-        assert non_empty_collection_names == [index_name], \
-            "Looks like your running on an incorrect milvus server. " \
-            "The index name on the server doesn't match the client."
-
-    print("Initializing MilvusDocumentStore.")
-    postgresql_host, postgresql_port = get_postgresql_address()
-    document_store = build_document_store(
-        postgresql_host, postgresql_port,
-        milvus_host, milvus_port,
-        index_name, index_type
+    def insert_vectors(batch: Dict) -> Dict:
+        slice_index = batch["slice_index"]
+        if batch["documents"]:
+            mutation_result = vector_document_store.collection.insert([batch.pop("embeddings").tolist()])
+            vector_id_map = {
+                document.id: str(vector_id)
+                for vector_id, document in zip(mutation_result.primary_keys, batch["documents"])
+            }
+            vector_document_store.update_vector_ids(vector_id_map, index=index)
+        index_manifest.increment_slice(slice_index, "num_embedded_records", batch["num_records"])
+        if batch["is_last"]:
+            index_manifest.update_slice(slice_index, status="embedded")
+        return batch
+
+    document_store.progress_bar = False
+    vector_document_store.progress_bar = False
+    pipeline = IngestionPipeline(
+        stages=[("write", write_documents), ("encode", encode_documents), ("insert", insert_vectors)],
+        queue_size=queue_size,
+        get_item_size=lambda batch: len(batch["documents"]),
     )
+    pipeline.run(document_batches, source_name="parse")
+    pipeline.print_report()
 
-    if args.delete_if_exists:
-        print(f"Deleting index {index_name} if it exists.")
-        document_store.delete_index(index_name)
-
-        # it needs to be reinstantiated after deleting the index.
-        document_store = build_document_store(
-            postgresql_host, postgresql_port,
-            milvus_host, milvus_port,
-            index_name, index_type
-        )
 
+def load_retriever(
+    experiment_name: str,
+    experiment_config: Dict,
+    use_embedding_cache: bool = False,
+    num_threads: Optional[int] = None,
+    index_data_path: Optional[str] = None,
+) -> Tuple[DensePassageRetriever, Optional[EmbeddingCache]]:
     print("Loading DPR retriever models.")
-    serialization_dir = os.path.join("serialization_dir", args.experiment_name)
+    serialization_dir = os.path.join("serialization_dir", experiment_name)
+    # The encoding workers load the same retriever, from the config before the pops below.
+    worker_experiment_config = {**experiment_config, "index_num_encoding_workers": 0}
     dont_train = experiment_config.pop("dont_train", False)
     batch_size = experiment_config.pop("index_batch_size", 5120) # use 4X48Gs.
+    # Pads each batch only to its longest passage instead of max_seq_len_passage (see haystack_monkeypatch.py).
+    length_bucketed_encoding = experiment_config.pop("length_bucketed_encoding", False)
+    # Tokenizes with batched fast-tokenizer calls, a chunk ahead of the encoding (see haystack_monkeypatch.py).
+    fast_tokenization = experiment_config.pop("fast_tokenization", False)
+    tokenization_chunk_size = experiment_config.pop("tokenization_chunk_size", None)
+    # "float16" halves the memory of the embeddings, and the memmap directory moves them to disk.
+    embedding_dtype = experiment_config.pop("embedding_dtype", "float32")
+    embedding_memmap_directory = experiment_config.pop("embedding_memmap_directory", None)
+    # "onnx" or "onnx_int8" for cpu nodes, after exporting the encoders with onnx_dpr.py.
+    encoder_backend = experiment_config.pop("encoder_backend", "torch")
+    # Batches by a number of (padded) tokens instead of index_batch_size. See autotune_dpr.py.
+    max_batch_tokens = experiment_config.pop("index_max_batch_tokens", None)
+    if max_batch_tokens is None:
+        max_batch_tokens = get_autotuned_max_batch_tokens(experiment_name, "passage")
+    # Encodes the passages in this many processes with pinned threads on cpu nodes (see encoding_pool.py).
+    num_encoding_workers = experiment_config.pop("index_num_encoding_workers", 0)
+    encoding_threads_per_worker = experiment_config.pop("index_encoding_threads_per_worker", None)
+    # Reads the passage token ids made by pretokenize_dpr.py for index_data_path (see token_cache.py).
+    use_token_cache = experiment_config.pop("index_token_cache", False)
     if dont_train:
         query_model = experiment_config["query_model"]
         passage_model = experiment_config["passage_model"]
@@ -99,45 +194,343 @@ def main():
             max_seq_len_passage=440,
             batch_size=batch_size,
         )
-    monkeypatch_retriever(retriever)
+    monkeypatch_retriever(
+        retriever,
+        length_bucketed_encoding=length_bucketed_encoding,
+        max_batch_tokens=max_batch_tokens,
+        fast_tokenization=fast_tokenization,
+        tokenization_chunk_size=tokenization_chunk_size,
+        embedding_dtype=embedding_dtype,
+        embedding_memmap_directory=embedding_memmap_directory,
+    )
+    use_onnx_encoders(retriever, experiment_name, encoder_backend, num_threads)
+    if use_token_cache and index_data_path is not None:
+        attach_passage_token_cache(retriever, index_data_path)
+    if num_encoding_workers:
+        attach_encoding_pool(
+            retriever,
+            partial(load_encoding_worker_retriever, experiment_name, worker_experiment_config, index_data_path),
+            num_encoding_workers,
+            encoding_threads_per_worker,
+        )
+    embedding_cache = None
+    if use_embedding_cache:
+        embedding_cache = attach_passage_embedding_cache(retriever)
+    return retriever, embedding_cache
+
+
+def load_encoding_worker_retriever(
+    experiment_name: str, experiment_config: Dict, index_data_path: Optional[str], num_threads: int
+) -> DensePassageRetriever:
+    return load_retriever(
+        experiment_name, experiment_config, num_threads=num_threads, index_data_path=index_data_path
+    )[0]
+
+
+def get_gpu_ids() -> List[str]:
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        return [gpu_id for gpu_id in os.environ["CUDA_VISIBLE_DEVICES"].split(",") if gpu_id.strip()]
+    import torch
+    return [str(gpu_id) for gpu_id in range(torch.cuda.device_count())]
+
+
+def run_index_workers(experiment_name: str, slice_indices: List[int], num_workers: int, logs_directory: str):
+    # Each slice is indexed by a separate process (python index_dpr.py ... --slice_index k), at most
+    # num_workers at a time. The GPUs are assigned to the worker slots round-robin.
+    gpu_ids = get_gpu_ids()
+    os.makedirs(logs_directory, exist_ok=True)
+    pending_slice_indices = list(slice_indices)
+    free_worker_indices = list(range(num_workers))
+    running = [] # (slice_index, worker_index, process, log_file)
+    failed_slice_indices = []
+    print(f"Indexing {len(pending_slice_indices)} slices with {num_workers} workers on gpus: {gpu_ids}.")
+    while pending_slice_indices or running:
+        while pending_slice_indices and free_worker_indices:
+            slice_index = pending_slice_indices.pop(0)
+            worker_index = free_worker_indices.pop(0)
+            env = dict(os.environ)
+            if gpu_ids:
+                env["CUDA_VISIBLE_DEVICES"] = gpu_ids[worker_index % len(gpu_ids)]
+            log_file_path = os.path.join(logs_directory, f"slice_{str(slice_index).zfill(5)}.log")
+            log_file = open(log_file_path, "a")
+            command = [
+                sys.executable, os.path.abspath(__file__), experiment_name, "--slice_index", str(slice_index)
+            ]
+            process = subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+            print(f"Started worker {worker_index} on slice {slice_index} (log: {log_file_path}).")
+            running.append((slice_index, worker_index, process, log_file))
+        time.sleep(5)
+        for item in list(running):
+            slice_index, worker_index, process, log_file = item
+            if process.poll() is None:
+                continue
+            running.remove(item)
+            log_file.close()
+            free_worker_indices.append(worker_index)
+            if process.returncode != 0:
+                failed_slice_indices.append(slice_index)
+                print(f"Worker {worker_index} failed on slice {slice_index} (exit code {process.returncode}).")
+            else:
+                print(f"Worker {worker_index} finished slice {slice_index}.")
+    if failed_slice_indices:
+        exit(
+            f"Slices {sorted(failed_slice_indices)} failed, see the logs in {logs_directory}. "
+            "Rerunning the same command resumes them."
+        )
+
+
+def consolidate_index(
+    document_store: MilvusDocumentStore,
+    index_manifest: IndexManifest,
+    get_retriever: Callable[[], DensePassageRetriever],
+):
+    # Run once after all the slices are indexed (possibly by many workers).
+    from pymilvus import utility
+    index_manifest.reload()
+    index_manifest.print_summary()
+    not_embedded_slice_indices = [
+        slice_index for slice_index in range(index_manifest.num_slices)
+        if not index_manifest.is_slice_embedded(slice_index)
+    ]
+    if not_embedded_slice_indices:
+        exit(f"Slices {not_embedded_slice_indices} aren't embedded yet, index them before consolidating.")
+
+    # The workers only embed the documents they write. These are the ones written (but not embedded)
+    # by interrupted workers, which are skipped as existing ones on resume. It's safe here as it's one process.
+    num_documents_without_embedding = document_store.get_document_count(only_documents_without_embedding=True)
+    if num_documents_without_embedding:
+        print(f"Embedding {num_documents_without_embedding} documents that were written but not embedded.")
+        document_store.progress_bar = True
+        document_store.update_embeddings(
+            get_retriever(), batch_size=10_000, update_existing_embeddings=False,
+        )
+
+    # Milvus builds the index of a segment once it's sealed, so flushing the growing segments of
+    # all the workers makes it build the rest of the index now rather than at the query time.
+    print("Flushing milvus collection and waiting for the index to be built.")
+    document_store.collection.flush()
+    utility.wait_for_index_building_complete(document_store.index)
+    document_store.collection.load()
+
+    num_documents = document_store.get_document_count()
+    num_documents_without_embedding = document_store.get_document_count(only_documents_without_embedding=True)
+    num_vectors = document_store.collection.num_entities
+    num_manifest_documents = index_manifest.get_num_written_documents()
+    print(f"Number of documents: {num_documents}")
+    print(f"Number of documents without embeddings: {num_documents_without_embedding}")
+    print(f"Number of vectors: {num_vectors}")
+    print(f"Number of documents written as per the manifest: {num_manifest_documents}")
+    if num_documents_without_embedding or num_vectors < num_documents:
+        exit("The index is incomplete, some of the documents don't have vectors.")
+    if num_vectors > num_documents:
+        print(
+            f"WARNING: There are {num_vectors - num_documents} more vectors than documents. These are from "
+            "workers that were interrupted after inserting vectors but before saving their ids. "
+            "They aren't reachable from any document, so they are harmless but take space."
+        )
+    if num_manifest_documents != num_documents:
+        print(
+            "WARNING: The number of documents doesn't match the manifest. "
+            "A worker was probably interrupted between writing documents and updating the manifest."
+        )
+    print("The index is consolidated.")
+
+
+def finish_local_index(document_store: LocalDocumentStore, nlist: int):
+    # Tunes the search and builds what the index type and codec search over, unless it's up to date.
+    print("Tuning the search block size of the local index.")
+    document_store.tune_block_size()
+    codec = document_store.codec_name
+    if document_store.index_type == "NUMPY_IVF":
+        ivf_config = document_store.config.get("ivf")
+        if document_store.is_built_for_embeddings(ivf_config) and ivf_config.get("codec", "float32") == codec:
+            print("The IVF of the local index is up to date.")
+        else:
+            print("Building the IVF of the local index.")
+            document_store.build_ivf(nlist)
+    elif codec != "float32":
+        codes_config = document_store.config.get("codes", {}).get(codec)
+        if document_store.is_built_for_embeddings(codes_config):
+            print(f"The {codec} codes of the local index are up to date.")
+        else:
+            print(f"Building the {codec} codes of the local index.")
+            document_store.build_codes()
+
+
+def main():
+    # https://haystack.deepset.ai/tutorials/06_better_retrieval_via_embedding_retrieval
+
+    parser = argparse.ArgumentParser(description="Allennlp-style wrapper around Haystack.")
+    parser.add_argument(
+        "experiment_name", type=str,
+        help="experiment_name (from config file in experiment_config/). Use haystack_help to see haystack args help."
+    )
+    parser.add_argument("--delete_if_exists", action="store_true", default=False, help="delete index if it exists.")
+    parser.add_argument(
+        "--slice_index", type=int, default=None,
+        help="only index this slice (of index_num_chunks). Many such workers can run at once on the same index.",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=0,
+        help="index the slices with these many local worker processes and then consolidate the index.",
+    )
+    parser.add_argument(
+        "--consolidate", action="store_true", default=False,
+        help="only consolidate (and verify) the index after all the slices are indexed by the workers.",
+    )
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    if args.slice_index is not None and (args.delete_if_exists or args.num_workers or args.consolidate):
+        exit("--slice_index can't be used with --delete_if_exists, --num_workers or --consolidate.")
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+
+    embed_title = experiment_config.pop("embed_title", True)
+    index_num_chunks = experiment_config.pop("index_num_chunks", 1)
+    index_num_read_workers = experiment_config.pop("index_num_read_workers", 1)
+    # Overlaps parsing, sql writes, encoding and vector insertions (see ingestion_pipeline.py).
+    index_pipeline = experiment_config.pop("index_pipeline", False)
+    index_pipeline_queue_size = experiment_config.pop("index_pipeline_queue_size", 2)
+    index_write_batch_size = experiment_config.pop("index_write_batch_size", 10_000)
+    # Reuses the passage embeddings across index types and document stores (same encoder and passages).
+    index_embedding_cache = experiment_config.pop("index_embedding_cache", False)
+    index_data_path = experiment_config.pop("index_data_path")
+    index_name = get_index_name(args.experiment_name, index_data_path)
+    index_type = experiment_config.pop("index_type")
+    assert index_type in ("FLAT", "IVF_FLAT", "HNSW") + LOCAL_INDEX_TYPES
+    print(f"Index name: {index_name}")
+    print(f"Index type: {index_type}")
+    # The number of inverted lists of NUMPY_IVF (nlist of IVF_FLAT is set in build_document_store).
+    nlist = experiment_config.pop("nlist", 16384)
+    # The storage of the local index embeddings for the search (see vector_codecs.py).
+    codec = experiment_config.pop("codec", "float32")
+
+    if index_type in LOCAL_INDEX_TYPES:
+        # The local index is a sqlite database and an embeddings file, which workers can't share.
+        if args.slice_index is not None or args.num_workers or args.consolidate or index_pipeline:
+            exit("--slice_index, --num_workers, --consolidate and index_pipeline aren't supported for local indexes.")
+        print("Initializing LocalDocumentStore.")
+        document_store = build_local_document_store(index_name, index_type, codec=codec)
+        if args.delete_if_exists:
+            print(f"Deleting index {index_name} if it exists.")
+            document_store.delete_index(index_name)
+    else:
+        document_store = build_milvus_document_store(index_name, index_type, args.delete_if_exists)
+
+    if index_type in LOCAL_INDEX_TYPES: # with the index, as the milvus index of the same name is another one.
+        index_manifest_directory = os.path.join(document_store.directory, "manifest")
+    else:
+        index_manifest_directory = get_index_manifest_directory(args.experiment_name, index_name)
+    index_manifest = IndexManifest(index_manifest_directory, index_name, index_data_path, index_num_chunks)
+    if args.delete_if_exists:
+        index_manifest.delete()
+    index_manifest.load_or_create()
+    if args.slice_index is not None and not 0 <= args.slice_index < index_num_chunks:
+        exit(f"The slice_index must be in [0, {index_num_chunks}).")
+    if index_manifest.get_num_written_documents() > document_store.get_document_count():
+        if args.slice_index is not None:
+            exit("The index manifest has more written documents than the document store. Rerun with --delete_if_exists.")
+        print(
+            "WARNING: The index manifest has more written documents than the document store. "
+            "Looks like the store was emptied outside of this script, so resetting the manifest."
+        )
+        index_manifest.delete()
+        index_manifest.load_or_create()
+    index_manifest.print_summary()
+
+    if args.num_workers or args.consolidate:
+        if args.num_workers:
+            run_index_workers(
+                args.experiment_name,
+                [
+                    slice_index for slice_index in range(index_num_chunks)
+                    if not index_manifest.is_slice_embedded(slice_index)
+                ],
+                args.num_workers,
+                logs_directory=os.path.join(index_manifest_directory, "logs"),
+            )
+        consolidate_index(
+            document_store, index_manifest,
+            lambda: load_retriever(
+                args.experiment_name, experiment_config, index_embedding_cache, index_data_path=index_data_path
+            )[0],
+        )
+        return
+
+    retriever, embedding_cache = load_retriever(
+        args.experiment_name, experiment_config, index_embedding_cache, index_data_path=index_data_path
+    )
+
+    # A worker (--slice_index) always uses the pipeline, as it embeds exactly the documents it writes,
+    # while update_embeddings embeds all the documents without vectors, including other workers' ones.
+    if index_pipeline or args.slice_index is not None:
+        print("Writing and embedding documents with the ingestion pipeline.")
+        document_batches = yield_document_batches(
+            index_data_path, index_manifest, embed_title,
+            batch_size=10_000, num_read_workers=index_num_read_workers,
+            slice_indices=None if args.slice_index is None else [args.slice_index],
+        )
+        vector_document_store = build_document_store(
+            *get_postgresql_address(), *get_milvus_address(), index_name, index_type
+        )
+        run_ingestion_pipeline(
+            document_batches, document_store, vector_document_store, retriever, index_manifest,
+            queue_size=index_pipeline_queue_size, write_batch_size=index_write_batch_size,
+        )
+        if args.slice_index is None:
+            print("Embedding texts (if any) that were written but not embedded earlier.")
+            document_store.progress_bar = True
+            document_store.update_embeddings(
+                retriever, batch_size=10_000, update_existing_embeddings=False,
+            )
+        if embedding_cache is not None:
+            embedding_cache.print_stats()
+        if getattr(retriever, "token_cache", None) is not None:
+            retriever.token_cache.print_stats()
+        return
 
     for slice_index in range(index_num_chunks):
 
-        print(f"\n\nReading input documents slice {slice_index+1}/{index_num_chunks}.")
-        documents = []
-        document_store.progress_bar = False
-        for document in yield_jsonl_slice(
-            index_data_path, index_num_chunks, slice_index
-        ):
-            true_document_id = document["meta"].pop("id")
-            document["id"] = true_document_id[-100:] # o/w raises error. The true ID will be in the metadata.
-            document["meta"]["id_prefix"] = true_document_id.replace(document["id"], "")
-            assert true_document_id == document["meta"]["id_prefix"] + document["id"]
-            metadata = {}
-            field_names = ["id_prefix", "section_index", "document_type", "document_index", "document_sub_index"]
-            for key_name in field_names:
-                if key_name in document["meta"]:
-                    metadata[key_name] = document["meta"][key_name]
-            if embed_title:
-                assert "title" in document["meta"] or "name" in document["meta"], \
-                    "The title/name must be set in meta if embed_title is True."
-                title = document["meta"].get("title", document["meta"].get("name", None))
-                metadata["name"] = title
-                assert title is not None
-            document["meta"] = metadata
-            documents.append(document)
-
-        num_documents = len(documents)
-        print(f"Number of documents in this slice: {num_documents}")
-        print("Writing documents in MilvusDocumentStore.")
-        for i in progressbar(range(0, len(documents), 10)):
-            document_store.write_documents(documents[i:i + 10], duplicate_documents="skip")
+        if index_manifest.is_slice_embedded(slice_index):
+            print(f"\n\nSkipping slice {slice_index+1}/{index_num_chunks} as it's already embedded.")
+            continue
+
+        if index_manifest.is_slice_written(slice_index):
+            print(f"\n\nSlice {slice_index+1}/{index_num_chunks} is already written, only embedding it.")
+        else:
+            print(f"\n\nReading input documents slice {slice_index+1}/{index_num_chunks}.")
+            documents = []
+            document_store.progress_bar = False
+            for document in yield_jsonl_slice(
+                index_data_path, index_num_chunks, slice_index, num_workers=index_num_read_workers
+            ):
+                documents.append(normalize_document(document, embed_title))
+
+            num_documents = len(documents)
+            print(f"Number of documents in this slice: {num_documents}")
+            print(f"Writing documents in {type(document_store).__name__}.")
+            written_documents = bulk_write_documents(document_store, documents, batch_size=index_write_batch_size)
+            print(f"Number of new documents written: {len(written_documents)}")
+            index_manifest.update_slice(
+                slice_index,
+                status="written",
+                num_documents=num_documents,
+                num_written_documents=len(written_documents),
+                first_document_id=documents[0]["id"] if documents else None,
+                last_document_id=documents[-1]["id"] if documents else None,
+            )
+            del documents, written_documents
 
         print("Computing number of total documents in the index (with or without embeddings).")
         number_of_documents = document_store.get_document_count()
         print(f"It is: {number_of_documents}")
 
-        print("Embedding texts in MilvusDocumentStore using DPR retriever models.")
+        print(f"Embedding texts in {type(document_store).__name__} using DPR retriever models.")
         # The data will be stored in milvus server (just like es).
         document_store.progress_bar = True
         # There are 2 batch_sizes here. The one passed in update_embeddings is the top level
@@ -146,14 +539,23 @@ def main():
         # another batch size that's configured by the jsonnet config parameter, which is the batch size
         # for the forward of of the retriever model. There's is not much value in increasing update_embeddings
         # to more than 10K, it has not effect on the GPU memory usage.
+        # This resumes from where an interrupted run stopped, as the vector ids are updated in sql per batch.
         document_store.update_embeddings(
             retriever, batch_size=10_000, update_existing_embeddings=False,
         )
+        index_manifest.update_slice(slice_index, status="embedded")
+        if embedding_cache is not None:
+            embedding_cache.print_stats()
+        if getattr(retriever, "token_cache", None) is not None:
+            retriever.token_cache.print_stats()
         # This is very slow for some reason, so skipping it.
         # time.sleep(2) # needs some time to update num_entites
         # number_of_documents = document_store.get_embedding_count()
         # print(f"Number of total documents with embeddings so far: {number_of_documents}")
 
+    if index_type in LOCAL_INDEX_TYPES:
+        finish_local_index(document_store, nlist)
+
 
 if __name__ == "__main__":
     main()
@@ -8,13 +8,20 @@ import argparse
 import time
 import shutil
 
+import faiss
 import _jsonnet
-from progressbar import progressbar
+from sqlalchemy import Integer, cast
 from haystack.nodes import DensePassageRetriever
 from haystack.document_stores import FAISSDocumentStore
+from haystack.document_stores.sql import DocumentORM
 
-from lib import yield_jsonl_slice, load_cwd_dotenv
+from lib import yield_jsonl_slice, load_cwd_dotenv, strip_compression_extension
+from dpr_lib import bulk_write_documents, get_autotuned_max_batch_tokens
 from haystack_monkeypatch import monkeypatch_retriever
+from onnx_dpr import use_onnx_encoders
+from embedding_cache import attach_passage_embedding_cache
+from token_cache import attach_passage_token_cache
+from index_manifest import IndexManifest
 
 
 
@@ -32,7 +39,7 @@ class FaissDocumentStoreManager:
         self.index_type = index_type
 
         data_name = os.path.splitext(
-            index_data_path
+            strip_compression_extension(index_data_path)
         )[0].replace("processed_datasets/", "").replace("processed_data/", "").replace("/", "__")
         index_name = "___".join([experiment_name, data_name])
         if len(index_name) >= 100:
@@ -51,6 +58,7 @@ class FaissDocumentStoreManager:
         self.index_sql_path = os.path.join(index_full_directory, "index.db")
         self.index_faiss_path = os.path.join(index_full_directory, "index.faiss")
         self.index_json_path = os.path.join(index_full_directory, "index.json")
+        self.index_manifest_directory = os.path.join(index_full_directory, "manifest")
 
         os.makedirs(index_full_directory, exist_ok=True)
 
@@ -67,20 +75,42 @@ class FaissDocumentStoreManager:
         )
 
         if index_exists:
-            document_store = FAISSDocumentStore(
-                sql_url="sqlite:///"+self.index_sql_path,
-                faiss_index_path=self.index_faiss_path,
-                faiss_config_path=self.index_json_path
-            )
+            # Not using faiss_index_path here, as that requires all documents in sql to have vectors
+            # which isn't the case if the last run was preempted after writing a slice but before saving.
+            with open(self.index_json_path) as file:
+                init_params = json.load(file)
+            faiss_index = faiss.read_index(self.index_faiss_path)
+            document_store = FAISSDocumentStore(**{
+                **init_params,
+                "faiss_index": faiss_index,
+                "embedding_dim": faiss_index.d,
+                "validate_index_sync": False,
+            })
         else:
             document_store = FAISSDocumentStore(
                 sql_url="sqlite:///"+self.index_sql_path,
-                faiss_index_factory_str=self.index_type
+                faiss_index_factory_str=self.index_type,
+                validate_index_sync=False,
             )
             assert document_store.faiss_index_factory_str == self.index_type
 
+        self._reset_unsaved_vector_ids(document_store)
         return document_store
 
+    def _reset_unsaved_vector_ids(self, document_store: FAISSDocumentStore):
+        # The vector ids are updated in sql as soon as the vectors are added in the (in-memory) faiss index.
+        # So if a run was preempted before saving, sql has vector ids that the saved faiss index doesn't.
+        # Reset them so that update_embeddings embeds those documents again.
+        num_saved_vectors = document_store.faiss_indexes[document_store.index].ntotal
+        num_reset_documents = document_store.session.query(DocumentORM).filter(
+            DocumentORM.index == document_store.index,
+            DocumentORM.vector_id.isnot(None),
+            cast(DocumentORM.vector_id, Integer) >= num_saved_vectors,
+        ).update({DocumentORM.vector_id: None}, synchronize_session=False)
+        document_store.session.commit()
+        if num_reset_documents:
+            print(f"Reset vector ids of {num_reset_documents} documents whose vectors weren't saved.")
+
     def save(self, document_store: FAISSDocumentStore):
         document_store.save(index_path=self.index_faiss_path, config_path=self.index_json_path)
 
@@ -105,6 +135,10 @@ def main():
 
     index_data_path = experiment_config.pop("index_data_path")
     index_num_chunks = experiment_config.pop("index_num_chunks", 1)
+    index_write_batch_size = experiment_config.pop("index_write_batch_size", 10_000)
+    # Reuses the passage embeddings across index types and document stores (same encoder and passages).
+    index_embedding_cache = experiment_config.pop("index_embedding_cache", False)
+    index_token_cache = experiment_config.pop("index_token_cache", False)
     index_type = experiment_config.pop("index_type")
     # For "IVFx,Flat" [x = 10 * sqrt (num_docs)]
     assert index_type in ("Flat", "HNSW") or bool(re.match(r'IVF\d+,Flat', index_type))
@@ -118,10 +152,25 @@ def main():
     print("Loading or building Document Store (Index)")
     document_store = document_store_manager.load(delete_if_exists=args.delete_if_exists)
 
+    index_manifest = IndexManifest(
+        document_store_manager.index_manifest_directory, document_store_manager.index_name,
+        index_data_path, index_num_chunks,
+    ).load_or_create()
+    index_manifest.print_summary()
+
     print("Loading DPR retriever models.")
     serialization_dir = os.path.join("serialization_dir", args.experiment_name)
     dont_train = experiment_config.pop("dont_train", False)
     batch_size = experiment_config.pop("index_batch_size", 5120) # use 4X48Gs.
+    length_bucketed_encoding = experiment_config.pop("length_bucketed_encoding", False)
+    fast_tokenization = experiment_config.pop("fast_tokenization", False)
+    tokenization_chunk_size = experiment_config.pop("tokenization_chunk_size", None)
+    embedding_dtype = experiment_config.pop("embedding_dtype", "float32")
+    embedding_memmap_directory = experiment_config.pop("embedding_memmap_directory", None)
+    encoder_backend = experiment_config.pop("encoder_backend", "torch")
+    max_batch_tokens = experiment_config.pop("index_max_batch_tokens", None)
+    if max_batch_tokens is None:
+        max_batch_tokens = get_autotuned_max_batch_tokens(args.experiment_name, "passage")
     if dont_train:
         query_model = experiment_config["query_model"]
         passage_model = experiment_config["passage_model"]
@@ -142,10 +191,28 @@ def main():
             max_seq_len_passage=440,
             batch_size=batch_size,
         )
-    monkeypatch_retriever(retriever)
+    monkeypatch_retriever(
+        retriever,
+        length_bucketed_encoding=length_bucketed_encoding,
+        max_batch_tokens=max_batch_tokens,
+        fast_tokenization=fast_tokenization,
+        tokenization_chunk_size=tokenization_chunk_size,
+        embedding_dtype=embedding_dtype,
+        embedding_memmap_directory=embedding_memmap_directory,
+    )
+    use_onnx_encoders(retriever, args.experiment_name, encoder_backend)
+    if index_token_cache:
+        attach_passage_token_cache(retriever, index_data_path)
+    embedding_cache = None
+    if index_embedding_cache:
+        embedding_cache = attach_passage_embedding_cache(retriever)
 
     for slice_index in range(index_num_chunks):
 
+        if index_manifest.is_slice_embedded(slice_index):
+            print(f"\n\nSkipping slice {slice_index+1}/{index_num_chunks} as it's already embedded and saved.")
+            continue
+
         print(f"\n\nReading input documents slice {slice_index+1}/{index_num_chunks}.")
         documents = []
         document_store.progress_bar = False
@@ -169,8 +236,17 @@ def main():
         num_documents = len(documents)
         print(f"Number of documents in this slice: {num_documents}")
         print("Writing documents in FaissDocumentStore.")
-        for i in progressbar(range(0, len(documents), 10)):
-            document_store.write_documents(documents[i:i + 10], duplicate_documents="skip")
+        written_documents = bulk_write_documents(document_store, documents, batch_size=index_write_batch_size)
+        print(f"Number of new documents written: {len(written_documents)}")
+        index_manifest.update_slice(
+            slice_index,
+            status="written",
+            num_documents=num_documents,
+            num_written_documents=len(written_documents),
+            first_document_id=documents[0]["id"] if documents else None,
+            last_document_id=documents[-1]["id"] if documents else None,
+        )
+        del documents, written_documents
 
         number_of_documents = document_store.get_document_count()
         print(f"Number of total documents with or without embeddings so far: {number_of_documents}")
@@ -190,9 +266,12 @@ def main():
         time.sleep(2) # needs some time to update num_entites
         number_of_documents = document_store.get_embedding_count()
         print(f"Number of total documents with embeddings so far: {number_of_documents}")
+        if embedding_cache is not None:
+            embedding_cache.print_stats()
 
         print("Saving work (checkpoint) so far.")
         document_store_manager.save(document_store)
+        index_manifest.update_slice(slice_index, status="embedded")
 
 
 if __name__ == "__main__":
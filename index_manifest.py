@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import threading
+from typing import Dict, List
+
+from lib import load_jsonl_index
+
+
+def get_index_manifest_directory(experiment_name: str, index_name: str) -> str:
+    # It needs to be on a durable (and writable) file system to survive preemptions. On beaker,
+    # serialization_dir is a read-only mount, so set INDEX_MANIFEST_DIRECTORY in the .env.
+    manifests_directory = os.environ.get(
+        "INDEX_MANIFEST_DIRECTORY", os.path.join("serialization_dir", experiment_name, "index_manifests")
+    )
+    return os.path.join(manifests_directory, index_name)
+
+
+def _write_json_atomically(instance: Dict, file_path: str):
+    temp_file_path = file_path + f".tmp{os.getpid()}.{threading.get_ident()}"
+    with open(temp_file_path, "w") as file:
+        json.dump(instance, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file_path, file_path)
+
+
+class IndexManifest:
+    """
+    Durable record of the indexing progress: which slices of the index data are written in the
+    document store, which are embedded, and how far the embedding of the current ones has got.
+    It's a directory with a header (what is being indexed) and a file per slice, so workers owning
+    different slices never write the same file. Each write is atomic (temp file + rename).
+
+    Slice status is "pending" -> "written" (all its documents are in sql) -> "embedded" (all its
+    documents have vectors).
+    """
+
+    def __init__(self, directory: str, index_name: str, index_data_path: str, num_slices: int) -> None:
+        self.directory = directory
+        self.index_name = index_name
+        self.index_data_path = index_data_path
+        self.num_slices = num_slices
+        self._lock = threading.Lock()
+        self._slices: Dict[int, Dict] = {}
+
+    @property
+    def _header_file_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def _slice_file_path(self, slice_index: int) -> str:
+        return os.path.join(self.directory, "slices", f"slice_{str(slice_index).zfill(5)}.json")
+
+    def _make_header(self) -> Dict:
+        return {
+            "index_name": self.index_name,
+            "index_data_path": self.index_data_path,
+            "index_data_num_lines": load_jsonl_index(self.index_data_path)["num_lines"],
+            "num_slices": self.num_slices,
+        }
+
+    def load_or_create(self) -> "IndexManifest":
+        header = self._make_header()
+        if os.path.exists(self._header_file_path):
+            with open(self._header_file_path) as file:
+                existing_header = json.load(file)
+            if existing_header != header:
+                raise Exception(
+                    f"The index manifest in {self.directory} was made for a different indexing setup:\n"
+                    f"{json.dumps(existing_header, indent=4)}\nbut now it is:\n{json.dumps(header, indent=4)}\n"
+                    "Pass --delete_if_exists to start the index from scratch."
+                )
+        else:
+            os.makedirs(os.path.join(self.directory, "slices"), exist_ok=True)
+            _write_json_atomically(header, self._header_file_path)
+        self.reload()
+        return self
+
+    def reload(self):
+        # Other workers may have updated their slices.
+        with self._lock:
+            for slice_index in range(self.num_slices):
+                file_path = self._slice_file_path(slice_index)
+                if os.path.exists(file_path):
+                    with open(file_path) as file:
+                        self._slices[slice_index] = json.load(file)
+                else:
+                    self._slices[slice_index] = {"slice_index": slice_index, "status": "pending"}
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self._slices = {}
+
+    def get_slice(self, slice_index: int) -> Dict:
+        with self._lock:
+            return dict(self._slices[slice_index])
+
+    def update_slice(self, slice_index: int, **fields):
+        with self._lock:
+            self._slices[slice_index].update(fields)
+            _write_json_atomically(self._slices[slice_index], self._slice_file_path(slice_index))
+
+    def increment_slice(self, slice_index: int, field_name: str, value: int):
+        with self._lock:
+            self._slices[slice_index][field_name] = self._slices[slice_index].get(field_name, 0) + value
+            _write_json_atomically(self._slices[slice_index], self._slice_file_path(slice_index))
+
+    def is_slice_written(self, slice_index: int) -> bool:
+        return self.get_slice(slice_index)["status"] in ("written", "embedded")
+
+    def is_slice_embedded(self, slice_index: int) -> bool:
+        return self.get_slice(slice_index)["status"] == "embedded"
+
+    def get_embedded_slice_indices(self) -> List[int]:
+        return [
+            slice_index for slice_index in range(self.num_slices) if self.is_slice_embedded(slice_index)
+        ]
+
+    def get_num_written_documents(self) -> int:
+        return sum(
+            self.get_slice(slice_index).get("num_written_documents", 0) for slice_index in range(self.num_slices)
+        )
+
+    def print_summary(self):
+        statuses = [self.get_slice(slice_index)["status"] for slice_index in range(self.num_slices)]
+        print(
+            f"Index manifest ({self.directory}): "
+            f"{statuses.count('embedded')} embedded, {statuses.count('written')} written (not embedded) "
+            f"and {statuses.count('pending')} pending slices out of {self.num_slices}."
+        )
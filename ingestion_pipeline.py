@@ -0,0 +1,165 @@
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+
+_END_OF_STREAM = object()
+
+
+class PipelineStageStats:
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.num_items = 0
+        self.num_units = 0
+        self.busy_seconds = 0.0
+        self.waiting_seconds = 0.0 # waiting for the previous stage (starved) or next stage (backpressure).
+
+    def as_dict(self, wall_seconds: float) -> Dict:
+        return {
+            "stage": self.name,
+            "items": self.num_items,
+            "units": self.num_units,
+            "busy_seconds": round(self.busy_seconds, 2),
+            "waiting_seconds": round(self.waiting_seconds, 2),
+            "units_per_busy_second": round(self.num_units / self.busy_seconds, 2) if self.busy_seconds else None,
+            "utilization": round(self.busy_seconds / wall_seconds, 3) if wall_seconds else None,
+        }
+
+
+class IngestionPipeline:
+    """
+    Runs the source and each stage in its own thread, connected by bounded queues. A stage takes an
+    item from its input queue, processes it and puts the result (unless it's None) in its output queue.
+    As the queues are bounded, a fast stage blocks once it's queue_size items ahead of the next one
+    (backpressure). So the throughput is that of the slowest stage rather than the sum of all stages.
+    Threads are enough here as the stages mostly wait on the databases or the (GIL-releasing) encoder.
+    """
+
+    def __init__(
+        self,
+        stages: List[Tuple[str, Callable[[Any], Any]]],
+        queue_size: int = 2,
+        get_item_size: Callable[[Any], int] = len,
+    ) -> None:
+        self.stages = stages
+        self.queue_size = queue_size
+        self.get_item_size = get_item_size
+        self.stats: List[PipelineStageStats] = []
+        self.wall_seconds = 0.0
+        self._stop_event = threading.Event()
+        self._exceptions: List[BaseException] = []
+
+    def _put(self, queue_: queue.Queue, item: Any) -> bool:
+        while not self._stop_event.is_set():
+            try:
+                queue_.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, queue_: queue.Queue) -> Any:
+        while not self._stop_event.is_set():
+            try:
+                return queue_.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM
+
+    def _run_source(self, source: Iterable, output_queue: queue.Queue, stats: PipelineStageStats):
+        try:
+            iterator = iter(source)
+            while True:
+                start_time = time.perf_counter()
+                item = next(iterator, _END_OF_STREAM)
+                stats.busy_seconds += time.perf_counter() - start_time
+                if item is _END_OF_STREAM:
+                    break
+                stats.num_items += 1
+                stats.num_units += self.get_item_size(item)
+                start_time = time.perf_counter()
+                if not self._put(output_queue, item):
+                    return
+                stats.waiting_seconds += time.perf_counter() - start_time
+        except BaseException as exception:
+            self._exceptions.append(exception)
+            self._stop_event.set()
+        finally:
+            self._put(output_queue, _END_OF_STREAM)
+
+    def _run_stage(
+        self,
+        function: Callable[[Any], Any],
+        input_queue: queue.Queue,
+        output_queue: queue.Queue,
+        stats: PipelineStageStats,
+    ):
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = self._get(input_queue)
+                stats.waiting_seconds += time.perf_counter() - start_time
+                if item is _END_OF_STREAM:
+                    break
+                start_time = time.perf_counter()
+                item = function(item)
+                stats.busy_seconds += time.perf_counter() - start_time
+                if item is None:
+                    continue
+                stats.num_items += 1
+                stats.num_units += self.get_item_size(item)
+                start_time = time.perf_counter()
+                if not self._put(output_queue, item):
+                    return
+                stats.waiting_seconds += time.perf_counter() - start_time
+        except BaseException as exception:
+            self._exceptions.append(exception)
+            self._stop_event.set()
+        finally:
+            self._put(output_queue, _END_OF_STREAM)
+
+    def run(self, source: Iterable, source_name: str = "source") -> List[Dict]:
+        self.stats = [PipelineStageStats(source_name)] + [PipelineStageStats(name) for name, _ in self.stages]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [
+            threading.Thread(
+                target=self._run_source, args=(source, queues[0], self.stats[0]), name=source_name, daemon=True
+            )
+        ]
+        for index, (name, function) in enumerate(self.stages):
+            threads.append(threading.Thread(
+                target=self._run_stage, args=(function, queues[index], queues[index+1], self.stats[index+1]),
+                name=name, daemon=True,
+            ))
+
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        # The last queue is drained here, so that the last stage is never blocked.
+        while self._get(queues[-1]) is not _END_OF_STREAM:
+            pass
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - start_time
+
+        if self._exceptions:
+            raise self._exceptions[0]
+        return [stats.as_dict(self.wall_seconds) for stats in self.stats]
+
+    def print_report(self):
+        print(f"\nIngestion pipeline finished in {self.wall_seconds:.2f} seconds.")
+        print(
+            f"{'stage':>12} {'items':>8} {'units':>10} {'busy(s)':>10} "
+            f"{'waiting(s)':>11} {'units/busy-s':>13} {'utilization':>12}"
+        )
+        for stats in self.stats:
+            stats_dict = stats.as_dict(self.wall_seconds)
+            print(
+                f"{stats_dict['stage']:>12} {stats_dict['items']:>8} {stats_dict['units']:>10} "
+                f"{stats_dict['busy_seconds']:>10} {stats_dict['waiting_seconds']:>11} "
+                f"{str(stats_dict['units_per_busy_second']):>13} {str(stats_dict['utilization']):>12}"
+            )
+        slowest = max(self.stats, key=lambda stats: stats.busy_seconds)
+        print(f"The bottleneck stage is: {slowest.name}")
@@ -1,8 +1,17 @@
 import os
+import bz2
+import gzip
 import json
+import lzma
 import math
-from typing import Dict, List, Union, Any
-from functools import lru_cache
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Callable, Dict, Iterable, List, Tuple, Union, Any
+from functools import lru_cache, partial
 
 
 def read_json(file_path: str) -> Union[List, Dict]:
@@ -11,10 +20,8 @@ def read_json(file_path: str) -> Union[List, Dict]:
     return data
 
 
-def read_jsonl(file_path: str) -> List[Dict]:
-    with open(file_path, "r") as file:
-        instances = [json.loads(line.strip()) for line in file.readlines() if line.strip()]
-    return instances
+def read_jsonl(file_path: str, num_workers: int = 1, json_backend: str = None) -> List[Dict]:
+    return list(_yield_jsonl_instances(file_path, num_workers, json_backend))
 
 
 def write_json(instance: Dict, file_path: str):
@@ -23,55 +30,393 @@ def write_json(instance: Dict, file_path: str):
         json.dump(instance, file, indent=4)
 
 
-def write_jsonl(instances: List[Dict], file_path: str):
+def write_jsonl(instances: List[Dict], file_path: str, block_num_lines: int = 10_000):
     print(f"Writing {len(instances)} instances in {file_path}")
-    with open(file_path, "w") as file:
-        for instance in instances:
-            file.write(json.dumps(instance)+"\n")
+    lines = ((json.dumps(instance)+"\n").encode("utf-8") for instance in instances)
+    write_lines(lines, file_path, block_num_lines=block_num_lines)
+
+
+def write_lines(lines: Iterable[bytes], file_path: str, block_num_lines: int = 10_000):
+    # Compressed files are written as a concatenation of independently compressed blocks
+    # (gzip members / bz2 and xz streams). It's still a valid file for the standard tools,
+    # but it allows the line index to seek to a block instead of decompressing from the start.
+    compression = get_file_compression(file_path)
+    with open(file_path, "wb") as file:
+        if compression is None:
+            file.writelines(lines)
+            return
+        compress = _COMPRESS_FUNCTIONS[compression]
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) >= block_num_lines:
+                file.write(compress(b"".join(block)))
+                block = []
+        if block:
+            file.write(compress(b"".join(block)))
+
+
+def get_file_compression(file_path: str) -> str:
+    for extension, compression in _EXTENSION_TO_COMPRESSION.items():
+        if file_path.endswith(extension):
+            return compression
+    return None
+
+
+def strip_compression_extension(file_path: str) -> str:
+    compression = get_file_compression(file_path)
+    if compression is None:
+        return file_path
+    return os.path.splitext(file_path)[0]
+
+
+def open_maybe_compressed(file_path: str, mode: str = "rb") -> IO:
+    compression = get_file_compression(file_path)
+    if compression is None:
+        return open(file_path, mode)
+    return _COMPRESSED_FILE_OPENERS[compression](file_path, mode)
+
+
+_EXTENSION_TO_COMPRESSION = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+_COMPRESSED_FILE_OPENERS = {"gzip": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+_COMPRESSED_FILE_CLASSES = {
+    "gzip": lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode="rb"),
+    "bz2": bz2.BZ2File,
+    "xz": lzma.LZMAFile,
+}
+_COMPRESS_FUNCTIONS = {
+    "gzip": partial(gzip.compress, compresslevel=6),
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+}
+_DECOMPRESSOR_CLASSES = {
+    "gzip": partial(zlib.decompressobj, wbits=31),
+    "bz2": bz2.BZ2Decompressor,
+    "xz": lzma.LZMADecompressor,
+}
+
+
+def yield_jsonl(file_path: str, size: int, num_workers: int = 1, json_backend: str = None):
+    print(f"Yielding {size} instances from {file_path}")
+    instances = []
+    for instance in _yield_jsonl_instances(file_path, num_workers, json_backend):
+        instances.append(instance)
+        if len(instances) >= size:
+            yield instances
+            instances = []
+    yield instances
 
 
-def yield_jsonl(file_path: str, size: int):
-    print(f"Yielding {size} instances from {file_path}")
-    with open(file_path, "r") as file:
-        instances = []
+def _yield_jsonl_instances(file_path: str, num_workers: int = 1, json_backend: str = None):
+    if num_workers > 1:
+        yield from yield_jsonl_parallel(file_path, num_workers=num_workers, json_backend=json_backend)
+        return
+    json_loads = get_json_loads(json_backend)
+    with open_maybe_compressed(file_path) as file:
         for line in file:
-            if not line.strip():
-                continue
-            instances.append(json.loads(line.strip()))
-            if len(instances) >= size:
-                yield instances
-                instances = []
-    yield instances
+            if line.strip():
+                yield json_loads(line)
+
+
+def get_json_loads(json_backend: str = None) -> Callable:
+    # orjson is an optional (faster) backend, and only used when asked for: unlike json, it reads integers
+    # beyond 64 bits as floats and fails on the NaN that write_jsonl (json.dumps) can write.
+    assert json_backend in (None, "json", "orjson"), f"Unknown json_backend {json_backend}"
+    if json_backend == "orjson":
+        import orjson
+        return orjson.loads
+    return json.loads
+
+
+def _parse_jsonl_line_range(
+    file_path: str, start_line_index: int, end_line_index: int, json_backend: str = None
+) -> List[Dict]:
+    json_loads = get_json_loads(json_backend)
+    with open_jsonl_at_line(file_path, start_line_index) as file:
+        lines = [file.readline() for _ in range(start_line_index, end_line_index)]
+    return [json_loads(line) for line in lines if line.strip()]
+
+
+def yield_jsonl_parallel(
+    file_path: str,
+    num_workers: int = None,
+    start_line_index: int = 0,
+    end_line_index: int = None,
+    chunk_num_bytes: int = 16 * 1024 * 1024,
+    json_backend: str = None,
+):
+    """
+    Parses the jsonl lines [start_line_index, end_line_index) in a process pool and yields them
+    in the original order. The lines are split into ranges of ~chunk_num_bytes (of the file on disk)
+    at the seek points of the line index, and at most 2 ranges/worker are in flight at any point,
+    so the memory usage is bounded irrespective of the file size. For compressed files, the seek
+    points are at the block boundaries, so the decompression is also parallelized.
+    """
+    num_workers = num_workers or os.cpu_count()
+    jsonl_index = load_jsonl_index(file_path)
+    end_line_index = jsonl_index["num_lines"] if end_line_index is None else end_line_index
+    if jsonl_index["compression"] is None:
+        point_line_indices, point_offsets = range(len(jsonl_index["line_offsets"])), jsonl_index["line_offsets"]
+    else:
+        point_line_indices, point_offsets = jsonl_index["point_line_indices"], jsonl_index["point_offsets"]
+
+    line_ranges = []
+    while start_line_index < end_line_index:
+        start_point_index = max(bisect_right(point_line_indices, start_line_index) - 1, 0)
+        # first seek point at or after the target offset.
+        point_index = bisect_left(point_offsets, point_offsets[start_point_index] + chunk_num_bytes)
+        point_index = max(point_index, start_point_index + 1)
+        if point_index < len(point_line_indices):
+            range_end_line_index = min(max(point_line_indices[point_index], start_line_index + 1), end_line_index)
+        else:
+            range_end_line_index = end_line_index
+        line_ranges.append((start_line_index, range_end_line_index))
+        start_line_index = range_end_line_index
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = deque()
+        for range_start_line_index, range_end_line_index in line_ranges:
+            futures.append(executor.submit(
+                _parse_jsonl_line_range, file_path, range_start_line_index, range_end_line_index, json_backend
+            ))
+            if len(futures) >= 2*num_workers:
+                yield from futures.popleft().result()
+        while futures:
+            yield from futures.popleft().result()
+
+
+def _get_jsonl_index_file_paths(file_path: str) -> List[str]:
+    # The sidecar index is kept next to the data file if possible. Data mounts (e.g. on beaker)
+    # are read-only, so fallback to a cache directory keyed by the absolute path of the file.
+    index_directory = os.environ.get(
+        "JSONL_INDEX_DIRECTORY", os.path.join(os.path.expanduser("~"), ".cache", "haystack_wrapper", "jsonl_indices")
+    )
+    index_file_name = "__".join([
+        string_to_hash(os.path.abspath(file_path))[:10], os.path.basename(file_path) + ".idx"
+    ])
+    return [file_path + ".idx", os.path.join(index_directory, index_file_name)]
+
+
+def _build_jsonl_index(file_path: str) -> Dict:
+    from tqdm import tqdm
+    print(f"Building line offsets index for {file_path}")
+    compression = get_file_compression(file_path)
+    if compression is not None:
+        return _build_compressed_jsonl_index(file_path, compression)
+    line_offsets = array("q")
+    num_records = 0
+    offset = 0
+    with open(file_path, "rb") as file:
+        for line in tqdm(file):
+            line_offsets.append(offset)
+            offset += len(line)
+            if line.strip():
+                num_records += 1
+    line_offsets.append(offset) # so that the end of the last line is also known.
+    return {
+        "num_lines": len(line_offsets) - 1,
+        "num_records": num_records,
+        "compression": None,
+        "line_offsets": line_offsets,
+    }
+
+
+def _build_compressed_jsonl_index(file_path: str, compression: str) -> Dict:
+    # There can't be an offset for every line in a compressed file. Instead, there is a seek point
+    # for every compressed block (gzip member / bz2 or xz stream): the compressed offset at which the
+    # block starts, the index of the first line that starts in it, and the number of decompressed bytes
+    # in the block before that line. Files with a single block (e.g. made by gzip cli) will have only
+    # one seek point, so they'll be read from the start. Use write_jsonl (or compress_jsonl.py) to make
+    # the block-compressed ones.
+    from tqdm import tqdm
+    point_line_indices, point_offsets, point_skip_bytes = array("q"), array("q"), array("q")
+    num_lines = num_records = 0
+    partial_line = b"" # decompressed bytes of the line that hasn't ended yet.
+    block_offset = data_offset = 0 # compressed offsets of the current block and the current data.
+    block_num_bytes = 0 # decompressed bytes seen so far in the current block.
+    block_has_point = False
+    decompressor = _DECOMPRESSOR_CLASSES[compression]()
+    data = b""
+    with open(file_path, "rb") as file, tqdm(unit="B", unit_scale=True) as progress_bar:
+        while True:
+            if not data:
+                data = file.read(1024 * 1024)
+                progress_bar.update(len(data))
+                if not data:
+                    break
+
+            output = decompressor.decompress(data)
+            if not block_has_point and not block_num_bytes and not partial_line:
+                point_line_indices.append(num_lines)
+                point_offsets.append(block_offset)
+                point_skip_bytes.append(0)
+                block_has_point = True
+            if not block_has_point and b"\n" in output: # the first line starting in this block.
+                point_line_indices.append(num_lines + 1)
+                point_offsets.append(block_offset)
+                point_skip_bytes.append(block_num_bytes + output.index(b"\n") + 1)
+                block_has_point = True
+
+            lines = (partial_line + output).split(b"\n")
+            partial_line = lines.pop()
+            num_lines += len(lines)
+            num_records += sum(1 for line in lines if line.strip())
+            block_num_bytes += len(output)
+
+            if decompressor.eof: # start of the next block.
+                block_offset = data_offset = data_offset + len(data) - len(decompressor.unused_data)
+                data = decompressor.unused_data
+                decompressor = _DECOMPRESSOR_CLASSES[compression]()
+                block_num_bytes = 0
+                block_has_point = False
+            else:
+                data_offset += len(data)
+                data = b""
+
+    if partial_line:
+        num_lines += 1
+        num_records += int(bool(partial_line.strip()))
+    return {
+        "num_lines": num_lines,
+        "num_records": num_records,
+        "compression": compression,
+        "point_line_indices": point_line_indices,
+        "point_offsets": point_offsets,
+        "point_skip_bytes": point_skip_bytes,
+    }
+
+
+def _read_jsonl_index(index_file_path: str, file_size: int, file_mtime: int) -> Dict:
+    with open(index_file_path, "rb") as file:
+        header = json.loads(file.readline())
+        if header["file_size"] != file_size or header["file_mtime"] != file_mtime:
+            return None
+        payload = array("q")
+        payload.frombytes(file.read())
+    jsonl_index = {
+        "num_lines": header["num_lines"],
+        "num_records": header["num_records"],
+        "compression": header.get("compression"),
+    }
+    if jsonl_index["compression"] is None:
+        assert len(payload) == header["num_lines"] + 1, f"Corrupted jsonl index {index_file_path}"
+        jsonl_index["line_offsets"] = payload
+    else:
+        num_points = len(payload) // 3
+        jsonl_index["point_line_indices"] = payload[:num_points]
+        jsonl_index["point_offsets"] = payload[num_points:2*num_points]
+        jsonl_index["point_skip_bytes"] = payload[2*num_points:]
+    return jsonl_index
+
+
+def _write_jsonl_index(jsonl_index: Dict, index_file_path: str, file_size: int, file_mtime: int):
+    header = {
+        "file_size": file_size,
+        "file_mtime": file_mtime,
+        "num_lines": jsonl_index["num_lines"],
+        "num_records": jsonl_index["num_records"],
+        "compression": jsonl_index["compression"],
+    }
+    if jsonl_index["compression"] is None:
+        payload = jsonl_index["line_offsets"]
+    else:
+        payload = jsonl_index["point_line_indices"] + jsonl_index["point_offsets"] + jsonl_index["point_skip_bytes"]
+    os.makedirs(os.path.dirname(os.path.abspath(index_file_path)), exist_ok=True)
+    temp_index_file_path = index_file_path + f".tmp{os.getpid()}"
+    with open(temp_index_file_path, "wb") as file:
+        file.write((json.dumps(header) + "\n").encode("utf-8"))
+        file.write(payload.tobytes())
+    os.replace(temp_index_file_path, index_file_path) # atomic, so concurrent readers never see a partial index.
 
 
 @lru_cache(maxsize=None)
+def _load_jsonl_index(file_path: str, file_size: int, file_mtime: int) -> Dict:
+    index_file_paths = _get_jsonl_index_file_paths(file_path)
+    for index_file_path in index_file_paths:
+        if os.path.exists(index_file_path):
+            jsonl_index = _read_jsonl_index(index_file_path, file_size, file_mtime)
+            if jsonl_index is not None:
+                return jsonl_index
+
+    jsonl_index = _build_jsonl_index(file_path)
+    for index_file_path in index_file_paths:
+        try:
+            _write_jsonl_index(jsonl_index, index_file_path, file_size, file_mtime)
+            print(f"Saved line offsets index in {index_file_path}")
+            break
+        except OSError:
+            continue
+    else:
+        print(f"WARNING: Couldn't save the line offsets index for {file_path} anywhere.")
+    return jsonl_index
+
+
+def load_jsonl_index(file_path: str) -> Dict:
+    """
+    Returns {"num_lines", "num_records", "compression", ...} for the (maybe compressed) jsonl file.
+    For plain files, line_offsets[i] is the byte offset at which i-th line starts. For compressed files,
+    there are seek points at block boundaries instead (see _build_compressed_jsonl_index). It's read
+    from a sidecar index file if one exists and matches the file size and mtime, o/w it's built in one
+    pass and saved for the next time.
+    """
+    file_stat = os.stat(file_path)
+    return _load_jsonl_index(os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+
+
+@contextmanager
+def open_jsonl_at_line(file_path: str, line_index: int) -> IO:
+    """Opens the (maybe compressed) jsonl file in binary mode, positioned at the start of the given line."""
+    jsonl_index = load_jsonl_index(file_path)
+    assert 0 <= line_index <= jsonl_index["num_lines"]
+    if jsonl_index["compression"] is None:
+        with open(file_path, "rb") as file:
+            file.seek(jsonl_index["line_offsets"][line_index])
+            yield file
+        return
+    point_index = bisect_right(jsonl_index["point_line_indices"], line_index) - 1
+    with open(file_path, "rb") as raw_file:
+        raw_file.seek(jsonl_index["point_offsets"][point_index])
+        # this continues reading into the next blocks as needed.
+        with _COMPRESSED_FILE_CLASSES[jsonl_index["compression"]](raw_file) as file:
+            file.read(jsonl_index["point_skip_bytes"][point_index])
+            for _ in range(jsonl_index["point_line_indices"][point_index], line_index):
+                file.readline()
+            yield file
+
+
 def get_file_num_lines(file_path: str) -> int:
-    from tqdm import tqdm
-    print(f"Counting num lines in {file_path}")
-    with open(file_path) as file:
-        number_of_lines = sum(1 for i in tqdm(file))
-    return number_of_lines
+    return load_jsonl_index(file_path)["num_lines"]
 
 
-def yield_jsonl_slice(file_path: str, num_slices: int, slice_index: int) -> List[Dict]:
-    from tqdm import tqdm
-    # This is to avoid the excess memory requirement of reading the whole file first
-    # and then slicing it.
+def get_jsonl_slice_line_range(file_path: str, num_slices: int, slice_index: int) -> Tuple[int, int]:
     assert 0 <= slice_index <= num_slices-1
     number_of_lines = get_file_num_lines(file_path)
     part_length = math.ceil(number_of_lines / num_slices)
-    with open(file_path) as file:
-        for index, line in enumerate(tqdm(file)):
+    start_line_index = min(part_length*slice_index, number_of_lines)
+    end_line_index = min(part_length*(slice_index+1), number_of_lines)
+    return start_line_index, end_line_index
+
+
+def yield_jsonl_slice(
+    file_path: str, num_slices: int, slice_index: int, num_workers: int = 1, json_backend: str = None
+) -> List[Dict]:
+    from tqdm import tqdm
+    # This is to avoid the excess memory requirement of reading the whole file first
+    # and then slicing it. The line index allows seeking (close) to the start of the slice.
+    start_line_index, end_line_index = get_jsonl_slice_line_range(file_path, num_slices, slice_index)
+    if num_workers > 1:
+        yield from yield_jsonl_parallel(
+            file_path, num_workers=num_workers, json_backend=json_backend,
+            start_line_index=start_line_index, end_line_index=end_line_index,
+        )
+        return
+    json_loads = get_json_loads(json_backend)
+    with open_jsonl_at_line(file_path, start_line_index) as file:
+        for _ in tqdm(range(start_line_index, end_line_index)):
+            line = file.readline()
             if not line.strip():
                 continue
-            if index < part_length*slice_index:
-                continue
-            if index > part_length*(slice_index+1):
-                break
-            if (
-                (part_length*slice_index) <= index < part_length*(slice_index+1)
-            ):
-                yield json.loads(line.strip())
+            yield json_loads(line)
 
 
 def is_directory_empty(directory: str) -> bool:
@@ -135,6 +480,26 @@ def get_milvus_address():
     return milvus_host, milvus_port
 
 
+def get_latency_percentiles(latencies: List[float], percentiles: Tuple[int, ...] = (50, 95, 99)) -> Dict[str, float]:
+    # Nearest-rank percentiles, e.g. {"p50": ..., "p95": ..., "p99": ...}.
+    latencies = sorted(latencies)
+    if not latencies:
+        return {f"p{percentile}": 0.0 for percentile in percentiles}
+    return {
+        f"p{percentile}": latencies[max(math.ceil(percentile / 100 * len(latencies)) - 1, 0)]
+        for percentile in percentiles
+    }
+
+
+def format_latencies(latencies: List[float]) -> str:
+    # Of latencies in seconds.
+    percentile_latencies = get_latency_percentiles(latencies)
+    return ", ".join(
+        [f"{name}: {1000 * latency:.1f}ms" for name, latency in percentile_latencies.items()]
+        + [f"n: {len(latencies)}"]
+    )
+
+
 def load_cwd_dotenv():
     from dotenv import load_dotenv
     env_path = os.path.join(os.getcwd(), ".env")
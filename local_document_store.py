@@ -0,0 +1,664 @@
+import os
+import copy
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from tqdm.auto import tqdm
+from sqlalchemy import Integer, cast
+from haystack.schema import Document, FilterType
+from haystack.document_stores import SQLDocumentStore
+from haystack.document_stores.sql import DocumentORM
+from haystack.document_stores.base import get_batches_from_generator
+
+from vector_codecs import CODEC_NAMES, VectorCodec, get_codec, train_kmeans, assign_to_centroids
+
+
+LOCAL_INDEX_TYPES = ("NUMPY_FLAT", "NUMPY_IVF")
+
+
+def get_local_index_directory(index_name: str, index_type: str) -> str:
+    local_index_directory = os.environ.get("LOCAL_INDEX_DIRECTORY", "local_indexes")
+    return os.path.join(local_index_directory, "__".join([index_name.lower(), index_type.lower()]))
+
+
+class LocalDocumentStore(SQLDocumentStore):
+    """
+    A document store without servers, for the index_types in LOCAL_INDEX_TYPES: the documents are in
+    sqlite (like FAISSDocumentStore), and the embeddings are appended to a raw float32 matrix on disk,
+    where the vector id of a document is its row. The search memory-maps the matrix and goes over it
+    in blocks of rows (a matrix multiply and an argpartition top-k per block, merged into the running
+    top-k), so the corpus doesn't need to fit in memory. The block size is tuned for the machine on
+    the first search (see tune_block_size) and saved with the index.
+
+    NUMPY_IVF additionally clusters the embeddings into nlist inverted lists (see build_ivf), and a
+    search only scores the lists of the nprobe centroids nearest to each query, like milvus IVF_FLAT.
+    The embeddings added after build_ivf are searched exhaustively until it's run again.
+
+    With a codec other than float32 (see vector_codecs.py), the exhaustive search goes over the codes
+    written by build_codes and the inverted lists hold codes instead of embeddings, which is what
+    has to fit in memory. The top rerank_top_n candidates of the codes are then rescored with their
+    float32 embeddings, which are only read for those rows.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        index: str = "document",
+        embedding_dim: int = 768,
+        similarity: str = "dot_product",
+        progress_bar: bool = True,
+        index_type: str = "NUMPY_FLAT",
+        nprobe: int = 512,
+        codec: str = "float32",
+        rerank_top_n: int = 0,
+    ) -> None:
+        # Same as build_document_store, as that's what DPR is trained for.
+        assert similarity == "dot_product", "LocalDocumentStore only supports dot_product similarity."
+        self.similarity = similarity
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(
+            url="sqlite:///" + os.path.join(directory, "index.db"),
+            index=index,
+            duplicate_documents="skip",
+            check_same_thread=False, # the sql reads of retrieve_batch_records can be in threads.
+        )
+        self.directory = directory
+        self.embedding_dim = embedding_dim
+        self.progress_bar = progress_bar
+        # For the result cache (see result_cache.py), like the ones of MilvusDocumentStore.
+        assert index_type in LOCAL_INDEX_TYPES
+        self.index_type = index_type
+        self.metric_type = "IP"
+        self.nprobe = nprobe
+        self.search_param = {"nprobe": nprobe} if index_type == "NUMPY_IVF" else {}
+        assert codec in CODEC_NAMES
+        self.codec_name = codec
+        self.rerank_top_n = rerank_top_n
+        if codec != "float32":
+            self.search_param.update(codec=codec, rerank_top_n=rerank_top_n)
+        self.embeddings_path = os.path.join(directory, "embeddings.bin")
+        self.config_path = os.path.join(directory, "embeddings.json")
+        if os.path.exists(self.config_path):
+            with open(self.config_path) as file:
+                self.config = json.load(file)
+            assert self.config["embedding_dim"] == embedding_dim
+        else:
+            self.config = {"embedding_dim": embedding_dim, "dtype": "float32", "block_size": None}
+            self._save_config()
+        if not os.path.exists(self.embeddings_path):
+            open(self.embeddings_path, "wb").close()
+        self._truncate_partial_row()
+        self._reset_unsaved_vector_ids()
+        self._embeddings = None
+        self._block_size = None # tuned, but not saved as the index was too small.
+        self._ivf = None
+        self._codes = None
+        if index_type == "NUMPY_IVF" and self.config.get("ivf"):
+            self.search_param["nlist"] = self.config["ivf"]["nlist"]
+
+    def _save_config(self):
+        with open(self.config_path + ".tmp", "w") as file:
+            json.dump(self.config, file, indent=4)
+        os.replace(self.config_path + ".tmp", self.config_path)
+
+    @property
+    def _row_num_bytes(self) -> int:
+        return self.embedding_dim * np.dtype(self.config["dtype"]).itemsize
+
+    def get_embedding_count(self, index: Optional[str] = None, filters: Optional[FilterType] = None) -> int:
+        if filters:
+            raise NotImplementedError("LocalDocumentStore does not support filters.")
+        return os.path.getsize(self.embeddings_path) // self._row_num_bytes
+
+    def _truncate_partial_row(self):
+        # A run interrupted in the middle of an append.
+        num_bytes = self.get_embedding_count() * self._row_num_bytes
+        if os.path.getsize(self.embeddings_path) != num_bytes:
+            os.truncate(self.embeddings_path, num_bytes)
+
+    def _reset_unsaved_vector_ids(self):
+        # The embeddings are appended before the vector ids are updated in sql, so this can't happen
+        # unless the embeddings file was truncated or replaced, but it's cheap to check.
+        num_reset_documents = self.session.query(DocumentORM).filter(
+            DocumentORM.index == self.index,
+            DocumentORM.vector_id.isnot(None),
+            cast(DocumentORM.vector_id, Integer) >= self.get_embedding_count(),
+        ).update({DocumentORM.vector_id: None}, synchronize_session=False)
+        self.session.commit()
+        if num_reset_documents:
+            print(f"Reset vector ids of {num_reset_documents} documents whose embeddings weren't saved.")
+
+    def get_embeddings(self) -> np.ndarray:
+        num_embeddings = self.get_embedding_count()
+        if self._embeddings is None or len(self._embeddings) != num_embeddings:
+            if not num_embeddings:
+                return np.zeros((0, self.embedding_dim), dtype=self.config["dtype"])
+            self._embeddings = np.memmap(
+                self.embeddings_path, dtype=self.config["dtype"], mode="r", shape=(num_embeddings, self.embedding_dim)
+            )
+        return self._embeddings
+
+    def _append_embeddings(self, embeddings: np.ndarray):
+        assert embeddings.ndim == 2 and embeddings.shape[1] == self.embedding_dim
+        with open(self.embeddings_path, "ab") as file:
+            file.write(np.ascontiguousarray(embeddings, dtype=self.config["dtype"]).tobytes())
+
+    def _clear_embeddings(self):
+        # The rows of the ivf and the codes would belong to other documents, so they're dropped (first, in
+        # case of a crash), and the generation tells what's built for the embeddings written from now on.
+        self.config["generation"] = self.config.get("generation", 0) + 1
+        self.config.pop("ivf", None)
+        self.config.pop("codes", None)
+        self._save_config()
+        self._ivf = None
+        self._codes = None
+        self.search_param.pop("nlist", None)
+        os.truncate(self.embeddings_path, 0)
+        self._embeddings = None
+
+    def is_built_for_embeddings(self, built_config: Optional[Dict]) -> bool:
+        # Whether the ivf or the codes of the config were built for all the current embeddings.
+        return bool(built_config) and (
+            built_config.get("generation", 0) == self.config.get("generation", 0)
+            and built_config["num_embeddings"] == self.get_embedding_count()
+        )
+
+    def add_embeddings(self, embeddings: np.ndarray) -> List[str]:
+        # Appends the embeddings and returns their vector ids, for the caller to update_vector_ids.
+        vector_id = self.get_embedding_count()
+        self._append_embeddings(embeddings)
+        return [str(vector_id + index) for index in range(len(embeddings))]
+
+    def update_embeddings(
+        self,
+        retriever,
+        index: Optional[str] = None,
+        update_existing_embeddings: bool = True,
+        filters: Optional[FilterType] = None,
+        batch_size: int = 10_000,
+    ):
+        """
+        As FAISSDocumentStore.update_embeddings: embeds the documents (without embeddings, unless
+        update_existing_embeddings) in batches of batch_size, appending the embeddings to the matrix.
+        """
+        index = index or self.index
+        if update_existing_embeddings:
+            if filters is not None:
+                raise Exception("update_existing_embeddings=True is not supported with filters.")
+            self._clear_embeddings()
+            self.reset_vector_ids(index)
+
+        document_count = self.get_document_count(index=index, only_documents_without_embedding=True)
+        if document_count == 0:
+            return
+        vector_id = self.get_embedding_count()
+        result = self._query(
+            index=index, vector_ids=None, batch_size=batch_size, filters=filters,
+            only_documents_without_embedding=True,
+        )
+        with tqdm(
+            total=document_count, disable=not self.progress_bar, unit=" docs", desc="Updating Embedding"
+        ) as progress_bar:
+            for document_batch in get_batches_from_generator(result, batch_size):
+                embeddings = retriever.embed_documents(document_batch)
+                self._append_embeddings(embeddings)
+                vector_id_map = {}
+                for document in document_batch:
+                    vector_id_map[str(document.id)] = str(vector_id)
+                    vector_id += 1
+                self.update_vector_ids(vector_id_map, index=index)
+                progress_bar.update(len(document_batch))
+
+    def search_top_k(
+        self,
+        query_embs: np.ndarray,
+        top_k: int,
+        block_size: Optional[int] = None,
+        query_block_size: int = 1024,
+        ivf_query_block_size: int = 128,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (scores, rows), both (num_queries, top_k) and sorted by the score. If there are fewer
+        than top_k embeddings, the rest of the rows are -1.
+        """
+        query_embs = np.ascontiguousarray(query_embs, dtype=np.float32).reshape(-1, self.embedding_dim)
+        # The candidates to rescore, when the codes are searched instead of the embeddings.
+        num_candidates = max(top_k, self.rerank_top_n) if self.codec_name != "float32" else top_k
+        is_compressed = False
+        start_row = 0
+        top_scores = np.zeros((len(query_embs), 0), dtype=np.float32)
+        top_rows = np.zeros((len(query_embs), 0), dtype=np.int64)
+        if self.index_type == "NUMPY_IVF":
+            ivf = self._get_ivf()
+            if ivf is None:
+                print("WARNING: The IVF of the index isn't built (see build_ivf), so it's searched exhaustively.")
+            else:
+                # Smaller query blocks than the flat search, as the candidates are (queries, nprobe, top_k).
+                ivf_query_block_size = max(
+                    1, min(ivf_query_block_size, 2**24 // (min(self.nprobe, ivf["nlist"]) * num_candidates))
+                )
+                ivf_scores, ivf_rows = [], []
+                for query_start in range(0, len(query_embs), ivf_query_block_size):
+                    block_scores, block_rows = self._search_ivf_top_k(
+                        ivf, query_embs[query_start:query_start+ivf_query_block_size], num_candidates
+                    )
+                    ivf_scores.append(block_scores)
+                    ivf_rows.append(block_rows)
+                top_scores, top_rows = np.concatenate(ivf_scores), np.concatenate(ivf_rows)
+                start_row = ivf["num_embeddings"]
+                is_compressed = ivf["codec"].name != "float32"
+        elif self.codec_name != "float32":
+            codes = self._get_codes()
+            if codes is None:
+                print(f"WARNING: The {self.codec_name} codes of the index aren't built (see build_codes).")
+            else:
+                top_scores, top_rows = self._search_flat_top_k(
+                    query_embs, num_candidates, codes["codes"], codes["codec"], 0, block_size, query_block_size
+                )
+                start_row = codes["num_embeddings"]
+                is_compressed = True
+        if start_row < self.get_embedding_count():
+            flat_scores, flat_rows = self._search_flat_top_k(
+                query_embs, num_candidates, self.get_embeddings(), VectorCodec(self.embedding_dim), start_row,
+                block_size, query_block_size,
+            )
+            top_scores, top_rows = _merge_top_k([top_scores, flat_scores], [top_rows, flat_rows], num_candidates)
+        if is_compressed and self.rerank_top_n:
+            top_scores = self._rerank(query_embs, top_scores, top_rows)
+        if num_candidates > top_k:
+            top_scores, top_rows = _merge_top_k([top_scores], [top_rows], top_k)
+        return _sort_and_pad_top_k(top_scores, top_rows, top_k)
+
+    def _search_flat_top_k(
+        self,
+        query_embs: np.ndarray,
+        top_k: int,
+        vectors: np.ndarray,
+        codec: VectorCodec,
+        start_row: int,
+        block_size: Optional[int],
+        query_block_size: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # The top_k of vectors[start_row:] (embeddings or codes), whose indices are the rows.
+        block_size = block_size or self.config["block_size"] or self._block_size or self.tune_block_size()
+        top_scores = np.zeros((len(query_embs), 0), dtype=np.float32)
+        top_rows = np.zeros((len(query_embs), 0), dtype=np.int64)
+        for start in range(start_row, len(vectors), block_size):
+            # Reads each block from disk once, for all the queries.
+            block = np.asarray(vectors[start:start+block_size])
+            block_scores, block_rows = [], []
+            for query_start in range(0, len(query_embs), query_block_size):
+                scores = codec.score(query_embs[query_start:query_start+query_block_size], block)
+                rows = _argpartition_top_k(scores, top_k)
+                block_scores.append(np.take_along_axis(scores, rows, axis=1))
+                block_rows.append(rows + start)
+            top_scores, top_rows = _merge_top_k(
+                [top_scores, np.concatenate(block_scores)], [top_rows, np.concatenate(block_rows)], top_k
+            )
+        return top_scores, top_rows
+
+    def _rerank(
+        self, query_embs: np.ndarray, scores: np.ndarray, rows: np.ndarray, query_block_size: int = 32
+    ) -> np.ndarray:
+        # The float32 scores of the candidate rows, reading the embeddings of a block of queries at once.
+        embeddings = self.get_embeddings()
+        scores = scores.copy()
+        for query_start in range(0, len(query_embs), query_block_size):
+            block_rows = rows[query_start:query_start+query_block_size]
+            valid = block_rows != -1
+            unique_rows, inverse = np.unique(block_rows[valid], return_inverse=True)
+            exact_scores = (
+                query_embs[query_start:query_start+query_block_size]
+                @ np.asarray(embeddings[unique_rows], dtype=np.float32).T
+            )
+            scores[query_start:query_start+query_block_size][valid] = exact_scores[np.nonzero(valid)[0], inverse]
+        return scores
+
+    def _train_codec(self, sample_size: int, seed: int) -> VectorCodec:
+        codec = get_codec(self.codec_name, self.embedding_dim)
+        if codec.name in ("float32", "float16"): # nothing to train.
+            return codec
+        embeddings = self.get_embeddings()
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False))
+        print(f"Training the {codec.name} codec on {len(sample_rows)} embeddings.")
+        codec.train(np.asarray(embeddings[sample_rows], dtype=np.float32), rng=rng, progress_bar=self.progress_bar)
+        return codec
+
+    def _get_codes(self) -> Optional[Dict]:
+        if self.codec_name not in self.config.get("codes", {}):
+            return None
+        if self._codes is None:
+            path = os.path.join(self.directory, f"codes_{self.codec_name}.npy")
+            self._codes = {
+                **self.config["codes"][self.codec_name],
+                "codec": _load_codec(self.codec_name, self.embedding_dim, path[:-len(".npy")] + "_codec.npz"),
+                "codes": np.load(path, mmap_mode="r"),
+            }
+        return self._codes
+
+    def build_codes(self, sample_size: int = 65536, batch_size: int = 65536, seed: int = 0):
+        """
+        Trains the codec of the index on a sample of the embeddings and writes the codes of all the
+        embeddings (by row), which the exhaustive search then goes over instead of the embeddings.
+        """
+        if self.codec_name == "float32":
+            return
+        embeddings = self.get_embeddings()
+        num_embeddings = len(embeddings)
+        if not num_embeddings:
+            return
+        codec = self._train_codec(sample_size, seed)
+        path = os.path.join(self.directory, f"codes_{codec.name}.npy")
+        codec_path = path[:-len(".npy")] + "_codec.npz"
+        print(f"Writing the {codec.name} codes of {num_embeddings} embeddings.")
+        codes = np.lib.format.open_memmap(
+            path + ".tmp", mode="w+", dtype=codec.code_dtype, shape=(num_embeddings, codec.code_size)
+        )
+        for start in tqdm(range(0, num_embeddings, batch_size), disable=not self.progress_bar):
+            codes[start:start+batch_size] = codec.encode(embeddings[start:start+batch_size])
+        codes.flush()
+        del codes
+        _save_codec(codec, codec_path + ".tmp")
+        os.replace(codec_path + ".tmp", codec_path)
+        os.replace(path + ".tmp", path)
+        self.config.setdefault("codes", {})[codec.name] = {
+            "num_embeddings": num_embeddings, "generation": self.config.get("generation", 0)
+        }
+        self._save_config()
+        self._codes = None
+        print(
+            f"The {codec.name} codes take {num_embeddings * codec.num_bytes_per_vector / 1024**3:.2f} GB "
+            f"({codec.num_bytes_per_vector} bytes per embedding instead of {self._row_num_bytes})."
+        )
+
+    def _get_ivf(self) -> Optional[Dict]:
+        if not self.config.get("ivf"):
+            return None
+        if self._ivf is None:
+            self._ivf = {
+                **self.config["ivf"],
+                "centroids": np.load(os.path.join(self.directory, "ivf_centroids.npy")),
+                "offsets": np.load(os.path.join(self.directory, "ivf_offsets.npy")),
+                "rows": np.load(os.path.join(self.directory, "ivf_rows.npy"), mmap_mode="r"),
+                "embeddings": np.load(os.path.join(self.directory, "ivf_embeddings.npy"), mmap_mode="r"),
+                "codec": _load_codec(
+                    self.config["ivf"].get("codec", "float32"), self.embedding_dim,
+                    os.path.join(self.directory, "ivf_codec.npz"),
+                ),
+            }
+        return self._ivf
+
+    def _search_ivf_top_k(self, ivf: Dict, query_embs: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(self.nprobe, ivf["nlist"])
+        probed_lists = _argpartition_top_k(query_embs @ ivf["centroids"].T, nprobe) # (num_queries, nprobe)
+        candidate_scores = np.full((len(query_embs), nprobe, top_k), -np.inf, dtype=np.float32)
+        candidate_rows = np.full((len(query_embs), nprobe, top_k), -1, dtype=np.int64)
+        # Each probed list is read once and scored for all the queries that probe it.
+        query_indices, probe_indices = np.divmod(np.arange(probed_lists.size), nprobe)
+        lists = probed_lists.reshape(-1)
+        order = np.argsort(lists, kind="stable")
+        group_starts = np.flatnonzero(np.diff(lists[order], prepend=-1))
+        for group_start, group_end in zip(group_starts, np.append(group_starts[1:], len(order))):
+            pairs = order[group_start:group_end]
+            list_index = lists[pairs[0]]
+            start, end = ivf["offsets"][list_index], ivf["offsets"][list_index + 1]
+            if start == end:
+                continue
+            scores = ivf["codec"].score(query_embs[query_indices[pairs]], ivf["embeddings"][start:end])
+            columns = _argpartition_top_k(scores, top_k)
+            candidate_scores[query_indices[pairs], probe_indices[pairs], :columns.shape[1]] = (
+                np.take_along_axis(scores, columns, axis=1)
+            )
+            candidate_rows[query_indices[pairs], probe_indices[pairs], :columns.shape[1]] = (
+                np.asarray(ivf["rows"][start:end])[columns]
+            )
+        return _merge_top_k(
+            [candidate_scores.reshape(len(query_embs), -1)], [candidate_rows.reshape(len(query_embs), -1)], top_k
+        )
+
+    def build_ivf(
+        self,
+        nlist: int,
+        sample_size: Optional[int] = None,
+        batch_size: int = 65536,
+        num_iterations: int = 100,
+        chunk_size: int = 4096,
+        codec_sample_size: int = 65536,
+        seed: int = 0,
+    ):
+        """
+        Trains nlist centroids with mini-batch k-means on a sample of the embeddings (by default
+        64 per centroid), assigns all the embeddings to their nearest centroid, and writes the inverted
+        lists as contiguous arrays: the embeddings (encoded with the codec of the index) reordered by
+        list, their rows, and the list offsets. The matrix multiplies use all the cores (through BLAS),
+        in chunks of chunk_size embeddings.
+        """
+        embeddings = self.get_embeddings()
+        num_embeddings = len(embeddings)
+        if not num_embeddings:
+            return
+        if num_embeddings < 39 * nlist:
+            nlist = max(num_embeddings // 39, 1)
+            print(f"WARNING: There are too few embeddings for the nlist, so using nlist={nlist}.")
+        rng = np.random.default_rng(seed)
+        sample_size = min(sample_size or 64 * nlist, num_embeddings)
+        sample_rows = np.sort(rng.choice(num_embeddings, size=sample_size, replace=False))
+        sample = np.asarray(embeddings[sample_rows], dtype=np.float32)
+
+        print(f"Training {nlist} centroids on {sample_size} embeddings.")
+        centroids = train_kmeans(
+            sample, nlist, batch_size=batch_size, num_iterations=num_iterations, chunk_size=chunk_size, rng=rng,
+            progress_bar=self.progress_bar,
+        )
+        codec = self._train_codec(codec_sample_size, seed)
+
+        print(f"Assigning {num_embeddings} embeddings to the {nlist} lists.")
+        assignments = np.zeros(num_embeddings, dtype=np.int32)
+        for start in tqdm(range(0, num_embeddings, chunk_size), disable=not self.progress_bar):
+            block = np.asarray(embeddings[start:start+chunk_size], dtype=np.float32)
+            assignments[start:start+len(block)] = assign_to_centroids(block, centroids, chunk_size)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.int64)
+
+        print("Writing the inverted lists.")
+        ivf_paths = {
+            name: os.path.join(self.directory, f"ivf_{name}.npy")
+            for name in ("centroids", "offsets", "rows", "embeddings")
+        }
+        ivf_embeddings = np.lib.format.open_memmap(
+            ivf_paths["embeddings"] + ".tmp", mode="w+", dtype=codec.code_dtype, shape=(num_embeddings, codec.code_size)
+        )
+        ivf_rows = np.lib.format.open_memmap(
+            ivf_paths["rows"] + ".tmp", mode="w+", dtype=np.int64, shape=(num_embeddings,)
+        )
+        cursors = offsets[:-1].copy()
+        for start in range(0, num_embeddings, batch_size):
+            block_assignments = assignments[start:start+batch_size]
+            order = np.argsort(block_assignments, kind="stable")
+            sorted_assignments = block_assignments[order]
+            # The position of each embedding within its list is the next free one of the list.
+            first_in_list = np.searchsorted(sorted_assignments, sorted_assignments)
+            positions = cursors[sorted_assignments] + np.arange(len(order)) - first_in_list
+            ivf_embeddings[positions] = codec.encode(embeddings[start:start+batch_size])[order]
+            ivf_rows[positions] = start + order
+            cursors += np.bincount(block_assignments, minlength=nlist)
+        ivf_embeddings.flush()
+        ivf_rows.flush()
+        del ivf_embeddings, ivf_rows
+        for name, array in (("centroids", centroids), ("offsets", offsets)):
+            np.save(ivf_paths[name] + ".tmp", array)
+            os.replace(ivf_paths[name] + ".tmp.npy", ivf_paths[name] + ".tmp")
+        codec_path = os.path.join(self.directory, "ivf_codec.npz")
+        _save_codec(codec, codec_path + ".tmp")
+        os.replace(codec_path + ".tmp", codec_path)
+        for path in ivf_paths.values():
+            os.replace(path + ".tmp", path)
+        # The config is saved last, so the ivf is only used once it's complete.
+        self.config["ivf"] = {
+            "nlist": nlist, "num_embeddings": num_embeddings, "codec": codec.name,
+            "generation": self.config.get("generation", 0),
+        }
+        self._save_config()
+        self._ivf = None
+        self.search_param["nlist"] = nlist
+        list_sizes = np.diff(offsets)
+        print(
+            f"Built the IVF with {nlist} lists of {list_sizes.mean():.1f} embeddings on average "
+            f"(max {list_sizes.max()}, {int((list_sizes == 0).sum())} empty), stored as {codec.name}."
+        )
+
+    def search(self, query_embs: np.ndarray, top_k: int) -> List[List[Tuple[str, float]]]:
+        # The (vector_id, score) hits of each query, like _milvus_search in haystack_monkeypatch.py.
+        scores, rows = self.search_top_k(query_embs, top_k)
+        return [
+            [(str(row), float(score)) for row, score in zip(query_rows, query_scores) if row != -1]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def tune_block_size(
+        self, num_queries: int = 256, block_sizes: Tuple[int, ...] = (4096, 16384, 65536, 262144)
+    ) -> int:
+        """
+        Times the search of num_queries random queries with each block size (over the first rows of
+        the matrix) and saves the fastest one in the config of the index.
+        """
+        embeddings = self.get_embeddings()
+        block_sizes = [block_size for block_size in block_sizes if block_size <= len(embeddings)] or block_sizes[:1]
+        num_rows = min(len(embeddings), 2 * max(block_sizes))
+        if not num_rows: # nothing to tune on.
+            return block_sizes[0]
+        query_embs = np.random.default_rng(0).standard_normal((num_queries, self.embedding_dim), dtype=np.float32)
+        block_size_to_seconds = {}
+        for block_size in block_sizes:
+            start_time = time.perf_counter()
+            for start in range(0, num_rows, block_size):
+                block = np.asarray(embeddings[start:min(start+block_size, num_rows)], dtype=np.float32)
+                scores = query_embs @ block.T
+                _argpartition_top_k(scores, 100)
+            block_size_to_seconds[block_size] = time.perf_counter() - start_time
+        best_block_size = min(block_size_to_seconds, key=block_size_to_seconds.get)
+        print(
+            "Search block size timings (seconds per {} rows): {}. Using {}.".format(
+                num_rows,
+                ", ".join(f"{block_size}: {seconds:.3f}" for block_size, seconds in block_size_to_seconds.items()),
+                best_block_size,
+            )
+        )
+        if num_rows >= 2 * max(block_sizes): # o/w tune again once the index is larger.
+            self.config["block_size"] = best_block_size
+            self._save_config()
+        else:
+            self._block_size = best_block_size
+        return best_block_size
+
+    def _get_documents_by_vector_ids(self, vector_ids: List[str], index: str) -> Dict[str, Document]:
+        documents = self.get_documents_by_vector_ids(list(set(vector_ids)), index=index)
+        return {document.meta["vector_id"]: document for document in documents}
+
+    def query_by_embedding_batch(
+        self,
+        query_embs: List[np.ndarray],
+        filters: Optional[List[Optional[FilterType]]] = None,
+        top_k: int = 10,
+        index: Optional[str] = None,
+        return_embedding: Optional[bool] = None,
+        headers: Optional[Dict[str, str]] = None,
+        scale_score: bool = True,
+    ) -> List[List[Document]]:
+        if headers:
+            raise NotImplementedError("LocalDocumentStore does not support headers.")
+        if filters is not None and any(filters):
+            raise NotImplementedError("LocalDocumentStore does not support filters.")
+        if return_embedding:
+            raise NotImplementedError("LocalDocumentStore does not return embeddings.")
+        index = index or self.index
+        hits = self.search(np.stack([np.asarray(query_emb).reshape(-1) for query_emb in query_embs]), top_k)
+        vector_id_to_document = self._get_documents_by_vector_ids(
+            [vector_id for query_hits in hits for vector_id, _ in query_hits], index
+        )
+        results = []
+        for query_hits in hits:
+            documents = []
+            for vector_id, score in query_hits:
+                if vector_id not in vector_id_to_document:
+                    continue
+                # A copy per query, as the same document can be a hit of several queries (with different scores),
+                # with its own meta, as callers pop from it.
+                document = copy.copy(vector_id_to_document[vector_id])
+                document.meta = dict(document.meta)
+                document.score = self.scale_to_unit_interval(score, self.similarity) if scale_score else score
+                documents.append(document)
+            results.append(documents)
+        return results
+
+    def query_by_embedding(
+        self,
+        query_emb: np.ndarray,
+        filters: Optional[FilterType] = None,
+        top_k: int = 10,
+        index: Optional[str] = None,
+        return_embedding: Optional[bool] = None,
+        headers: Optional[Dict[str, str]] = None,
+        scale_score: bool = True,
+    ) -> List[Document]:
+        return self.query_by_embedding_batch(
+            [query_emb], filters=[filters], top_k=top_k, index=index, return_embedding=return_embedding,
+            headers=headers, scale_score=scale_score,
+        )[0]
+
+    def delete_index(self, index: str):
+        super().delete_index(index)
+        self._clear_embeddings()
+
+
+def _save_codec(codec: VectorCodec, path: str):
+    with open(path, "wb") as file:
+        np.savez(file, **codec.get_state())
+
+
+def _load_codec(name: str, embedding_dim: int, path: str) -> VectorCodec:
+    codec = get_codec(name, embedding_dim)
+    if name != "float32":
+        with np.load(path) as state:
+            codec.set_state(dict(state))
+    return codec
+
+
+def _merge_top_k(
+    scores_list: List[np.ndarray], rows_list: List[np.ndarray], top_k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    scores, rows = np.concatenate(scores_list, axis=1), np.concatenate(rows_list, axis=1)
+    columns = _argpartition_top_k(scores, top_k)
+    return np.take_along_axis(scores, columns, axis=1), np.take_along_axis(rows, columns, axis=1)
+
+
+def _sort_and_pad_top_k(scores: np.ndarray, rows: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Sorted by the score, with the rows of -inf scores (the candidates of empty lists) as -1.
+    order = np.argsort(-scores, axis=1, kind="stable")
+    scores, rows = np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+    if rows.shape[1] < top_k:
+        padding = top_k - rows.shape[1]
+        scores = np.pad(scores, ((0, 0), (0, padding)), constant_values=-np.inf)
+        rows = np.pad(rows, ((0, 0), (0, padding)), constant_values=-1)
+    rows[np.isneginf(scores)] = -1
+    return scores, rows
+
+
+def _argpartition_top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+    # The columns of the top_k (unsorted) scores of each row, or all of them if there are fewer.
+    if scores.shape[1] <= top_k:
+        return np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    return np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+
+
+def build_local_document_store(
+    index_name: str, index_type: str, nprobe: int = 512, codec: str = "float32", rerank_top_n: int = 0
+) -> LocalDocumentStore:
+    # The nprobe default is the one of build_document_store for IVF_FLAT.
+    assert index_type in LOCAL_INDEX_TYPES
+    return LocalDocumentStore(
+        get_local_index_directory(index_name, index_type), index=index_name, index_type=index_type, nprobe=nprobe,
+        codec=codec, rerank_top_n=rerank_top_n,
+    )
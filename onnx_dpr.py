@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import argparse
+from typing import Dict, List, Optional
+
+import _jsonnet
+import numpy as np
+import torch
+
+from lib import yield_jsonl, read_json, write_json, load_cwd_dotenv
+
+
+ENCODER_BACKENDS = ("torch", "onnx", "onnx_int8")
+
+
+def get_onnx_directory(experiment_name: str) -> str:
+    return os.path.join("serialization_dir", experiment_name, "onnx")
+
+
+def get_onnx_encoder_file_path(experiment_name: str, encoder_name: str, quantized: bool) -> str:
+    assert encoder_name in ("query", "passage")
+    file_name = f"{encoder_name}_encoder" + (".int8" if quantized else "") + ".onnx"
+    return os.path.join(get_onnx_directory(experiment_name), file_name)
+
+
+class _PooledOutputModule(torch.nn.Module):
+    # What haystack's DPREncoder returns (and the BiAdaptiveModel passes on in eval mode).
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(
+            input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids, return_dict=False
+        )[0]
+
+
+def export_encoder(encoder, file_path: str, max_seq_len: int):
+    module = _PooledOutputModule(encoder.model).cpu().eval()
+    dummy_inputs = tuple(torch.ones((2, max_seq_len), dtype=torch.long) for _ in range(3))
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    print(f"Exporting {file_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            dummy_inputs,
+            file_path,
+            input_names=input_names,
+            output_names=["pooler_output"],
+            dynamic_axes={
+                **{name: {0: "batch_size", 1: "sequence_length"} for name in input_names},
+                "pooler_output": {0: "batch_size"},
+            },
+            opset_version=14,
+            do_constant_folding=True,
+        )
+
+
+def quantize_encoder(file_path: str, quantized_file_path: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    print(f"Quantizing (dynamic int8) {file_path} into {quantized_file_path}")
+    quantize_dynamic(file_path, quantized_file_path, weight_type=QuantType.QInt8)
+
+
+def load_onnx_session(file_path: str, num_threads: Optional[int] = None):
+    try:
+        import onnxruntime
+    except ImportError:
+        exit("The onnx encoder backend needs onnxruntime (pip install onnxruntime).")
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        session_options.intra_op_num_threads = num_threads
+    return onnxruntime.InferenceSession(file_path, session_options, providers=["CPUExecutionProvider"])
+
+
+class OnnxBiEncoder:
+    """
+    Stands in for the retriever's BiAdaptiveModel in _get_predictions (same forward arguments and
+    output), running the query and passage encoders exported by this script with onnxruntime on cpu.
+    """
+
+    def __init__(self, query_session, passage_session) -> None:
+        self.query_session = query_session
+        self.passage_session = passage_session
+
+    def eval(self):
+        return self
+
+    @staticmethod
+    def _run(session, input_ids, segment_ids, attention_mask) -> torch.Tensor:
+        max_seq_len = input_ids.shape[-1]
+        outputs = session.run(["pooler_output"], {
+            "input_ids": input_ids.reshape(-1, max_seq_len).cpu().numpy(),
+            "attention_mask": attention_mask.reshape(-1, max_seq_len).cpu().numpy(),
+            "token_type_ids": segment_ids.reshape(-1, max_seq_len).cpu().numpy(),
+        })
+        return torch.from_numpy(outputs[0])
+
+    def forward(
+        self,
+        query_input_ids=None,
+        query_segment_ids=None,
+        query_attention_mask=None,
+        passage_input_ids=None,
+        passage_segment_ids=None,
+        passage_attention_mask=None,
+    ):
+        query_embeddings = passage_embeddings = None
+        if query_input_ids is not None:
+            query_embeddings = self._run(
+                self.query_session, query_input_ids, query_segment_ids, query_attention_mask
+            )
+        if passage_input_ids is not None:
+            passage_embeddings = self._run(
+                self.passage_session, passage_input_ids, passage_segment_ids, passage_attention_mask
+            )
+        return [(query_embeddings, passage_embeddings)]
+
+
+def use_onnx_encoders(retriever, experiment_name: str, encoder_backend: str, num_threads: Optional[int] = None):
+    assert encoder_backend in ENCODER_BACKENDS, f"encoder_backend must be one of {ENCODER_BACKENDS}."
+    if encoder_backend == "torch":
+        return
+    quantized = encoder_backend == "onnx_int8"
+    sessions = []
+    for encoder_name in ("query", "passage"):
+        file_path = get_onnx_encoder_file_path(experiment_name, encoder_name, quantized)
+        if not os.path.exists(file_path):
+            exit(
+                f"The onnx encoder {file_path} is not available. Run: "
+                f"python onnx_dpr.py export {experiment_name}" + (" --quantize" if quantized else "")
+            )
+        sessions.append(load_onnx_session(file_path, num_threads))
+    print(f"Using the {encoder_backend} encoder backend.")
+    retriever.model = OnnxBiEncoder(*sessions)
+    retriever.encoder_backend = encoder_backend # it changes the embeddings, so it's a part of the cache key.
+
+
+def load_evaluation_data(experiment_config: Dict, num_passages: int, num_queries: int):
+    from haystack.schema import Document
+    instances = next(yield_jsonl(experiment_config["index_data_path"], num_passages))
+    documents = [
+        Document(content=instance["content"], meta={"name": instance["meta"].get("name", "")})
+        for instance in instances
+    ]
+    dev_file_path = os.path.join(experiment_config["data_dir"], experiment_config["dev_filename"])
+    queries = [instance["question"] for instance in read_json(dev_file_path)][:num_queries]
+    return documents, queries
+
+
+def get_top_k_indices(query_embeddings: np.ndarray, passage_embeddings: np.ndarray, top_k: int) -> np.ndarray:
+    scores = query_embeddings @ passage_embeddings.T
+    return np.argsort(-scores, axis=1)[:, :top_k]
+
+
+def get_cosines(embeddings: np.ndarray, reference_embeddings: np.ndarray) -> np.ndarray:
+    return (embeddings * reference_embeddings).sum(axis=1) / (
+        np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference_embeddings, axis=1)
+    )
+
+
+def embed_and_time(retriever, documents: List, queries: List[str]):
+    start_time = time.perf_counter()
+    passage_embeddings = retriever.embed_documents(documents)
+    passage_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    query_embeddings = np.stack(retriever.embed_queries(queries))
+    query_seconds = time.perf_counter() - start_time
+    return passage_embeddings, query_embeddings, {
+        "passages_per_second": round(len(documents) / passage_seconds, 2),
+        "queries_per_second": round(len(queries) / query_seconds, 2),
+    }
+
+
+def evaluate(
+    retriever,
+    experiment_name: str,
+    experiment_config: Dict,
+    encoder_backend: str,
+    num_passages: int,
+    num_queries: int,
+    top_k: int,
+    num_threads: Optional[int],
+) -> Dict:
+    # The pytorch model (on cpu) is the reference, recall@k is of its top_k passages in the onnx top_k.
+    documents, queries = load_evaluation_data(experiment_config, num_passages, num_queries)
+    print(f"Embedding {len(documents)} passages and {len(queries)} queries with torch.")
+    torch_passage_embeddings, torch_query_embeddings, torch_throughput = embed_and_time(
+        retriever, documents, queries
+    )
+    use_onnx_encoders(retriever, experiment_name, encoder_backend, num_threads)
+    print(f"Embedding {len(documents)} passages and {len(queries)} queries with {encoder_backend}.")
+    onnx_passage_embeddings, onnx_query_embeddings, onnx_throughput = embed_and_time(
+        retriever, documents, queries
+    )
+
+    passage_cosines = get_cosines(onnx_passage_embeddings, torch_passage_embeddings)
+    query_cosines = get_cosines(onnx_query_embeddings, torch_query_embeddings)
+    torch_top_k = get_top_k_indices(torch_query_embeddings, torch_passage_embeddings, top_k)
+    onnx_top_k = get_top_k_indices(onnx_query_embeddings, onnx_passage_embeddings, top_k)
+    recall_at_k = np.mean([
+        len(set(torch_indices) & set(onnx_indices)) / top_k
+        for torch_indices, onnx_indices in zip(torch_top_k, onnx_top_k)
+    ])
+    top_1_agreement = np.mean(torch_top_k[:, 0] == onnx_top_k[:, 0])
+    return {
+        "encoder_backend": encoder_backend,
+        "num_passages": len(documents),
+        "num_queries": len(queries),
+        "passage_cosine_mean": round(float(passage_cosines.mean()), 6),
+        "passage_cosine_min": round(float(passage_cosines.min()), 6),
+        "query_cosine_mean": round(float(query_cosines.mean()), 6),
+        "query_cosine_min": round(float(query_cosines.min()), 6),
+        f"recall@{top_k}_vs_torch": round(float(recall_at_k), 4),
+        f"recall@{top_k}_delta": round(float(recall_at_k) - 1.0, 4),
+        "top_1_agreement_vs_torch": round(float(top_1_agreement), 4),
+        "torch": torch_throughput,
+        encoder_backend: onnx_throughput,
+        "passage_speedup": round(onnx_throughput["passages_per_second"] / torch_throughput["passages_per_second"], 2),
+        "query_speedup": round(onnx_throughput["queries_per_second"] / torch_throughput["queries_per_second"], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and evaluate onnx (cpu) versions of the DPR encoders.")
+    subparsers = parser.add_subparsers(title="Commands", metavar="", dest="command")
+    base_parser = argparse.ArgumentParser(add_help=False)
+    base_parser.add_argument(
+        "experiment_name", type=str, help="experiment_name (from config file in experiment_config/)."
+    )
+    export_parser = subparsers.add_parser(
+        "export", description="Export", help="Export the encoders to onnx.", parents=[base_parser]
+    )
+    export_parser.add_argument(
+        "--quantize", action="store_true", default=False, help="also make dynamic int8 quantized encoders."
+    )
+    evaluate_parser = subparsers.add_parser(
+        "evaluate", description="Evaluate", help="Compare the onnx encoders with the torch ones.",
+        parents=[base_parser],
+    )
+    evaluate_parser.add_argument(
+        "--encoder_backend", type=str, choices=("onnx", "onnx_int8"), default="onnx", help="backend to evaluate."
+    )
+    evaluate_parser.add_argument("--num_passages", type=int, help="number of index passages.", default=2000)
+    evaluate_parser.add_argument("--num_queries", type=int, help="number of dev queries.", default=200)
+    evaluate_parser.add_argument("--top_k", type=int, help="k of recall@k.", default=20)
+    evaluate_parser.add_argument("--num_threads", type=int, help="onnxruntime intra-op threads.", default=None)
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    if not args.command:
+        parser.print_help()
+        exit()
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+    evaluation_config = dict(experiment_config)
+
+    from index_dpr import load_retriever # here as index_dpr imports this module.
+    experiment_config["encoder_backend"] = "torch"
+    retriever, _ = load_retriever(args.experiment_name, experiment_config)
+    retriever.progress_bar = False
+
+    if args.command == "export":
+        for encoder_name, encoder, max_seq_len in (
+            ("query", retriever.query_encoder, retriever.processor.max_seq_len_query),
+            ("passage", retriever.passage_encoder, retriever.processor.max_seq_len_passage),
+        ):
+            file_path = get_onnx_encoder_file_path(args.experiment_name, encoder_name, quantized=False)
+            export_encoder(encoder, file_path, max_seq_len)
+            if args.quantize:
+                quantized_file_path = get_onnx_encoder_file_path(args.experiment_name, encoder_name, quantized=True)
+                quantize_encoder(file_path, quantized_file_path)
+        print(
+            "Done. Set \"encoder_backend\": \"onnx\"" + (" (or \"onnx_int8\")" if args.quantize else "") +
+            " in the experiment config to use it."
+        )
+
+    elif args.command == "evaluate":
+        retriever.model.to(torch.device("cpu"))
+        retriever.devices = [torch.device("cpu")]
+        result = evaluate(
+            retriever, args.experiment_name, evaluation_config, args.encoder_backend,
+            args.num_passages, args.num_queries, args.top_k, args.num_threads,
+        )
+        print(json.dumps(result, indent=4))
+        suffix = ".int8" if args.encoder_backend == "onnx_int8" else ""
+        write_json(result, os.path.join(get_onnx_directory(args.experiment_name), f"evaluation{suffix}.json"))
+
+
+if __name__ == "__main__":
+    main()
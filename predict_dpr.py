@@ -1,14 +1,19 @@
 import os
 import json
 import argparse
+from typing import Dict, Optional, Tuple
 
 import _jsonnet
 from dotenv import load_dotenv
 from haystack.nodes import DensePassageRetriever
 
-from lib import read_jsonl, write_jsonl, get_postgresql_address, get_milvus_address, make_dirs_for_file_path
-from dpr_lib import get_index_name, milvus_connect, get_collection_name_to_sizes, build_document_store
+from lib import read_jsonl, write_jsonl, make_dirs_for_file_path, strip_compression_extension
+from dpr_lib import get_index_name, build_milvus_document_store, get_autotuned_max_batch_tokens
 from haystack_monkeypatch import monkeypatch_retriever
+from onnx_dpr import use_onnx_encoders
+from embedding_cache import EmbeddingCache, attach_query_embedding_cache
+from result_cache import get_index_result_cache
+from local_document_store import LOCAL_INDEX_TYPES, build_local_document_store
 
 
 
@@ -21,7 +26,7 @@ def get_prediction_output_file_path(
     serialization_dir = os.path.join("serialization_dir", experiment_name)
     index_name = get_index_name(experiment_name, index_data_path)
     prediction_name = os.path.splitext(
-        prediction_file_path
+        strip_compression_extension(prediction_file_path)
     )[0].replace("processed_data/", "").replace("/", "__") + f"__{num_documents}_docs"
     retrieval_results_dir = os.path.join(serialization_dir, "retrieval_results")
     prediction_file_path = os.path.join(
@@ -30,6 +35,89 @@ def get_prediction_output_file_path(
     return prediction_file_path
 
 
+def load_document_store(index_name: str, index_type: str, experiment_config: Dict):
+    """
+    The local or milvus document store of the index, checked to be non-empty. Pops its keys from experiment_config.
+    """
+    if index_type in LOCAL_INDEX_TYPES:
+        print("Initializing LocalDocumentStore.")
+        # The number of inverted lists searched per query by NUMPY_IVF.
+        nprobe = experiment_config.pop("nprobe", 512)
+        # The codes searched instead of the embeddings, and how many of their top hits are rescored with the embeddings.
+        codec = experiment_config.pop("codec", "float32")
+        rerank_top_n = experiment_config.pop("rerank_top_n", 0)
+        document_store = build_local_document_store(
+            index_name, index_type, nprobe=nprobe, codec=codec, rerank_top_n=rerank_top_n
+        )
+        assert document_store.get_embedding_count(), f"The local index {document_store.directory} is empty."
+    else:
+        document_store = build_milvus_document_store(index_name, index_type)
+        assert not document_store.collection.is_empty
+    assert document_store.index_type == index_type
+    return document_store
+
+
+def load_query_retriever(
+    experiment_name: str, experiment_config: Dict
+) -> Tuple[DensePassageRetriever, Optional[EmbeddingCache]]:
+    """
+    The (trained) retriever to embed queries with, and its query embedding cache if it's enabled.
+    Pops its keys from experiment_config.
+    """
+    dont_train = experiment_config.pop("dont_train", False)
+    length_bucketed_encoding = experiment_config.pop("length_bucketed_encoding", False)
+    fast_tokenization = experiment_config.pop("fast_tokenization", False)
+    tokenization_chunk_size = experiment_config.pop("tokenization_chunk_size", None)
+    embedding_dtype = experiment_config.pop("embedding_dtype", "float32")
+    embedding_memmap_directory = experiment_config.pop("embedding_memmap_directory", None)
+    encoder_backend = experiment_config.pop("encoder_backend", "torch")
+    # Caches the query embeddings on disk, so that predicting on the same queries (with other indexes or
+    # num_documents) skips the encoder. See embedding_cache.py.
+    query_embedding_cache = experiment_config.pop("predict_query_embedding_cache", False)
+    query_embedding_cache_max_gb = experiment_config.pop("predict_query_embedding_cache_max_gb", 10)
+    # Batches the query encoding by a number of (padded) tokens instead of batch_size. See autotune_dpr.py.
+    max_batch_tokens = experiment_config.pop("predict_max_batch_tokens", None)
+    if max_batch_tokens is None:
+        max_batch_tokens = get_autotuned_max_batch_tokens(experiment_name, "query")
+    serialization_dir = os.path.join("serialization_dir", experiment_name)
+    if dont_train:
+        query_model = experiment_config["query_model"]
+        passage_model = experiment_config["passage_model"]
+        retriever = DensePassageRetriever(
+            document_store=None,
+            query_embedding_model=query_model,
+            passage_embedding_model=passage_model,
+            max_seq_len_query=60,
+            max_seq_len_passage=440,
+            progress_bar=True,
+        )
+    else:
+        retriever = DensePassageRetriever.load(
+            load_dir=serialization_dir,
+            document_store=None, # No need to pass document_store here, pass at retrieval time.
+            query_encoder_dir="query_encoder",
+            passage_encoder_dir="passage_encoder",
+            max_seq_len_query=60,
+            max_seq_len_passage=440,
+        )
+        retriever.progress_bar = True
+    monkeypatch_retriever(
+        retriever,
+        length_bucketed_encoding=length_bucketed_encoding,
+        max_batch_tokens=max_batch_tokens,
+        fast_tokenization=fast_tokenization,
+        tokenization_chunk_size=tokenization_chunk_size,
+        embedding_dtype=embedding_dtype,
+        embedding_memmap_directory=embedding_memmap_directory,
+    )
+    use_onnx_encoders(retriever, experiment_name, encoder_backend)
+    embedding_cache = None
+    if query_embedding_cache:
+        embedding_cache = attach_query_embedding_cache(
+            retriever, max_num_bytes=int(query_embedding_cache_max_gb * 1024**3)
+        )
+    return retriever, embedding_cache
+
 
 def main():
     # https://haystack.deepset.ai/tutorials/06_better_retrieval_via_embedding_retrieval
@@ -43,9 +131,24 @@ def main():
     )
     parser.add_argument("prediction_file_path", nargs="?", help="prediction file path", default=None)
     parser.add_argument("--num_documents", type=int, help="num_documents", default=20)
-    parser.add_argument("--batch_size", type=int, help="batch_size", default=256) # no point increasing it, knn is bs=1
+    parser.add_argument("--batch_size", type=int, help="batch_size", default=256)
+    parser.add_argument(
+        "--search_batch_size", type=int, default=256,
+        help="number of query vectors per milvus search request (0 searches one query at a time).",
+    )
+    parser.add_argument(
+        "--max_concurrent_searches", type=int, default=1,
+        help="number of milvus search requests (with their sql reads) in flight at once.",
+    )
     parser.add_argument("--query_field", type=str, help="query_field", default="question_text")
     parser.add_argument("--output_directory", type=str, help="output_directory", default=None)
+    parser.add_argument(
+        "--compress_output", type=str, choices=("gz", "bz2", "xz"), default=None,
+        help="write the predictions compressed (the extension is added to the output file path).",
+    )
+    parser.add_argument(
+        "--num_read_workers", type=int, help="number of processes to parse the prediction file with.", default=1
+    )
     args = parser.parse_args()
 
     experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
@@ -54,6 +157,8 @@ def main():
 
     experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
     batch_size = experiment_config.get("predict_batch_size", args.batch_size)
+    search_batch_size = experiment_config.get("predict_search_batch_size", args.search_batch_size)
+    max_concurrent_searches = experiment_config.get("predict_max_concurrent_searches", args.max_concurrent_searches)
 
     if not args.prediction_file_path:
         print("The prediction file path is not passed, defaulting to dev file_path from the config:")
@@ -62,99 +167,53 @@ def main():
         )
         print(args.prediction_file_path)
 
-    print("Connecting to Milvus.")
-    milvus_host, milvus_port = get_milvus_address()
-    milvus_connect(milvus_host, milvus_port)
-
     index_data_path = experiment_config.pop("index_data_path")
     index_name = get_index_name(args.experiment_name, index_data_path)
     index_type = experiment_config.pop("index_type")
-    assert index_type in ("FLAT", "IVF_FLAT", "HNSW")
+    assert index_type in ("FLAT", "IVF_FLAT", "HNSW") + LOCAL_INDEX_TYPES
     print(f"Index name: {index_name}")
     print(f"Index type: {index_type}")
 
-    print("Milvus collections stats.")
-    collection_name_to_sizes = get_collection_name_to_sizes()
-    print(json.dumps(collection_name_to_sizes, indent=4))
-
-    non_empty_collection_names = [
-        collection_name for collection_name, size in collection_name_to_sizes.items()
-        if size > 0
-    ]
-    if non_empty_collection_names:
-        assert non_empty_collection_names == [index_name], \
-            "Looks like your running on an incorrect milvus server. " \
-            "The index name on the server doesn't match the client."
-
-    print("Initializing MilvusDocumentStore.")
-    postgresql_host, postgresql_port = get_postgresql_address()
-    document_store = build_document_store(
-        postgresql_host, postgresql_port,
-        milvus_host, milvus_port,
-        index_name, index_type
-    )
+    document_store = load_document_store(index_name, index_type, experiment_config)
 
     print("Computing number of total documents in the index.")
     number_of_documents = document_store.get_document_count()
     print(f"It is: {number_of_documents}")
 
-    assert not document_store.collection.is_empty
-    assert document_store.index_type == index_type
-
-    dont_train = experiment_config.pop("dont_train", False)
-    serialization_dir = os.path.join("serialization_dir", args.experiment_name)
-    if dont_train:
-        query_model = experiment_config["query_model"]
-        passage_model = experiment_config["passage_model"]
-        retriever = DensePassageRetriever(
-            document_store=None,
-            query_embedding_model=query_model,
-            passage_embedding_model=passage_model,
-            max_seq_len_query=60,
-            max_seq_len_passage=440,
-            progress_bar=True,
-        )
-    else:
-        retriever = DensePassageRetriever.load(
-            load_dir=serialization_dir,
-            document_store=None, # No need to pass document_store here, pass at retrieval time.
-            query_encoder_dir="query_encoder",
-            passage_encoder_dir="passage_encoder",
-            max_seq_len_query=60,
-            max_seq_len_passage=440,
-        )
-        retriever.progress_bar = True
-    monkeypatch_retriever(retriever)
+    # Caches the ranked hits per query embedding for this index (invalidated when its documents change),
+    # so runs with the same or smaller num_documents don't search. See result_cache.py.
+    use_result_cache = experiment_config.pop("predict_result_cache", False)
+    result_cache_top_k = experiment_config.pop("predict_result_cache_top_k", None)
+    retriever, embedding_cache = load_query_retriever(args.experiment_name, experiment_config)
 
-    prediction_instances = read_jsonl(args.prediction_file_path)
+    prediction_instances = read_jsonl(args.prediction_file_path, num_workers=args.num_read_workers)
 
     queries = [instance[args.query_field] for instance in prediction_instances]
     document_store.progress_bar = True
-    retrieval_results = retriever.retrieve_batch(
+    result_cache = None
+    if use_result_cache:
+        result_cache = get_index_result_cache(document_store, index_name, number_of_documents)
+        print(f"Using result cache: {result_cache.directory}")
+    # The records (id, content, score and metadata) are read from sql in bulk for the hits of each
+    # milvus search request, instead of a Document per hit that's then converted.
+    retrieval_results = retriever.retrieve_batch_records(
         queries=queries,
         top_k=args.num_documents,
         index=index_name,
         batch_size=batch_size,
-        document_store=document_store
+        document_store=document_store,
+        search_batch_size=search_batch_size,
+        max_concurrent_searches=max_concurrent_searches,
+        result_cache=result_cache,
+        result_cache_top_k=result_cache_top_k,
     )
 
     for prediction_instance, retrieved_documents in zip(prediction_instances, retrieval_results):
-        retrieved_documents_stripped = []
-        for retrieved_document in retrieved_documents:
-            retrieved_document_ = retrieved_document.to_dict()
-            id_ = retrieved_document_["meta"].pop("id_prefix") + retrieved_document_["id"]
-            retrieved_document_["meta"].pop("vector_id")
-            retrieved_document_stripped = {
-                "id": id_,
-                "content": retrieved_document_["content"],
-                "score": retrieved_document_["score"],
-            }
-            for key, value in retrieved_document_["meta"].items():
-                retrieved_document_stripped[key] = value
-            if "name" in retrieved_document_stripped:
-                retrieved_document_stripped["title"] = retrieved_document_stripped.pop("name")
-            retrieved_documents_stripped.append(retrieved_document_stripped)
-        prediction_instance["retrieved_documents"] = retrieved_documents_stripped
+        prediction_instance["retrieved_documents"] = retrieved_documents
+    if embedding_cache is not None:
+        embedding_cache.print_stats()
+    if result_cache is not None:
+        result_cache.print_stats()
 
     output_file_path = get_prediction_output_file_path(
         args.experiment_name,
@@ -164,6 +223,8 @@ def main():
     )
     if args.output_directory:
         output_file_path = os.path.join(args.output_directory, os.path.basename(output_file_path))
+    if args.compress_output:
+        output_file_path += "." + args.compress_output
 
     make_dirs_for_file_path(output_file_path)
     write_jsonl(prediction_instances, output_file_path)
@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import argparse
+from typing import Dict, List
+
+import _jsonnet
+import torch
+
+from lib import yield_jsonl_slice, load_cwd_dotenv
+from token_cache import TokenCache, TokenCacheWriter, get_passage_token_cache_directory, get_dict_passage_keys
+from fast_tokenization import PASSAGE_TENSOR_NAMES, tokenize_passages, get_passage_dataset
+from index_dpr import normalize_document, load_retriever
+
+
+def document_to_dict(document: Dict) -> Dict:
+    # As DensePassageRetriever.embed_documents makes them.
+    return {
+        "passages": [{
+            "title": document["meta"].get("name", ""),
+            "text": document["content"],
+            "label": "positive",
+            "external_id": document["id"],
+        }]
+    }
+
+
+def tokenize_dicts(retriever, dicts: List[Dict]) -> List[List[int]]:
+    return tokenize_passages(
+        retriever.passage_tokenizer,
+        [dict_["passages"][0]["title"] for dict_ in dicts],
+        [dict_["passages"][0]["text"] for dict_ in dicts],
+        retriever.processor.max_seq_len_passage,
+        retriever.processor.embed_title,
+    )
+
+
+def verify(retriever, dicts: List[Dict], token_cache: TokenCache):
+    # The cached tensors must be the ones haystack's processor makes, up to the padding that
+    # _get_predictions trims anyway, so it's compared over the full max_seq_len_passage.
+    dataset, _ = get_passage_dataset(retriever, dicts, token_cache)
+    expected_dataset, expected_tensor_names, _, _ = retriever.processor.dataset_from_dicts(
+        dicts, indices=[i for i in range(len(dicts))], return_baskets=True
+    )
+    expected_tensors = dict(zip(expected_tensor_names, expected_dataset.tensors))
+    for tensor_name, tensor in zip(PASSAGE_TENSOR_NAMES, dataset.tensors):
+        if not torch.equal(tensor.long(), expected_tensors[tensor_name].long()):
+            exit(
+                f"The cached {tensor_name} don't match haystack's processor ones. "
+                f"Delete {token_cache.directory} and don't use index_token_cache."
+            )
+    print(f"Verified the cached tokens of {len(dicts)} passages against haystack's processor.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tokenize the index passages once into the token cache (see token_cache.py)."
+    )
+    parser.add_argument(
+        "experiment_name", type=str, help="experiment_name (from config file in experiment_config/)."
+    )
+    parser.add_argument("--batch_size", type=int, help="number of passages tokenized at once.", default=10_000)
+    parser.add_argument(
+        "--num_verify", type=int, help="number of passages to check against haystack's processor.", default=1000
+    )
+    parser.add_argument("--force", action="store_true", help="remake the token cache if it exists.")
+    parser.add_argument("--num_read_workers", type=int, help="number of json parsing processes.", default=1)
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+
+    embed_title = experiment_config.pop("embed_title", True)
+    index_data_path = experiment_config.pop("index_data_path")
+    experiment_config.pop("index_num_encoding_workers", None) # only the tokenizer is used here.
+    retriever, _ = load_retriever(args.experiment_name, experiment_config)
+
+    directory = get_passage_token_cache_directory(retriever, index_data_path)
+    if TokenCache.exists(directory):
+        if not args.force:
+            exit(f"The token cache {directory} already exists. Use --force to remake it.")
+        shutil.rmtree(directory)
+    print(f"Writing the token cache: {directory}")
+
+    writer = TokenCacheWriter(directory, len(retriever.passage_tokenizer))
+    verify_dicts = []
+    dicts = []
+    for document in yield_jsonl_slice(index_data_path, 1, 0, num_workers=args.num_read_workers):
+        dicts.append(document_to_dict(normalize_document(document, embed_title)))
+        if len(dicts) >= args.batch_size:
+            writer.add(get_dict_passage_keys(dicts), tokenize_dicts(retriever, dicts))
+            verify_dicts += dicts[:args.num_verify - len(verify_dicts)]
+            dicts = []
+    if dicts:
+        writer.add(get_dict_passage_keys(dicts), tokenize_dicts(retriever, dicts))
+        verify_dicts += dicts[:args.num_verify - len(verify_dicts)]
+    num_passages = writer.close()
+    print(f"Tokenized {num_passages} unique passages.")
+
+    if verify_dicts:
+        verify(retriever, verify_dicts, TokenCache(directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from lib import read_json
+from embedding_cache import EmbeddingCache
+
+
+def get_result_cache_directory() -> str:
+    return os.environ.get(
+        "RESULT_CACHE_DIRECTORY",
+        os.path.join(os.path.expanduser("~"), ".cache", "haystack_wrapper", "result_cache"),
+    )
+
+
+def embeddings_to_keys(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    return np.array(
+        [hashlib.blake2b(embedding.tobytes(), digest_size=16).digest() for embedding in embeddings], dtype="S16"
+    )
+
+
+def get_search_fingerprint(**search_settings) -> str:
+    return hashlib.sha1(json.dumps(search_settings, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+
+
+class ResultCache:
+    """
+    On-disk cache of the ranked (vector_id, score) hits of the query embeddings for an index, with an
+    EmbeddingCache per top_k (the ids and the float64 scores viewed as int64, padded with id -1), so
+    a top_k is answered from the hits of any top_k at least as large. It's in a directory per index
+    name and search settings (including the document count). The caches of other search settings for
+    the same index are kept side by side (e.g. for nprobe sweeps), and the ones of another document
+    count are deleted, so it's invalidated when the index changes. With approximate index types, the
+    top of a larger search can differ slightly from a smaller search.
+    """
+
+    def __init__(self, index_name: str, **search_settings) -> None:
+        index_directory = os.path.join(get_result_cache_directory(), index_name)
+        fingerprint = get_search_fingerprint(**search_settings)
+        number_of_documents = search_settings.get("number_of_documents")
+        for other_directory in glob.glob(os.path.join(index_directory, "*")):
+            if os.path.basename(other_directory) == fingerprint:
+                continue
+            try:
+                other_search_settings = read_json(os.path.join(other_directory, "search_settings.json"))
+            except (OSError, ValueError):
+                continue # being created (or deleted) by another run.
+            if other_search_settings.get("number_of_documents") != number_of_documents:
+                print(f"Deleting the stale result cache: {other_directory}")
+                shutil.rmtree(other_directory, ignore_errors=True)
+        self.directory = os.path.join(index_directory, fingerprint)
+        os.makedirs(self.directory, exist_ok=True)
+        # Written whole (renamed into place), as other runs read it to tell if the cache is stale.
+        settings_path = os.path.join(self.directory, "search_settings.json")
+        with open(settings_path + f".tmp{os.getpid()}", "w") as file:
+            json.dump(search_settings, file, indent=4)
+        os.replace(settings_path + f".tmp{os.getpid()}", settings_path)
+        self._top_k_to_cache: Dict[int, EmbeddingCache] = {}
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    def _get_cache(self, top_k: int) -> EmbeddingCache:
+        if top_k not in self._top_k_to_cache:
+            self._top_k_to_cache[top_k] = EmbeddingCache(os.path.join(self.directory, f"top_{top_k}"))
+        return self._top_k_to_cache[top_k]
+
+    def _get_top_ks(self) -> List[int]:
+        return sorted(
+            int(os.path.basename(path)[len("top_"):]) for path in glob.glob(os.path.join(self.directory, "top_*"))
+        )
+
+    def lookup(self, keys: np.ndarray, top_k: int) -> Tuple[List[Optional[List[Tuple[str, float]]]], np.ndarray]:
+        """
+        Returns (hits, found): the top_k (vector_id, score) hits of each key, or None where not found.
+        """
+        hits = [None] * len(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        for cache_top_k in self._get_top_ks():
+            remaining = np.flatnonzero(~found)
+            if cache_top_k < top_k or not len(remaining):
+                continue
+            rows, cache_found = self._get_cache(cache_top_k).lookup(keys[remaining])
+            for index, row in zip(remaining[cache_found], rows[cache_found] if rows is not None else []):
+                vector_ids, scores = row[:cache_top_k], row[cache_top_k:].view(np.float64)
+                hits[index] = [
+                    (str(vector_id), float(score))
+                    for vector_id, score in zip(vector_ids[:top_k], scores[:top_k]) if vector_id != -1
+                ]
+            found[remaining[cache_found]] = True
+        self.num_lookups += len(keys)
+        self.num_hits += int(found.sum())
+        return hits, found
+
+    def put(self, keys: np.ndarray, hits: List[List[Tuple[str, float]]], top_k: int):
+        assert len(keys) == len(hits)
+        vector_ids = np.full((len(keys), top_k), -1, dtype=np.int64)
+        scores = np.zeros((len(keys), top_k), dtype=np.float64)
+        for index, query_hits in enumerate(hits):
+            for rank, (vector_id, score) in enumerate(query_hits[:top_k]):
+                vector_ids[index, rank] = int(vector_id)
+                scores[index, rank] = score
+        self._get_cache(top_k).put(keys, np.concatenate([vector_ids, scores.view(np.int64)], axis=1))
+
+    def print_stats(self):
+        hit_rate = self.num_hits / self.num_lookups if self.num_lookups else 0.0
+        print(f"Result cache ({self.directory}): {self.num_hits}/{self.num_lookups} hits ({hit_rate:.1%}).")
+
+
+def get_index_result_cache(document_store, index_name: str, number_of_documents: int) -> ResultCache:
+    return ResultCache(
+        index_name,
+        index_type=document_store.index_type,
+        metric_type=document_store.metric_type,
+        similarity=document_store.similarity,
+        search_param=document_store.search_param,
+        number_of_documents=number_of_documents,
+    )
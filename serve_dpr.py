@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import argparse
+import threading
+import collections
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+import _jsonnet
+import numpy as np
+
+from lib import get_latency_percentiles, load_cwd_dotenv
+from dpr_lib import get_index_name
+from local_document_store import LOCAL_INDEX_TYPES
+from predict_dpr import load_document_store, load_query_retriever
+
+
+def get_latency_percentiles_ms(latencies: Deque[float]) -> Dict[str, float]:
+    return {name: round(1000 * seconds, 1) for name, seconds in get_latency_percentiles(list(latencies)).items()}
+
+
+class MicroBatcher:
+    """
+    Coalesces the items of concurrent requests into batches for function, which maps a list of items
+    to a list of results, in its own thread. A batch runs once max_batch_size items are pending or
+    the oldest pending request has waited max_wait_seconds, so a lone request waits at most that long,
+    and under load the batches fill up instead. Requests aren't split across batches (a request larger
+    than max_batch_size is a batch of its own).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable[[List[Any]], List[Any]],
+        max_batch_size: int,
+        max_wait_seconds: float,
+        num_recent_latencies: int = 10000,
+    ) -> None:
+        self.name = name
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._pending: Deque[Tuple[List[Any], Future, float]] = collections.deque()
+        self._num_pending_items = 0
+        self._condition = threading.Condition()
+        self.num_requests = 0
+        self.num_items = 0
+        self.num_batches = 0
+        self.busy_seconds = 0.0
+        self.batch_seconds: Deque[float] = collections.deque(maxlen=num_recent_latencies)
+        self.wait_seconds: Deque[float] = collections.deque(maxlen=num_recent_latencies)
+        self._thread = threading.Thread(target=self._run, name=f"{name}_batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, items: List[Any]) -> Future:
+        future = Future()
+        if not items:
+            future.set_result([])
+            return future
+        with self._condition:
+            self._pending.append((items, future, time.perf_counter()))
+            self._num_pending_items += len(items)
+            self._condition.notify()
+        return future
+
+    def __call__(self, items: List[Any]) -> List[Any]:
+        return self.submit(items).result()
+
+    def _take_batch(self) -> List[Tuple[List[Any], Future, float]]:
+        with self._condition:
+            while True:
+                if self._pending:
+                    deadline = self._pending[0][2] + self.max_wait_seconds
+                    remaining_seconds = deadline - time.perf_counter()
+                    if self._num_pending_items >= self.max_batch_size or remaining_seconds <= 0:
+                        break
+                    self._condition.wait(remaining_seconds)
+                else:
+                    self._condition.wait()
+            requests = [self._pending.popleft()]
+            num_items = len(requests[0][0])
+            while self._pending and num_items + len(self._pending[0][0]) <= self.max_batch_size:
+                requests.append(self._pending.popleft())
+                num_items += len(requests[-1][0])
+            self._num_pending_items -= num_items
+            return requests
+
+    def _run(self):
+        while True:
+            requests = self._take_batch()
+            start_time = time.perf_counter()
+            items = [item for request_items, _, _ in requests for item in request_items]
+            try:
+                results = self.function(items)
+                assert len(results) == len(items), \
+                    f"{self.name} returned {len(results)} results for {len(items)} items."
+            except BaseException as exception:
+                for _, future, _ in requests:
+                    future.set_exception(exception)
+                continue
+            finally:
+                end_time = time.perf_counter()
+                self.num_requests += len(requests)
+                self.num_items += len(items)
+                self.num_batches += 1
+                self.busy_seconds += end_time - start_time
+                self.batch_seconds.append(end_time - start_time)
+                self.wait_seconds.extend(start_time - submit_time for _, _, submit_time in requests)
+            offset = 0
+            for request_items, future, _ in requests:
+                future.set_result(results[offset:offset+len(request_items)])
+                offset += len(request_items)
+
+    def get_stats(self, wall_seconds: float) -> Dict:
+        return {
+            "requests": self.num_requests,
+            "items": self.num_items,
+            "batches": self.num_batches,
+            "pending_items": self._num_pending_items,
+            "items_per_batch": round(self.num_items / self.num_batches, 2) if self.num_batches else None,
+            "utilization": round(self.busy_seconds / wall_seconds, 3) if wall_seconds else None,
+            "batch_ms": get_latency_percentiles_ms(self.batch_seconds),
+            "queue_wait_ms": get_latency_percentiles_ms(self.wait_seconds),
+        }
+
+
+class RetrievalService:
+    """
+    The loaded retriever and document store, with a MicroBatcher for the query encoding and another
+    for the search (with the sql reads of the records). As they run in their own threads, the encoding
+    of a batch overlaps the search of the previous one.
+    """
+
+    def __init__(
+        self,
+        retriever,
+        document_store,
+        index_name: str,
+        default_top_k: int,
+        max_encode_batch_size: int,
+        max_search_batch_size: int,
+        max_wait_seconds: float,
+        num_recent_latencies: int = 10000,
+    ) -> None:
+        self.retriever = retriever
+        self.document_store = document_store
+        self.index_name = index_name
+        self.default_top_k = default_top_k
+        self._make_session = None
+        if document_store.index_type not in LOCAL_INDEX_TYPES:
+            # The session of the document store can't be shared by threads (see retrieve_batch_records).
+            from sqlalchemy.orm import sessionmaker
+            self._make_session = sessionmaker(bind=document_store.session.get_bind())
+        self.encode_batcher = MicroBatcher(
+            "encode", self._encode, max_encode_batch_size, max_wait_seconds, num_recent_latencies
+        )
+        self.search_batcher = MicroBatcher(
+            "search", self._search, max_search_batch_size, max_wait_seconds, num_recent_latencies
+        )
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_queries = 0
+        self.num_errors = 0
+        self.request_seconds: Deque[float] = collections.deque(maxlen=num_recent_latencies)
+        self._lock = threading.Lock()
+
+    def _encode(self, queries: List[str]) -> List[np.ndarray]:
+        return list(self.retriever.embed_search_queries(queries, self.document_store, index=self.index_name))
+
+    def _search(self, items: List[Tuple[np.ndarray, int]]) -> List[List[Dict]]:
+        # One search of the batch with its largest top_k, truncated per query.
+        query_embs = np.stack([query_emb for query_emb, _ in items])
+        max_top_k = max(top_k for _, top_k in items)
+        if self._make_session is None:
+            records = self.retriever.search_records(
+                query_embs, self.document_store, top_k=max_top_k, index=self.index_name
+            )
+        else:
+            with self._make_session() as session:
+                records = self.retriever.search_records(
+                    query_embs, self.document_store, top_k=max_top_k, index=self.index_name, session=session
+                )
+        return [query_records[:top_k] for query_records, (_, top_k) in zip(records, items)]
+
+    def retrieve(self, queries: List[str], top_k: int) -> List[List[Dict]]:
+        start_time = time.perf_counter()
+        try:
+            query_embs = self.encode_batcher(queries)
+            results = self.search_batcher([(query_emb, top_k) for query_emb in query_embs])
+        except BaseException:
+            with self._lock:
+                self.num_errors += 1
+            raise
+        with self._lock:
+            self.num_requests += 1
+            self.num_queries += len(queries)
+            self.request_seconds.append(time.perf_counter() - start_time)
+        return results
+
+    def get_stats(self) -> Dict:
+        wall_seconds = time.time() - self.start_time
+        return {
+            "index_name": self.index_name,
+            "uptime_seconds": round(wall_seconds, 1),
+            "requests": self.num_requests,
+            "queries": self.num_queries,
+            "errors": self.num_errors,
+            "queries_per_second": round(self.num_queries / wall_seconds, 2) if wall_seconds else None,
+            "request_ms": get_latency_percentiles_ms(self.request_seconds),
+            "batchers": [
+                batcher.get_stats(wall_seconds) for batcher in (self.encode_batcher, self.search_batcher)
+            ],
+        }
+
+
+class RetrievalRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /retrieve {"queries": [...]} (or {"query": "..."}) with an optional "top_k" returns
+    {"results": [[record, ...], ...]} (or {"result": [...]}). GET /stats and GET /health.
+    """
+
+    service: RetrievalService = None
+    max_top_k: int = 1000
+
+    def log_message(self, format, *args):
+        pass # Not a line per request.
+
+    def _send_json(self, status: int, instance: Dict):
+        body = json.dumps(instance).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, self.service.get_stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        if self.path != "/retrieve":
+            self._send_json(404, {"error": f"Unknown path {self.path}."})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            single_query = "query" in request
+            queries = [request["query"]] if single_query else request["queries"]
+            top_k = int(request.get("top_k", self.service.default_top_k))
+            assert isinstance(queries, list) and all(isinstance(query, str) for query in queries), \
+                "queries should be a list of strings."
+            assert 0 < top_k <= self.max_top_k, f"top_k should be in 1..{self.max_top_k}."
+        except (ValueError, KeyError, TypeError, AssertionError) as exception:
+            self._send_json(400, {"error": f"Bad request: {exception}"})
+            return
+        try:
+            results = self.service.retrieve(queries, top_k)
+        except Exception as exception:
+            self._send_json(500, {"error": repr(exception)})
+            return
+        self._send_json(200, {"result": results[0]} if single_query else {"results": results})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address.
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def main():
+    load_cwd_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Serve retrieval (with the retriever and document store loaded once) over http or a unix socket."
+    )
+    parser.add_argument(
+        "experiment_name", type=str, help="experiment_name (from config file in experiment_config/)."
+    )
+    parser.add_argument("--host", type=str, help="host to listen on.", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="port to listen on.", default=8000)
+    parser.add_argument(
+        "--unix_socket", type=str, default=None, help="unix socket path to listen on instead of the host and port."
+    )
+    parser.add_argument("--num_documents", type=int, help="default top_k of a request.", default=20)
+    parser.add_argument("--max_top_k", type=int, help="largest top_k of a request.", default=1000)
+    parser.add_argument(
+        "--max_encode_batch_size", type=int, default=64, help="largest number of queries encoded at once."
+    )
+    parser.add_argument(
+        "--max_search_batch_size", type=int, default=256, help="largest number of queries per search request."
+    )
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=5.0,
+        help="longest a query waits for others to batch with, in each of the encoding and the search.",
+    )
+    args = parser.parse_args()
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+
+    index_data_path = experiment_config.pop("index_data_path")
+    index_name = get_index_name(args.experiment_name, index_data_path)
+    index_type = experiment_config.pop("index_type")
+    assert index_type in ("FLAT", "IVF_FLAT", "HNSW") + LOCAL_INDEX_TYPES
+    print(f"Index name: {index_name}")
+    print(f"Index type: {index_type}")
+
+    document_store = load_document_store(index_name, index_type, experiment_config)
+    retriever, _ = load_query_retriever(args.experiment_name, experiment_config)
+    retriever.progress_bar = False
+    document_store.progress_bar = False
+
+    service = RetrievalService(
+        retriever,
+        document_store,
+        index_name,
+        default_top_k=args.num_documents,
+        max_encode_batch_size=args.max_encode_batch_size,
+        max_search_batch_size=args.max_search_batch_size,
+        max_wait_seconds=args.max_wait_ms / 1000,
+    )
+    print("Warming up.")
+    service.retrieve(["warm up"], args.num_documents)
+
+    RetrievalRequestHandler.service = service
+    RetrievalRequestHandler.max_top_k = args.max_top_k
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, RetrievalRequestHandler)
+        print(f"Serving on unix socket {args.unix_socket}.")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RetrievalRequestHandler)
+        print(f"Serving on http://{args.host}:{args.port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        print(json.dumps(service.get_stats(), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from lib import strip_compression_extension
+from embedding_cache import texts_to_keys
+
+
+def get_token_cache_directory() -> str:
+    return os.environ.get(
+        "TOKEN_CACHE_DIRECTORY",
+        os.path.join(os.path.expanduser("~"), ".cache", "haystack_wrapper", "token_cache"),
+    )
+
+
+def get_tokenizer_fingerprint(tokenizer, **settings) -> str:
+    hasher = hashlib.sha1()
+    hasher.update(type(tokenizer).__name__.encode("utf-8"))
+    for token, token_id in sorted(tokenizer.get_vocab().items()):
+        hasher.update(f"{token}\t{token_id}\n".encode("utf-8"))
+    hasher.update(str(tokenizer.all_special_ids).encode("utf-8"))
+    for key, value in sorted(settings.items()):
+        hasher.update(f"{key}={value}".encode("utf-8"))
+    return hasher.hexdigest()[:20]
+
+
+def get_passage_tokenizer_fingerprint(retriever) -> str:
+    return get_tokenizer_fingerprint(
+        retriever.passage_tokenizer,
+        max_seq_len_passage=retriever.processor.max_seq_len_passage,
+        embed_title=retriever.processor.embed_title,
+    )
+
+
+def get_corpus_fingerprint(index_data_path: str) -> str:
+    # Only a namespace: the passages are looked up by their text, so a changed corpus can't give wrong
+    # tokens, only misses. The name and size (not mtime) so that a copy on another machine matches.
+    file_name = os.path.basename(strip_compression_extension(index_data_path))
+    hasher = hashlib.sha1(f"{file_name}\t{os.path.getsize(index_data_path)}".encode("utf-8"))
+    return file_name.replace(".", "_") + "__" + hasher.hexdigest()[:12]
+
+
+def get_passage_token_cache_directory(retriever, index_data_path: str) -> str:
+    return os.path.join(
+        get_token_cache_directory(),
+        "passages",
+        get_passage_tokenizer_fingerprint(retriever),
+        get_corpus_fingerprint(index_data_path),
+    )
+
+
+def get_dict_passage_keys(dicts: List[Dict]) -> np.ndarray:
+    # Same keys as embedding_cache.get_passage_keys, from the dicts that embed_documents makes.
+    return texts_to_keys([
+        dict_["passages"][0]["title"] + "\x00" + dict_["passages"][0]["text"] for dict_ in dicts
+    ])
+
+
+class TokenCacheWriter:
+    """
+    Writes the token ids of a corpus into the TokenCache format: the ids of all the passages
+    concatenated (in a raw file, as its size isn't known in advance), their offsets, and the passage
+    keys sorted for binary search with the row of each. meta.json is written last, marking it complete.
+    """
+
+    def __init__(self, directory: str, vocab_size: int) -> None:
+        self.directory = directory
+        self.token_id_dtype = np.dtype(np.uint16 if vocab_size <= 2**16 else np.uint32)
+        os.makedirs(directory, exist_ok=True)
+        self._input_ids_file = open(os.path.join(directory, "input_ids.bin.tmp"), "wb")
+        self._keys = []
+        self._lengths = []
+
+    def add(self, keys: np.ndarray, input_ids: List[List[int]]):
+        assert len(keys) == len(input_ids)
+        lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        flat_input_ids = np.fromiter(
+            (id_ for ids in input_ids for id_ in ids), dtype=self.token_id_dtype, count=int(lengths.sum())
+        )
+        self._input_ids_file.write(flat_input_ids.tobytes())
+        self._keys.append(keys)
+        self._lengths.append(lengths)
+
+    def close(self) -> int:
+        self._input_ids_file.close()
+        os.replace(
+            os.path.join(self.directory, "input_ids.bin.tmp"), os.path.join(self.directory, "input_ids.bin")
+        )
+        keys = np.concatenate(self._keys) if self._keys else np.zeros(0, dtype=texts_to_keys([]).dtype)
+        lengths = np.concatenate(self._lengths) if self._lengths else np.zeros(0, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        keys, rows = np.unique(keys, return_index=True) # sorted, and the first one of duplicates.
+        np.save(os.path.join(self.directory, "keys.npy"), keys)
+        np.save(os.path.join(self.directory, "rows.npy"), rows.astype(np.int64))
+        np.save(os.path.join(self.directory, "offsets.npy"), offsets)
+        meta = {"num_passages": len(lengths), "num_tokens": int(offsets[-1]), "dtype": self.token_id_dtype.name}
+        with open(os.path.join(self.directory, "meta.json.tmp"), "w") as file:
+            json.dump(meta, file)
+        os.replace(os.path.join(self.directory, "meta.json.tmp"), os.path.join(self.directory, "meta.json"))
+        return len(keys)
+
+
+class TokenCache:
+    """
+    Memory-mapped token ids of a corpus (see TokenCacheWriter), looked up by the passage keys.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as file:
+            self.meta = json.load(file)
+        self.keys = np.load(os.path.join(directory, "keys.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(directory, "rows.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self.input_ids = np.memmap(os.path.join(directory, "input_ids.bin"), dtype=self.meta["dtype"], mode="r")
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, "meta.json"))
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (rows, found) where rows are only valid where found is True.
+        """
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        self.num_lookups += len(keys)
+        self.num_hits += int(found.sum())
+        return np.asarray(self.rows[positions]), found
+
+    def fill_input_ids(self, rows: np.ndarray, input_ids: np.ndarray) -> np.ndarray:
+        # Copies the ids of the rows into the (padded) input_ids, and returns the lengths.
+        starts = np.asarray(self.offsets[rows])
+        lengths = np.minimum(np.asarray(self.offsets[rows + 1]) - starts, input_ids.shape[1])
+        positions = np.arange(input_ids.shape[1])
+        is_token = positions[None, :] < lengths[:, None]
+        input_ids[is_token] = self.input_ids[(starts[:, None] + positions[None, :])[is_token]]
+        return lengths
+
+    def print_stats(self):
+        hit_rate = self.num_hits / self.num_lookups if self.num_lookups else 0.0
+        print(
+            f"Token cache ({self.directory}): {self.num_hits}/{self.num_lookups} hits ({hit_rate:.1%}), "
+            f"{self.meta['num_passages']} passages."
+        )
+
+
+def attach_passage_token_cache(retriever, index_data_path: str) -> Optional[TokenCache]:
+    """
+    Makes _get_predictions (see haystack_monkeypatch.py) read the passage token ids from the token
+    cache of this corpus and tokenizer, made by pretokenize_dpr.py, instead of tokenizing them.
+    """
+    directory = get_passage_token_cache_directory(retriever, index_data_path)
+    if not TokenCache.exists(directory):
+        print(
+            f"WARNING: The token cache {directory} doesn't exist, so the passages will be tokenized. "
+            "Make it with pretokenize_dpr.py."
+        )
+        return None
+    token_cache = TokenCache(directory)
+    print(f"Using passage token cache: {directory}")
+    retriever.token_cache = token_cache
+    return token_cache
@@ -0,0 +1,407 @@
+import os
+import json
+import shutil
+import argparse
+from itertools import islice
+from typing import Callable, Dict, Iterator, List
+
+import _jsonnet
+import numpy as np
+
+from lib import yield_jsonl_slice, read_json, write_json, load_cwd_dotenv
+from dpr_lib import get_index_name, build_milvus_document_store, bulk_write_documents
+from local_document_store import LOCAL_INDEX_TYPES, build_local_document_store
+from ingestion_pipeline import IngestionPipeline
+from index_dpr import normalize_document, finish_local_index
+
+
+# Moves the embeddings of an index between the document stores (milvus, faiss and local) without
+# re-encoding the corpus. An export directory has, per shard, embeddings_{shard}.npy (float32, rows
+# in the order of the id table) and ids_{shard}.jsonl (the id and id_prefix of the documents, as in
+# sql), and a manifest.json written last, so an interrupted export isn't mistaken for a complete one.
+
+MILVUS_INDEX_TYPES = ("FLAT", "IVF_FLAT", "HNSW")
+BACKENDS = ("milvus", "faiss", "local")
+
+
+class EmbeddingShardWriter:
+    """
+    Writes the pages of (ids, id prefixes, embeddings) into the shards of num_embeddings rows in total.
+    The embeddings go into memory-mapped .npy files of known shape, so only a page is ever in memory.
+    """
+
+    def __init__(self, directory: str, embedding_dim: int, num_embeddings: int, shard_size: int) -> None:
+        self.directory = directory
+        self.embedding_dim = embedding_dim
+        self.num_embeddings = num_embeddings
+        self.shard_size = shard_size
+        self.shards: List[Dict] = []
+        self.num_written_embeddings = 0
+        self._embeddings = None
+        self._ids_file = None
+        self._shard_offset = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_shard(self):
+        num_shard_embeddings = min(self.shard_size, self.num_embeddings - self.num_written_embeddings)
+        assert num_shard_embeddings > 0, "There are more embeddings than counted, the index changed during the export."
+        name = f"{len(self.shards):05d}"
+        self.shards.append({
+            "embeddings_file_name": f"embeddings_{name}.npy",
+            "ids_file_name": f"ids_{name}.jsonl",
+            "num_embeddings": num_shard_embeddings,
+        })
+        self._embeddings = np.lib.format.open_memmap(
+            os.path.join(self.directory, self.shards[-1]["embeddings_file_name"]),
+            mode="w+", dtype=np.float32, shape=(num_shard_embeddings, self.embedding_dim),
+        )
+        self._ids_file = open(os.path.join(self.directory, self.shards[-1]["ids_file_name"]), "w")
+        self._shard_offset = 0
+
+    def _close_shard(self):
+        self._embeddings.flush()
+        self._embeddings = None
+        self._ids_file.close()
+        self._ids_file = None
+
+    def add(self, ids: List[str], id_prefixes: List[str], embeddings: np.ndarray):
+        assert len(ids) == len(id_prefixes) == len(embeddings)
+        start = 0
+        while start < len(ids):
+            if self._embeddings is None:
+                self._open_shard()
+            end = start + min(len(ids) - start, len(self._embeddings) - self._shard_offset)
+            self._embeddings[self._shard_offset:self._shard_offset + end - start] = embeddings[start:end]
+            self._ids_file.write("".join(
+                json.dumps({"id": id_, "id_prefix": id_prefix}) + "\n"
+                for id_, id_prefix in zip(ids[start:end], id_prefixes[start:end])
+            ))
+            self._shard_offset += end - start
+            self.num_written_embeddings += end - start
+            start = end
+            if self._shard_offset == len(self._embeddings):
+                self._close_shard()
+
+    def close(self, source: Dict) -> Dict:
+        assert self.num_written_embeddings == self.num_embeddings, \
+            "There are fewer embeddings than counted, the index changed during the export."
+        manifest = {
+            "embedding_dim": self.embedding_dim,
+            "dtype": "float32",
+            "num_embeddings": self.num_embeddings,
+            "shards": self.shards,
+            "source": source,
+        }
+        write_json(manifest, os.path.join(self.directory, "manifest.json"))
+        return manifest
+
+
+def read_embedding_manifest(directory: str) -> Dict:
+    manifest_path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        exit(f"{manifest_path} not found, the export in {directory} is incomplete or missing.")
+    return read_json(manifest_path)
+
+
+def yield_embedding_pages(directory: str, page_size: int) -> Iterator[Dict]:
+    # The embeddings of a page are a slice of the memory-mapped shard, read when they're used.
+    for shard in read_embedding_manifest(directory)["shards"]:
+        embeddings = np.load(os.path.join(directory, shard["embeddings_file_name"]), mmap_mode="r")
+        with open(os.path.join(directory, shard["ids_file_name"])) as file:
+            for start in range(0, shard["num_embeddings"], page_size):
+                id_rows = [json.loads(line) for line in islice(file, page_size)]
+                yield {
+                    "ids": [id_row["id"] for id_row in id_rows],
+                    "id_prefixes": [id_row["id_prefix"] for id_row in id_rows],
+                    "embeddings": embeddings[start:start + len(id_rows)],
+                }
+
+
+def yield_document_pages(document_store, page_size: int) -> Iterator[Dict]:
+    # The (id, id_prefix, vector_id) of the documents with embeddings, streamed from sql (a server-side
+    # cursor on postgresql) in one query, with the pages sorted by vector id for the embedding reads.
+    from sqlalchemy import and_, select
+    from haystack.document_stores.sql import DocumentORM, MetaDocumentORM
+    statement = select(DocumentORM.id, DocumentORM.vector_id, MetaDocumentORM.value).outerjoin(
+        MetaDocumentORM,
+        and_(
+            MetaDocumentORM.document_id == DocumentORM.id,
+            MetaDocumentORM.document_index == DocumentORM.index,
+            MetaDocumentORM.name == "id_prefix",
+        ),
+    ).where(DocumentORM.index == document_store.index, DocumentORM.vector_id.isnot(None))
+    result = document_store.session.execute(statement.execution_options(stream_results=True))
+    for rows in result.partitions(page_size):
+        rows = sorted(rows, key=lambda row: int(row.vector_id))
+        yield {
+            "ids": [row.id for row in rows],
+            "id_prefixes": [row.value or "" for row in rows],
+            "vector_ids": [row.vector_id for row in rows],
+        }
+
+
+def get_embedding_reader(document_store, backend: str) -> Callable[[List[str]], np.ndarray]:
+    # A function of the (sorted) vector ids of a page to their embeddings.
+    if backend == "milvus":
+        collection = document_store.collection
+        collection.load()
+
+        def read_embeddings(vector_ids: List[str]) -> np.ndarray:
+            results = collection.query(
+                expr=f"{document_store.id_field} in [{','.join(vector_ids)}]",
+                output_fields=[document_store.embedding_field],
+            )
+            vector_id_to_embedding = {
+                str(result[document_store.id_field]): result[document_store.embedding_field] for result in results
+            }
+            missing_vector_ids = set(vector_ids) - set(vector_id_to_embedding)
+            assert not missing_vector_ids, f"{len(missing_vector_ids)} vector ids of sql aren't in milvus."
+            return np.array([vector_id_to_embedding[vector_id] for vector_id in vector_ids], dtype=np.float32)
+
+    elif backend == "faiss":
+        import faiss
+        faiss_index = document_store.faiss_indexes[document_store.index]
+        try: # IVF indexes need the map from the vector ids to the lists to reconstruct.
+            faiss.extract_index_ivf(faiss_index).make_direct_map()
+        except RuntimeError:
+            pass
+
+        def read_embeddings(vector_ids: List[str]) -> np.ndarray:
+            # The vector ids are the positions in the index, so a page is mostly one run of them.
+            rows = np.array([int(vector_id) for vector_id in vector_ids], dtype=np.int64)
+            run_starts = np.flatnonzero(np.diff(rows, prepend=-2) != 1)
+            run_ends = np.append(run_starts[1:], len(rows))
+            return np.concatenate([
+                faiss_index.reconstruct_n(int(rows[start]), int(end - start))
+                for start, end in zip(run_starts, run_ends)
+            ]).astype(np.float32)
+
+    else:
+
+        def read_embeddings(vector_ids: List[str]) -> np.ndarray:
+            rows = np.array([int(vector_id) for vector_id in vector_ids], dtype=np.int64)
+            return np.asarray(document_store.get_embeddings()[rows], dtype=np.float32)
+
+    return read_embeddings
+
+
+def get_embedding_inserter(document_store, backend: str) -> Callable[[np.ndarray], List[str]]:
+    # A function of the embeddings of a page to their (new) vector ids.
+    if backend == "milvus":
+
+        def insert_embeddings(embeddings: np.ndarray) -> List[str]:
+            mutation_result = document_store.collection.insert([embeddings.tolist()])
+            return [str(vector_id) for vector_id in mutation_result.primary_keys]
+
+    elif backend == "faiss":
+        faiss_index = document_store.faiss_indexes[document_store.index]
+        if not faiss_index.is_trained:
+            exit("The faiss index isn't trained. Train it (FAISSDocumentStore.train_index) before the import.")
+
+        def insert_embeddings(embeddings: np.ndarray) -> List[str]:
+            # As FAISSDocumentStore.write_documents, the vector ids are the positions in the index.
+            vector_id = faiss_index.ntotal
+            faiss_index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+            return [str(vector_id + index) for index in range(len(embeddings))]
+
+    else:
+        insert_embeddings = document_store.add_embeddings
+    return insert_embeddings
+
+
+def export_embeddings(document_store, backend: str, directory: str, page_size: int, shard_size: int, source: Dict):
+    num_documents = document_store.get_document_count()
+    num_embeddings = num_documents - document_store.get_document_count(only_documents_without_embedding=True)
+    print(f"Exporting the embeddings of {num_embeddings}/{num_documents} documents to {directory}.")
+    writer = EmbeddingShardWriter(directory, document_store.embedding_dim, num_embeddings, shard_size)
+    read_embeddings = get_embedding_reader(document_store, backend)
+
+    def read_page(page: Dict) -> Dict:
+        page["embeddings"] = read_embeddings(page["vector_ids"])
+        return page
+
+    def write_page(page: Dict) -> Dict:
+        writer.add(page["ids"], page["id_prefixes"], page.pop("embeddings"))
+        return page
+
+    pipeline = IngestionPipeline(
+        stages=[("read", read_page), ("write", write_page)],
+        queue_size=4,
+        get_item_size=lambda page: len(page["ids"]),
+    )
+    pipeline.run(yield_document_pages(document_store, page_size), source_name="sql")
+    pipeline.print_report()
+    manifest = writer.close(source)
+    print(f"Exported {manifest['num_embeddings']} embeddings in {len(manifest['shards'])} shards.")
+
+
+def import_embeddings(document_store, backend: str, directory: str, page_size: int):
+    """
+    Inserts the embeddings of the export into the vector store and updates the vector ids of their
+    documents in sql. The documents must be in sql already (see --write_documents), and the ones that
+    aren't, or that have an embedding already, are skipped, so an interrupted import can be rerun.
+    """
+    from sqlalchemy import select
+    from sqlalchemy.orm import sessionmaker
+    from haystack.document_stores.sql import DocumentORM
+    manifest = read_embedding_manifest(directory)
+    assert manifest["embedding_dim"] == document_store.embedding_dim, \
+        f"The export has {manifest['embedding_dim']}-dim embeddings, the document store {document_store.embedding_dim}."
+    print(f"Importing {manifest['num_embeddings']} embeddings from {directory} (exported from {manifest['source']}).")
+    index = document_store.index
+    insert_embeddings = get_embedding_inserter(document_store, backend)
+    # The insert stage updates the vector ids with the session of the document store, so the
+    # match stage (in another thread) reads with its own.
+    match_session = sessionmaker(bind=document_store.session.get_bind())()
+    counts = {"missing": 0, "embedded": 0, "inserted": 0}
+
+    def match_page(page: Dict) -> Dict:
+        rows = match_session.execute(
+            select(DocumentORM.id, DocumentORM.vector_id).where(
+                DocumentORM.index == index, DocumentORM.id.in_(page["ids"])
+            )
+        ).all()
+        id_to_vector_id = {row.id: row.vector_id for row in rows}
+        positions = [
+            position for position, id_ in enumerate(page["ids"])
+            if id_ in id_to_vector_id and id_to_vector_id[id_] is None
+        ]
+        counts["missing"] += len(page["ids"]) - len(id_to_vector_id)
+        counts["embedded"] += len(id_to_vector_id) - len(positions)
+        page["ids"] = [page["ids"][position] for position in positions]
+        page["embeddings"] = np.asarray(page["embeddings"][positions], dtype=np.float32)
+        return page
+
+    def insert_page(page: Dict) -> Dict:
+        if page["ids"]:
+            vector_ids = insert_embeddings(page["embeddings"])
+            document_store.update_vector_ids(dict(zip(page["ids"], vector_ids)), index=index)
+            counts["inserted"] += len(vector_ids)
+        page.pop("embeddings")
+        return page
+
+    pipeline = IngestionPipeline(
+        stages=[("match", match_page), ("insert", insert_page)],
+        queue_size=4,
+        get_item_size=lambda page: len(page["ids"]),
+    )
+    pipeline.run(yield_embedding_pages(directory, page_size), source_name="shards")
+    pipeline.print_report()
+    match_session.close()
+    print(
+        f"Inserted {counts['inserted']} embeddings, skipped {counts['embedded']} of documents with embeddings "
+        f"and {counts['missing']} of documents that aren't in the document store."
+    )
+
+
+def write_index_documents(document_store, index_data_path: str, embed_title: bool, batch_size: int, num_workers: int):
+    # As index_dpr.py writes them, without the embeddings.
+    print(f"Writing the documents of {index_data_path}.")
+    num_written_documents = 0
+    documents = []
+    for document in yield_jsonl_slice(index_data_path, 1, 0, num_workers=num_workers):
+        documents.append(normalize_document(document, embed_title))
+        if len(documents) >= batch_size:
+            num_written_documents += len(bulk_write_documents(document_store, documents, batch_size=batch_size))
+            documents = []
+    if documents:
+        num_written_documents += len(bulk_write_documents(document_store, documents, batch_size=batch_size))
+    print(f"Number of new documents written: {num_written_documents}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the embeddings of an index to .npy shards, or import them into another document store."
+    )
+    parser.add_argument("command", type=str, choices=("export", "import"), help="export or import.")
+    parser.add_argument(
+        "experiment_name", type=str, help="experiment_name (from config file in experiment_config/)."
+    )
+    parser.add_argument("directory", type=str, help="directory of the exported embeddings.")
+    parser.add_argument(
+        "--index_type", type=str, default=None,
+        help="index type of the document store, if not the one of the experiment config.",
+    )
+    parser.add_argument(
+        "--backend", type=str, choices=BACKENDS, default=None,
+        help="document store (default: local for the local index types, milvus for FLAT/IVF_FLAT/HNSW, o/w faiss).",
+    )
+    parser.add_argument("--page_size", type=int, help="number of embeddings read and written at once.", default=10_000)
+    parser.add_argument("--shard_size", type=int, help="number of embeddings per exported shard.", default=1_000_000)
+    parser.add_argument("--force", action="store_true", help="remake the export if it exists.")
+    parser.add_argument(
+        "--write_documents", action="store_true",
+        help="write the documents of index_data_path into the document store before the import.",
+    )
+    parser.add_argument("--num_read_workers", type=int, help="number of json parsing processes.", default=1)
+    args = parser.parse_args()
+    load_cwd_dotenv()
+
+    experiment_config_file_path = os.path.join("experiment_configs", args.experiment_name + ".jsonnet")
+    if not os.path.exists(experiment_config_file_path):
+        exit(f"Experiment config file_path {experiment_config_file_path} not found.")
+    experiment_config = json.loads(_jsonnet.evaluate_file(experiment_config_file_path))
+
+    embed_title = experiment_config.pop("embed_title", True)
+    index_write_batch_size = experiment_config.pop("index_write_batch_size", 10_000)
+    index_data_path = experiment_config.pop("index_data_path")
+    index_name = get_index_name(args.experiment_name, index_data_path)
+    index_type = args.index_type or experiment_config.pop("index_type")
+    backend = args.backend
+    if backend is None:
+        backend = (
+            "local" if index_type in LOCAL_INDEX_TYPES else "milvus" if index_type in MILVUS_INDEX_TYPES else "faiss"
+        )
+    print(f"Index name: {index_name}")
+    print(f"Index type: {index_type} ({backend})")
+
+    if args.command == "export":
+        if os.path.exists(args.directory) and os.listdir(args.directory):
+            if not args.force:
+                exit(f"The export directory {args.directory} isn't empty. Use --force to remake it.")
+            shutil.rmtree(args.directory)
+
+    document_store_manager = None
+    if backend == "milvus":
+        document_store = build_milvus_document_store(index_name, index_type, delete_if_exists=False)
+    elif backend == "faiss":
+        from index_dpr_faiss import FaissDocumentStoreManager
+        document_store_manager = FaissDocumentStoreManager(args.experiment_name, index_data_path, index_type)
+        document_store = document_store_manager.load(delete_if_exists=False)
+    else:
+        document_store = build_local_document_store(
+            index_name, index_type, codec=experiment_config.pop("codec", "float32")
+        )
+    document_store.progress_bar = False
+
+    if args.command == "export":
+        source = {"experiment_name": args.experiment_name, "index_name": index_name, "index_type": index_type}
+        export_embeddings(document_store, backend, args.directory, args.page_size, args.shard_size, source)
+        return
+
+    if args.write_documents:
+        write_index_documents(
+            document_store, index_data_path, embed_title, index_write_batch_size, args.num_read_workers
+        )
+    import_embeddings(document_store, backend, args.directory, args.page_size)
+    if backend == "milvus":
+        from pymilvus import utility
+        print("Flushing milvus collection and waiting for the index to be built.")
+        document_store.collection.flush()
+        utility.wait_for_index_building_complete(document_store.index)
+        document_store.collection.load()
+    elif backend == "faiss":
+        print("Saving the faiss index.")
+        document_store_manager.save(document_store)
+    else:
+        finish_local_index(document_store, experiment_config.pop("nlist", 16384))
+    num_documents_without_embedding = document_store.get_document_count(only_documents_without_embedding=True)
+    if num_documents_without_embedding:
+        print(
+            f"WARNING: {num_documents_without_embedding} documents of the index don't have embeddings. "
+            "Embed them with the index script of the document store."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+from typing import Dict, Optional
+
+import numpy as np
+from tqdm.auto import tqdm
+
+
+# Compressed storage of the embeddings of LocalDocumentStore. The queries stay float32 and are
+# scored (dot product) directly against the codes, a block at a time, so only the codes of the
+# block are decoded. 768-dim embeddings take 3072 bytes in float32, 1536 in float16, 768 in int8
+# and embedding_dim / 8 (96) with pq.
+CODEC_NAMES = ("float32", "float16", "int8", "pq")
+
+
+def assign_to_centroids(embeddings: np.ndarray, centroids: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    # The nearest centroid (by l2 distance) of each embedding: the argmax of x.c - |c|^2/2.
+    half_squared_norms = 0.5 * (centroids * centroids).sum(axis=1)
+    assignments = np.zeros(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), chunk_size):
+        scores = np.asarray(embeddings[start:start+chunk_size], dtype=np.float32) @ centroids.T - half_squared_norms
+        assignments[start:start+chunk_size] = scores.argmax(axis=1)
+    return assignments
+
+
+def train_kmeans(
+    sample: np.ndarray,
+    num_clusters: int,
+    batch_size: int = 65536,
+    num_iterations: int = 100,
+    chunk_size: int = 4096,
+    rng: Optional[np.random.Generator] = None,
+    progress_bar: bool = False,
+) -> np.ndarray:
+    """
+    Mini-batch k-means (l2) of the sample rows. Each centroid is the running mean of the embeddings
+    assigned to it, and the centroids that got none are re-seeded from the sample at the end.
+    """
+    rng = rng or np.random.default_rng(0)
+    sample_size = len(sample)
+    centroids = sample[rng.choice(sample_size, size=num_clusters, replace=False)].astype(np.float32)
+    counts = np.zeros(num_clusters, dtype=np.int64)
+    for _ in tqdm(range(num_iterations), disable=not progress_bar):
+        batch = sample[rng.choice(sample_size, size=min(batch_size, sample_size), replace=False)]
+        assignments = assign_to_centroids(batch, centroids, chunk_size)
+        batch_counts = np.bincount(assignments, minlength=num_clusters)
+        batch_sums = np.zeros_like(centroids)
+        np.add.at(batch_sums, assignments, batch)
+        counts += batch_counts
+        updated = batch_counts > 0
+        # The learning rate of a centroid decays with the number of embeddings assigned to it so far.
+        centroids[updated] += (
+            batch_sums[updated] - batch_counts[updated, None] * centroids[updated]
+        ) / counts[updated, None]
+    empty = np.flatnonzero(counts == 0)
+    centroids[empty] = sample[rng.choice(sample_size, size=len(empty), replace=False)]
+    return centroids
+
+
+class VectorCodec:
+    """
+    The float32 codec, which stores the embeddings as they are. The other codecs override the code
+    type, the training (on a sample of the embeddings), the encoding and the scoring.
+    """
+
+    name = "float32"
+
+    def __init__(self, embedding_dim: int) -> None:
+        self.embedding_dim = embedding_dim
+
+    @property
+    def code_dtype(self) -> np.dtype:
+        return np.dtype(np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return self.embedding_dim
+
+    @property
+    def num_bytes_per_vector(self) -> int:
+        return self.code_size * self.code_dtype.itemsize
+
+    @property
+    def num_state_bytes(self) -> int:
+        return sum(array.nbytes for array in self.get_state().values())
+
+    def train(self, sample: np.ndarray, rng: Optional[np.random.Generator] = None, progress_bar: bool = False):
+        pass
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def score(self, query_embs: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return query_embs @ np.asarray(codes, dtype=np.float32).T
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return {}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        pass
+
+
+class Float16Codec(VectorCodec):
+
+    name = "float16"
+
+    @property
+    def code_dtype(self) -> np.dtype:
+        return np.dtype(np.float16)
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        return np.asarray(embeddings, dtype=np.float16)
+
+
+class Int8Codec(VectorCodec):
+    """
+    Per-dimension scalar quantization: each dimension is mapped linearly from its [min, max] on
+    the training sample to 0..255. The score is q.(min + code * scale) = q.min + (q * scale).code.
+    """
+
+    name = "int8"
+
+    def __init__(self, embedding_dim: int) -> None:
+        super().__init__(embedding_dim)
+        self.minimums = np.zeros(embedding_dim, dtype=np.float32)
+        self.scales = np.ones(embedding_dim, dtype=np.float32)
+
+    @property
+    def code_dtype(self) -> np.dtype:
+        return np.dtype(np.uint8)
+
+    def train(self, sample: np.ndarray, rng: Optional[np.random.Generator] = None, progress_bar: bool = False):
+        self.minimums = sample.min(axis=0).astype(np.float32)
+        self.scales = np.maximum((sample.max(axis=0) - self.minimums) / 255, 1e-12).astype(np.float32)
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(embeddings, dtype=np.float32) - self.minimums) / self.scales)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def score(self, query_embs: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        offsets = query_embs @ self.minimums
+        return (query_embs * self.scales) @ np.asarray(codes, dtype=np.float32).T + offsets[:, None]
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return {"minimums": self.minimums, "scales": self.scales}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.minimums, self.scales = state["minimums"], state["scales"]
+
+
+class PQCodec(VectorCodec):
+    """
+    Product quantization: the embedding is split into num_subquantizers sub-vectors, and each is
+    stored as the (one byte) index of its nearest of 256 k-means centroids of that subspace. The
+    score is the sum over the subspaces of the query's dot product with the code's centroid, which
+    is looked up from a (num_queries, num_subquantizers, 256) table computed once per query block.
+    """
+
+    name = "pq"
+
+    def __init__(self, embedding_dim: int, num_subquantizers: Optional[int] = None) -> None:
+        super().__init__(embedding_dim)
+        self.num_subquantizers = num_subquantizers or embedding_dim // 8
+        assert embedding_dim % self.num_subquantizers == 0
+        self.subvector_dim = embedding_dim // self.num_subquantizers
+        self.codebooks = np.zeros((self.num_subquantizers, 256, self.subvector_dim), dtype=np.float32)
+
+    @property
+    def code_dtype(self) -> np.dtype:
+        return np.dtype(np.uint8)
+
+    @property
+    def code_size(self) -> int:
+        return self.num_subquantizers
+
+    def _split(self, embeddings: np.ndarray) -> np.ndarray:
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), self.num_subquantizers, -1)
+
+    def train(self, sample: np.ndarray, rng: Optional[np.random.Generator] = None, progress_bar: bool = False):
+        assert len(sample) >= 256, "pq needs at least 256 embeddings to train on."
+        subvectors = self._split(sample)
+        for subquantizer in tqdm(range(self.num_subquantizers), disable=not progress_bar):
+            self.codebooks[subquantizer] = train_kmeans(
+                np.ascontiguousarray(subvectors[:, subquantizer]), 256, num_iterations=25, rng=rng
+            )
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        subvectors = self._split(embeddings)
+        codes = np.zeros((len(embeddings), self.num_subquantizers), dtype=np.uint8)
+        for subquantizer in range(self.num_subquantizers):
+            codes[:, subquantizer] = assign_to_centroids(subvectors[:, subquantizer], self.codebooks[subquantizer])
+        return codes
+
+    def score(self, query_embs: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        tables = np.einsum("qmd,mkd->qmk", self._split(query_embs), self.codebooks)
+        codes = np.asarray(codes)
+        scores = np.zeros((len(query_embs), len(codes)), dtype=np.float32)
+        for subquantizer in range(self.num_subquantizers):
+            scores += tables[:, subquantizer, codes[:, subquantizer]]
+        return scores
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return {"codebooks": self.codebooks}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.codebooks = state["codebooks"]
+        self.num_subquantizers, _, self.subvector_dim = self.codebooks.shape
+
+
+def get_codec(name: str, embedding_dim: int) -> VectorCodec:
+    name_to_class = {
+        codec_class.name: codec_class for codec_class in (VectorCodec, Float16Codec, Int8Codec, PQCodec)
+    }
+    if name not in name_to_class:
+        raise ValueError(f"Unknown codec {name}. Use one of {CODEC_NAMES}.")
+    return name_to_class[name](embedding_dim)